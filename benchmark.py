@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+"""
+PFshare benchmark suite
+Generates a synthetic tree, drives the server with concurrent HTTP and Socket.IO
+clients and writes latency percentiles and throughput for each scenario as JSON.
+
+    python benchmark.py                                  # throwaway server on a generated tree
+    python benchmark.py --url http://host:80 --files ./files
+    python benchmark.py --compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import shutil
+import http.client
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import socketio
+except ImportError:
+    socketio = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TREE_ROOT = "bench"  # Everything the suite creates lives below this folder
+TREE_MARKER = ".bench-tree.json"
+FANOUT_TIMEOUT = 10  # Seconds to wait for an event to reach every client
+SERVER_START_TIMEOUT = 120  # Seconds to wait for the server and its search index
+
+# Runs the app from the working directory so ./files is the generated tree
+SERVER_LAUNCHER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import pfshare
+pfshare.start_services()
+pfshare.socketio.run(pfshare.app, host='127.0.0.1', port=int(sys.argv[2]), allow_unsafe_werkzeug=True)
+"""
+
+SCENARIOS = [
+    'list_wide', 'list_wide_all', 'list_deep', 'page_wide', 'search',
+    'download', 'download_range', 'upload', 'upload_chunked', 'zip', 'fanout'
+]
+
+class BenchError(Exception):
+    """A request that did not return what the scenario expects"""
+
+# Synthetic tree
+
+def write_random_file(path, size, rng, block=1024 * 1024):
+    """Write size bytes of seeded random data"""
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(block, size)
+            f.write(rng.randbytes(n))
+            size -= n
+
+def generate_tree(files_dir, params):
+    """Create bench/{wide,deep,large,zip,upload,fanout} below files_dir; reused when the parameters match"""
+    root = os.path.join(files_dir, TREE_ROOT)
+    marker = os.path.join(root, TREE_MARKER)
+    try:
+        with open(marker, 'r') as f:
+            if json.load(f) == params:
+                return root
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(root, ignore_errors=True)
+    rng = random.Random(params['seed'])
+    words = ['report', 'photo', 'notes', 'backup', 'invoice', 'draft', 'music', 'video', 'scan', 'log']
+    exts = ['.txt', '.jpg', '.pdf', '.mp3', '.csv', '.zip', '.log', '.md']
+
+    # One folder with many small entries
+    wide = os.path.join(root, 'wide')
+    os.makedirs(wide)
+    for i in range(params['wide_files']):
+        name = f"{rng.choice(words)}_{i:06d}{rng.choice(exts)}"
+        write_random_file(os.path.join(wide, name), rng.randint(0, 4096), rng)
+    for i in range(params['wide_files'] // 100):
+        os.makedirs(os.path.join(wide, f"folder_{i:04d}"))
+
+    # A narrow chain of nested folders
+    level = os.path.join(root, 'deep')
+    for depth in range(params['deep_depth']):
+        os.makedirs(level)
+        for i in range(params['deep_files']):
+            write_random_file(os.path.join(level, f"{rng.choice(words)}_{depth}_{i}{rng.choice(exts)}"), 16 * 1024, rng)
+        level = os.path.join(level, f"level_{depth + 1}")
+
+    # Large files for full and ranged downloads
+    large = os.path.join(root, 'large')
+    os.makedirs(large)
+    write_random_file(os.path.join(large, 'large.bin'), params['large_size'], rng)
+
+    # A mix of compressible and incompressible files to zip
+    zip_dir = os.path.join(root, 'zip')
+    for i in range(params['zip_files']):
+        sub = os.path.join(zip_dir, f"part_{i % 8}")
+        os.makedirs(sub, exist_ok=True)
+        if i % 2:
+            write_random_file(os.path.join(sub, f"data_{i}.bin"), params['zip_file_size'], rng)
+        else:
+            with open(os.path.join(sub, f"text_{i}.txt"), 'w') as f:
+                f.write(' '.join(rng.choice(words) for _ in range(params['zip_file_size'] // 6)))
+
+    os.makedirs(os.path.join(root, 'upload'))
+    os.makedirs(os.path.join(root, 'fanout'))
+
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return root
+
+# Server
+
+def free_port():
+    """Ask the OS for an unused local port"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, port):
+    """Run pfshare.py from workdir in a child process; output goes to workdir/server.log"""
+    log = open(os.path.join(workdir, 'server.log'), 'ab')
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVER_LAUNCHER, REPO_DIR, str(port)],
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT
+    )
+    log.close()
+    return process
+
+def wait_until_ready(base_url, process=None):
+    """Wait until the server answers and its search index has been built"""
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise BenchError(f"Server exited with code {process.returncode}")
+        try:
+            status, _, _ = request_once(base_url, 'GET', '/api/search?' + urlencode({'q': 'bench'}))
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.25)
+    raise BenchError("Server did not become ready in time")
+
+# HTTP
+
+class Client:
+    """One keep-alive connection with the session cookie, used by a single thread"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.https = parts.scheme == 'https'
+        self.cookie = None
+        self.conn = None
+
+    def connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.conn = cls(self.host, self.port, timeout=120)
+
+    def request(self, method, path, body=None, headers=None, expect=(200,)):
+        """Send a request and read the whole response; returns (status, headers, body)"""
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        for attempt in range(2):
+            if self.conn is None:
+                self.connect()
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server closed an idle keep-alive connection; retry once on a new one
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        if response.will_close:
+            self.conn.close()
+            self.conn = None
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        if response.status not in expect:
+            raise BenchError(f"{method} {path} returned {response.status}: {data[:200]!r}")
+        return response.status, response, data
+
+    def json(self, method, path, payload=None, expect=(200,)):
+        body = json.dumps(payload).encode() if payload is not None else None
+        _, _, data = self.request(method, path, body, {'Content-Type': 'application/json'}, expect)
+        return json.loads(data)
+
+    def login(self, password):
+        body = urlencode({'password': password}).encode()
+        self.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'}, expect=(200, 302))
+        if not self.cookie:
+            raise BenchError("Login did not return a session cookie")
+
+def request_once(base_url, method, path):
+    """Single request on a fresh connection"""
+    client = Client(base_url)
+    return client.request(method, path, expect=range(100, 600))
+
+def multipart_body(fields, filename, content):
+    """Encode form fields and one file as multipart/form-data"""
+    boundary = '----pfshare-bench-' + os.urandom(8).hex()
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+# Measurement
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize(latencies, errors, duration, transferred, concurrency):
+    """Latency percentiles in milliseconds plus throughput for one scenario"""
+    values = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'requests': len(values),
+        'errors': len(errors),
+        'first_errors': errors[:5],
+        'concurrency': concurrency,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(values) / duration, 2) if duration else None,
+        'bytes': transferred,
+        'throughput_mb_s': round(transferred / duration / 1024 / 1024, 2) if duration else None,
+        'latency_ms': {
+            'min': ms(values[0] if values else None),
+            'mean': ms(sum(values) / len(values) if values else None),
+            'p50': ms(percentile(values, 50)),
+            'p90': ms(percentile(values, 90)),
+            'p99': ms(percentile(values, 99)),
+            'max': ms(values[-1] if values else None)
+        }
+    }
+
+def run_load(base_url, operation, requests, concurrency):
+    """Call operation(client, i) requests times from concurrency threads; it returns bytes moved"""
+    local = threading.local()
+    lock = threading.Lock()
+    latencies, errors = [], []
+    transferred = 0
+
+    def worker(i):
+        nonlocal transferred
+        if not hasattr(local, 'client'):
+            local.client = Client(base_url)
+        start = time.perf_counter()
+        try:
+            moved = operation(local.client, i)
+        except (BenchError, OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            transferred += moved or 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(requests)))
+    return summarize(latencies, errors, time.perf_counter() - started, transferred, concurrency)
+
+# Scenarios
+
+def http_scenarios(args, rng):
+    """Map scenario name to a per-request operation"""
+    tree = TREE_ROOT
+    deep_paths = [f"{tree}/deep" + ''.join(f"/level_{d}" for d in range(1, depth + 1)) for depth in range(args.deep_depth)]
+    search_terms = ['report', 'photo_0', 'notes', '000', 'invoice_00', 'scan', '.pdf', 'level']
+    upload_content = rng.randbytes(args.upload_size)
+
+    def get(path, headers=None, expect=(200,)):
+        def operation(client, i):
+            _, _, data = client.request('GET', path, headers=headers, expect=expect)
+            return len(data)
+        return operation
+
+    def list_wide_all(client, i):
+        cursor, moved = None, 0
+        while True:
+            query = {'path': f"{tree}/wide", 'limit': 1000}
+            if cursor:
+                query['cursor'] = cursor
+            _, _, data = client.request('GET', '/api/list?' + urlencode(query))
+            moved += len(data)
+            cursor = json.loads(data).get('next_cursor')
+            if not cursor:
+                return moved
+
+    def list_deep(client, i):
+        _, _, data = client.request('GET', '/api/list?' + urlencode({'path': deep_paths[i % len(deep_paths)]}))
+        return len(data)
+
+    def search(client, i):
+        query = {'q': search_terms[i % len(search_terms)], 'path': tree}
+        _, _, data = client.request('GET', '/api/search?' + urlencode(query))
+        return len(data)
+
+    def download_range(client, i):
+        size = min(args.range_size, args.large_size)
+        start = random.Random(i).randint(0, args.large_size - size)
+        path = '/download?' + urlencode({'path': f"{tree}/large/large.bin"})
+        _, _, data = client.request('GET', path, headers={'Range': f"bytes={start}-{start + size - 1}"}, expect=(206,))
+        if len(data) != size:
+            raise BenchError(f"Range returned {len(data)} bytes instead of {size}")
+        return len(data)
+
+    def upload(client, i):
+        body, content_type = multipart_body({'path': f"{tree}/upload"}, f"upload_{i}.bin", upload_content)
+        client.request('POST', '/upload', body, {'Content-Type': content_type})
+        return len(upload_content)
+
+    def upload_chunked(client, i):
+        size = len(upload_content)
+        started = client.json('POST', '/upload_session', {'path': f"{tree}/upload", 'name': f"chunked_{i}.bin", 'size': size})
+        chunk = started.get('chunk_size') or size
+        for offset in range(0, size, chunk):
+            query = urlencode({'upload_id': started['upload_id'], 'offset': offset})
+            client.request('PUT', '/upload_chunk?' + query, upload_content[offset:offset + chunk],
+                           {'Content-Type': 'application/octet-stream'})
+        client.json('POST', '/upload_complete', {'upload_ids': [started['upload_id']]})
+        return size
+
+    return {
+        'list_wide': get('/api/list?' + urlencode({'path': f"{tree}/wide"})),
+        'list_wide_all': list_wide_all,
+        'list_deep': list_deep,
+        'page_wide': get('/?' + urlencode({'path': f"{tree}/wide"})),
+        'search': search,
+        'download': get('/download?' + urlencode({'path': f"{tree}/large/large.bin"})),
+        'download_range': download_range,
+        'upload': upload,
+        'upload_chunked': upload_chunked,
+        'zip': get('/download_folder?' + urlencode({'path': f"{tree}/zip"}))
+    }
+
+def run_fanout(base_url, args):
+    """Time how long a folder change takes to reach N subscribed Socket.IO clients"""
+    if socketio is None:
+        return {'skipped': 'python-socketio client is not installed (pip install "python-socketio[client]")'}
+
+    folder = f"{TREE_ROOT}/fanout"
+    received = {}
+    lock = threading.Lock()
+    clients = []
+
+    def attach(index, sio):
+        @sio.on('dir_delta')
+        def on_delta(data):
+            now = time.perf_counter()
+            if data.get('path') != folder:
+                return
+            with lock:
+                for item in data.get('added') or []:
+                    received.setdefault(item['name'], {}).setdefault(index, now)
+
+    try:
+        for index in range(args.clients):
+            sio = socketio.Client(reconnection=False)
+            attach(index, sio)
+            sio.connect(base_url, wait_timeout=10)
+            sio.call('subscribe', {'path': folder}, timeout=10)
+            clients.append(sio)
+
+        admin = Client(base_url)
+        admin.login(args.password)
+        deliveries, all_clients, first_client, errors = [], [], [], []
+        created = []
+        started = time.perf_counter()
+        for i in range(args.fanout_events):
+            name = f"event_{os.getpid()}_{i}"
+            sent = time.perf_counter()
+            try:
+                admin.json('POST', '/create_folder', {'path': folder, 'name': name})
+            except BenchError as e:
+                errors.append(str(e))
+                continue
+            created.append(name)
+            deadline = time.time() + FANOUT_TIMEOUT
+            while time.time() < deadline:
+                with lock:
+                    arrived = dict(received.get(name, {}))
+                if len(arrived) == len(clients):
+                    break
+                time.sleep(0.005)
+            if len(arrived) < len(clients):
+                errors.append(f"{name} reached {len(arrived)} of {len(clients)} clients")
+            times = sorted(t - sent for t in arrived.values())
+            deliveries.extend(times)
+            if times:
+                first_client.append(times[0])
+            if len(times) == len(clients):
+                all_clients.append(times[-1])
+        duration = time.perf_counter() - started
+
+        for name in created:
+            admin.json('POST', '/delete', {'path': f"{folder}/{name}"}, expect=(200, 404))
+    finally:
+        for sio in clients:
+            sio.disconnect()
+
+    result = summarize(deliveries, errors, duration, 0, len(clients))
+    result.update(
+        clients=len(clients),
+        events=args.fanout_events,
+        transport=clients[0].transport() if clients else None,
+        first_client_ms=summarize(first_client, [], duration, 0, 1)['latency_ms'],
+        all_clients_ms=summarize(all_clients, [], duration, 0, 1)['latency_ms'],
+        note='Includes the server-side delta debounce (DELTA_DEBOUNCE)'
+    )
+    return result
+
+# Reporting
+
+def git_revision():
+    """Current commit of the checkout being measured, if it is a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_result(name, result):
+    if 'skipped' in result:
+        print(f"  {name:<16} skipped: {result['skipped']}")
+        return
+    latency = result['latency_ms']
+    line = (f"  {name:<16} n={result['requests']:<5} err={result['errors']:<3} "
+            f"p50={latency['p50']}ms p90={latency['p90']}ms p99={latency['p99']}ms "
+            f"{result['throughput_rps']} req/s")
+    if result['bytes']:
+        line += f" {result['throughput_mb_s']} MB/s"
+    print(line)
+
+def compare_results(before_path, after_path):
+    """Print p50/p99 latency and throughput changes between two result files"""
+    with open(before_path, 'r') as f:
+        before = json.load(f)['results']
+    with open(after_path, 'r') as f:
+        after = json.load(f)['results']
+
+    def change(old, new):
+        if not old or new is None:
+            return '-'
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"{'scenario':<16} {'p50 ms':>24} {'p99 ms':>24} {'req/s':>24}")
+    for name in after:
+        old, new = before.get(name), after[name]
+        if not old or 'latency_ms' not in old or 'latency_ms' not in new:
+            continue
+        cells = []
+        for key in ('p50', 'p99'):
+            a, b = old['latency_ms'][key], new['latency_ms'][key]
+            cells.append(f"{a}->{b} {change(a, b)}")
+        a, b = old['throughput_rps'], new['throughput_rps']
+        cells.append(f"{a}->{b} {change(a, b)}")
+        print(f"{name:<16} " + ' '.join(f"{c:>24}" for c in cells))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark PFshare listing, search, transfers, zip and socket fanout')
+    parser.add_argument('--url', help='Benchmark a running server instead of starting one')
+    parser.add_argument('--files', help='Files directory of the running server to generate the tree in (with --url)')
+    parser.add_argument('--workdir', help='Directory for the started server and its tree (kept afterwards)')
+    parser.add_argument('--password', default='admin123', help='Admin password, used for the fanout scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent HTTP clients')
+    parser.add_argument('--transfer-requests', type=int, default=20, help='Requests for download, upload and zip')
+    parser.add_argument('--clients', type=int, default=50, help='Socket.IO clients for the fanout scenario')
+    parser.add_argument('--fanout-events', type=int, default=20, help='Folder changes to time in the fanout scenario')
+    parser.add_argument('--wide-files', type=int, default=10000)
+    parser.add_argument('--deep-depth', type=int, default=30)
+    parser.add_argument('--deep-files', type=int, default=10)
+    parser.add_argument('--large-size', type=int, default=256 * 1024 * 1024, help='Bytes in the large download file')
+    parser.add_argument('--range-size', type=int, default=1024 * 1024, help='Bytes per ranged download')
+    parser.add_argument('--upload-size', type=int, default=8 * 1024 * 1024, help='Bytes per uploaded file')
+    parser.add_argument('--zip-files', type=int, default=200)
+    parser.add_argument('--zip-file-size', type=int, default=256 * 1024)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Result file (default: benchmark-<timestamp>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two result files and exit')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    selected = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    tree_params = {
+        'seed': args.seed,
+        'wide_files': args.wide_files,
+        'deep_depth': args.deep_depth,
+        'deep_files': args.deep_files,
+        'large_size': args.large_size,
+        'zip_files': args.zip_files,
+        'zip_file_size': args.zip_file_size
+    }
+
+    process = None
+    workdir = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        if args.files:
+            print(f"Generating tree in {os.path.join(args.files, TREE_ROOT)}...")
+            generate_tree(args.files, tree_params)
+    else:
+        workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='pfshare-bench-')
+        os.makedirs(workdir, exist_ok=True)
+        print(f"Generating tree in {os.path.join(workdir, 'files', TREE_ROOT)}...")
+        generate_tree(os.path.join(workdir, 'files'), tree_params)
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        process = start_server(workdir, port)
+
+    try:
+        print(f"Waiting for {base_url}...")
+        wait_until_ready(base_url, process)
+
+        rng = random.Random(args.seed)
+        operations = http_scenarios(args, rng)
+        transfers = {'download', 'upload', 'upload_chunked', 'zip'}
+        results = {}
+        print("Results:")
+        for name in selected:
+            if name == 'fanout':
+                results[name] = run_fanout(base_url, args)
+            else:
+                requests = args.transfer_requests if name in transfers else args.requests
+                results[name] = run_load(base_url, operations[name], requests, args.concurrency)
+            print_result(name, results[name])
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if workdir and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'url': args.url,
+            'tree': tree_params,
+            'requests': args.requests,
+            'transfer_requests': args.transfer_requests,
+            'concurrency': args.concurrency,
+            'range_size': args.range_size,
+            'upload_size': args.upload_size
+        },
+        'results': results
+    }
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+if __name__ == '__main__':
+    main()
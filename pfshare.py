@@ -5,136 +5,4320 @@ Features: File browsing, uploading, downloading, admin/viewer modes, real-time u
 """
 
 import os
+import re
+import posixpath
 import json
+import base64
+import time
+import sqlite3
+import hashlib
 import shutil
 import zipfile
+import tarfile
+import zlib
+import gzip
+import bz2
+import lzma
 import mimetypes
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 import secrets
+import atexit
+import queue
+import stat
+import errno
+import struct
+import ctypes
+import ctypes.util
+import bisect
+import heapq
+import mmap
+import codecs
+import random
+import logging
+import cProfile
+import pstats
+from urllib.parse import quote
 
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash
+from flask import Flask, Response, render_template, request, jsonify, send_file, session, redirect, url_for, flash, stream_with_context
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import Manager, PubSubManager, RedisManager, KombuManager, ZmqManager, KafkaManager
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.wsgi import wrap_file
 from werkzeug.security import check_password_hash, generate_password_hash
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None  # Thumbnails are disabled without Pillow
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: single process only
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Static files and responses are only gzipped
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None  # Checksums are SHA-256 and MD5 only
+
 app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_hex(16)
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
 app.config['JSON_AS_ASCII'] = False  # Enable proper Unicode handling in JSON responses
 
-# Configuration
-ADMIN_PASSWORD = "admin123"  # Change this in production
-BASE_DIR = os.path.abspath("./files")  # Directory to serve files from
-ALLOWED_EXTENSIONS = set()  # Empty set means all extensions allowed
-CONFIG_FILE = "config.json"  # Configuration file for persistent data
+# Configuration
+ADMIN_PASSWORD = "admin123"  # Change this in production
+BASE_DIR = os.path.abspath("./files")  # Directory to serve files from
+ALLOWED_EXTENSIONS = set()  # Empty set means all extensions allowed
+CONFIG_FILE = "config.json"  # Configuration file for persistent data
+DATA_DIR = os.path.abspath("./.pfshare")  # Server state; keep it on the same filesystem as BASE_DIR
+UPLOAD_TMP_DIR = os.path.join(DATA_DIR, "uploads")  # Partial files of chunked uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size handed to clients for resumable uploads
+UPLOAD_EXPIRY = 24 * 3600  # Seconds before an abandoned chunked upload is removed
+CHUNKED_UPLOAD_MAX_SIZE = None  # Largest file a chunked upload may declare, in bytes (None for no limit)
+SEARCH_DB = os.path.join(DATA_DIR, "search.db")  # Tree-wide file name index
+SEARCH_PAGE_SIZE = 100  # Search results per page
+LIST_PAGE_SIZE = 200  # Folder entries per /api/list page
+LISTING_CACHE_SIZE = 256  # Sorted folder listings kept in memory
+LISTING_CACHE_MAX_ITEMS = 500000  # Entries kept across all cached listings
+ASSET_DIR = os.path.join(DATA_DIR, "assets")  # Precompressed copies of the files in static/
+COMPRESS_MIMETYPES = ('text/html', 'application/json')  # Responses compressed on the fly
+COMPRESS_MIN_SIZE = 1024  # Smaller responses are sent as they are
+COMPRESS_LEVEL = 6  # gzip level for responses; static files get the best compression once
+THUMBNAIL_DIR = os.path.join(DATA_DIR, "thumbnails")  # On-disk thumbnail cache
+THUMBNAIL_SIZES = (96, 256)  # Allowed thumbnail edge lengths in pixels; the first is the default
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Oldest thumbnails are evicted beyond this
+THUMBNAIL_WORKERS = min(os.cpu_count() or 1, 4)  # Processes rendering thumbnails
+DELTA_DEBOUNCE = 0.25  # Seconds a folder must be quiet before its changes are broadcast
+DELTA_MAX_DELAY = 1.0  # Longest a change waits while a folder keeps changing
+# Multi-worker mode: None runs a single process. 'sqlite' connects worker processes through
+# a queue in DATA_DIR (no broker needed); a redis://, amqp://, kafka:// or zmq+tcp:// URL
+# uses that broker instead. Can also be set with the PFSHARE_MESSAGE_QUEUE environment variable.
+MESSAGE_QUEUE = os.environ.get('PFSHARE_MESSAGE_QUEUE') or None
+BUS_DB = os.path.join(DATA_DIR, "bus.db")  # Local message queue for MESSAGE_QUEUE = 'sqlite'
+BUS_POLL_INTERVAL = 0.05  # Seconds between checks for new messages on the local queue
+STATE_DB = os.path.join(DATA_DIR, "state.db")  # Shared text and its recent operations
+TRASH_DIR = os.path.join(DATA_DIR, "trash")  # Deleted items wait here for undo; same filesystem as BASE_DIR
+UNDO_DB = os.path.join(DATA_DIR, "undo.db")  # Undo journal
+UNDO_HISTORY = 50  # Undo steps kept per browser session
+UNDO_MAX_AGE = 7 * 24 * 3600  # Seconds an operation stays undoable
+BULK_MAX_ITEMS = 10000  # Most items one bulk delete, move, copy or download may select
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Bytes copied per kernel call; progress is reported in between
+COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)  # Try the next way of copying
+JOBS_DB = os.path.join(DATA_DIR, "jobs.db")  # Background jobs and their progress
+JOB_DIR = os.path.join(DATA_DIR, "jobs")  # Folder ZIPs built by jobs that do not fit the ZIP cache
+JOB_WORKERS = 2  # Background jobs running at once per worker; the rest wait in line
+JOB_PROGRESS_INTERVAL = 0.5  # Seconds between progress reports of a job
+JOB_KEEP = 3600  # Seconds finished jobs and their results are kept
+TRASH_MAX_BYTES = 10 * 1024 * 1024 * 1024  # Oldest deleted items are purged for good beyond this
+TRASH_PURGE_INTERVAL = 600  # Seconds between background trash purges
+WATCH_FILESYSTEM = True  # Pick up changes made to BASE_DIR outside PFshare (rsync, Samba, cron...)
+WATCH_QUEUE_SIZE = 10000  # Pending filesystem events; on overflow the whole tree is resynced
+WATCH_COALESCE = 0.5  # Seconds of filesystem events gathered and deduplicated per batch
+WATCH_POLL_INTERVAL = 30  # Seconds between scans of folders inotify cannot watch
+THUMBNAIL_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff'}
+DIR_SIZE_LAZY = True  # Show folder sizes as pending and compute them in the background
+DIR_SIZE_WORKERS = 2  # Background threads used to compute folder sizes
+DIR_SIZE_BUS_BATCH = 500  # Folder sizes per bus message when a walk is shared with other workers
+ZIP_STREAMING = True  # Stream folder ZIPs while they are built instead of using a temp file
+ZIP_CHUNK_SIZE = 1024 * 1024  # Bytes read from each file per step when zipping; also the unit deflated in parallel
+ZIP_WORKERS = min(os.cpu_count() or 1, 4)  # Processes deflating folder ZIPs; 0 deflates in the request thread
+ZIP_COMPRESSION_LEVEL = 6  # zlib level for deflated ZIP entries, 1 (fastest) to 9 (smallest)
+ZIP_CACHE_DIR = os.path.join(DATA_DIR, "zip_cache")  # Finished folder ZIPs, keyed by the folder's contents
+ZIP_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024  # Least recently downloaded ZIPs are evicted beyond this; 0 disables the cache
+ZIP_STALL_TIMEOUT = 60  # Seconds without progress before a ZIP build is given up
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Bytes per read when the server cannot send files itself
+MAX_RANGES = 16  # Requests asking for more byte ranges than this get the whole file
+USE_X_SENDFILE = False  # Let a fronting Apache/lighttpd send whole files via X-Sendfile
+SENDFILE_RANGE_SERVERS = ('gunicorn',)  # Servers whose sendfile path stops at Content-Length
+PREVIEW_PAGE_BYTES = 64 * 1024  # Default size of a text preview page
+PREVIEW_MAX_BYTES = 1024 * 1024  # Largest text preview page or follow update
+PREVIEW_MAX_LINES = 10000  # Most lines per line-numbered or tail preview page
+PREVIEW_FOLLOW_INTERVAL = 1.0  # Seconds between checks of followed files for appended data
+LINE_INDEX_STRIDE = 1024 * 1024  # Bytes between the line-offset checkpoints of a previewed file
+LINE_INDEX_CACHE_SIZE = 64  # Previewed files whose line index is kept in memory
+ARCHIVE_INDEX_DIR = os.path.join(DATA_DIR, "archive_index")  # Member lists of browsed archives
+ARCHIVE_INDEX_CACHE_SIZE = 16  # Archive member lists kept in memory
+ARCHIVE_INDEX_MAX_BYTES = 64 * 1024 * 1024  # Least recently browsed archive indexes are evicted beyond this
+DEDUP_ENABLED = False  # Replace uploads (and, in the background, existing files) that duplicate a file in BASE_DIR by links
+DEDUP_LINK = 'auto'  # 'reflink' (copy-on-write clones only), 'hardlink', or 'auto' for a reflink where supported, else a hard link
+DEDUP_MIN_SIZE = 1024 * 1024  # Smaller files are not deduplicated
+DEDUP_SCAN_INTERVAL = 24 * 3600  # Seconds between background deduplication scans of BASE_DIR
+DEDUP_DB = os.path.join(DATA_DIR, "dedup.db")  # Content hashes of the files in BASE_DIR
+CHECKSUM_DB = os.path.join(DATA_DIR, "checksums.db")  # Cached file digests, keyed by inode, size and mtime
+CHECKSUM_ALGORITHMS = ('sha256', 'md5', 'xxh128')  # Digests kept per file; sha256 always is, xxh128 needs `pip install xxhash`
+CHECKSUM_LISTED = 'sha256'  # Digest shown in folder listings
+CHECKSUM_WORKERS = min(os.cpu_count() or 1, 4)  # Threads hashing files in parallel
+CHECKSUM_SCAN = True  # Hash every file in BASE_DIR in the background, so digests are ready when asked for
+CHECKSUM_SCAN_INTERVAL = 6 * 3600  # Seconds between background checksum scans
+LOG_LEVEL = os.environ.get('PFSHARE_LOG_LEVEL', 'INFO')  # DEBUG also logs every request
+LOG_FORMAT = os.environ.get('PFSHARE_LOG_FORMAT', 'text')  # 'json' writes one JSON object per line
+METRICS_DIR = os.path.join(DATA_DIR, "metrics")  # Per-worker metric snapshots in multi-worker mode
+METRICS_SNAPSHOT_INTERVAL = 5  # Seconds between a worker's metric snapshots
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")  # cProfile dumps of profiled requests
+PROFILE_KEEP = 100  # Newest profiles kept in PROFILE_DIR
+
+# Already-compressed formats are stored in ZIPs as-is instead of being deflated again
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp4', '.mkv', '.mov', '.avi', '.wmv', '.flv', '.webm', '.m4v',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.opus',
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.zst',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.jar', '.apk',
+}
+
+# Create base directory if it doesn't exist
+os.makedirs(BASE_DIR, exist_ok=True)
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+os.makedirs(TRASH_DIR, exist_ok=True)
+os.makedirs(JOB_DIR, exist_ok=True)
+os.makedirs(METRICS_DIR, exist_ok=True)
+os.makedirs(PROFILE_DIR, exist_ok=True)
+
+def load_secret_key():
+    """Session signing key, kept in DATA_DIR so sessions (and their undo history) survive restarts"""
+    key_path = os.path.join(DATA_DIR, "secret_key")
+    try:
+        with open(key_path, 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        key = secrets.token_hex(32)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+        return key
+
+app.config['SECRET_KEY'] = load_secret_key()
+
+# Logging: everything goes through the 'pfshare' logger. Context is passed as fields
+# (extra={...}) and written as key=value pairs, or as JSON lines with LOG_FORMAT = 'json'.
+LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class StructuredFormatter(logging.Formatter):
+    """Log lines carrying the record's extra fields"""
+    
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+    
+    def format(self, record):
+        fields = {k: v for k, v in vars(record).items() if k not in LOG_RECORD_ATTRS}
+        message = record.getMessage()
+        if self.as_json:
+            entry = {
+                'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                'level': record.levelname,
+                'message': message,
+                **fields
+            }
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        
+        line = f"{self.formatTime(record)} {record.levelname} {message}"
+        for key, value in fields.items():
+            if isinstance(value, (list, tuple, dict)) or (isinstance(value, str) and (not value or ' ' in value)):
+                value = json.dumps(value, ensure_ascii=False, default=str)
+            line += f" {key}={value}"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+log = logging.getLogger('pfshare')
+if not log.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == 'json'))
+    log.addHandler(log_handler)
+    log.setLevel(LOG_LEVEL.upper())
+    log.propagate = False
+
+# Metrics: counters, gauges and histograms kept per process and served on /metrics in
+# the Prometheus text format. In multi-worker mode every worker writes snapshots to
+# METRICS_DIR and whichever worker is scraped adds up those of the live workers.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(13))  # 1KB .. 16GB
+metrics = {}  # Name -> Metric, in the order they are exposed
+metrics_lock = threading.Lock()
+
+class Metric:
+    """A Prometheus counter, gauge or histogram with a fixed list of label names"""
+    
+    def __init__(self, name, kind, help_text, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets if kind == 'histogram' else None
+        self.values = {}  # Label values -> number, or per-bucket counts + [sum, count]
+        metrics[name] = self
+    
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with metrics_lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value, **labels):
+        with metrics_lock:
+            self.values[self.key(labels)] = value
+    
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with metrics_lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+http_requests_total = Metric('pfshare_http_requests_total', 'counter', 'HTTP requests handled', ('route', 'method', 'status'))
+http_request_seconds = Metric('pfshare_http_request_duration_seconds', 'histogram',
+                              'Time from receiving a request until its response body was sent', ('route', 'method'))
+received_bytes_total = Metric('pfshare_received_bytes_total', 'counter', 'Request body bytes read, e.g. uploads', ('route',))
+sent_bytes_total = Metric('pfshare_sent_bytes_total', 'counter', 'Response body bytes sent, e.g. downloads', ('route',))
+zip_build_seconds = Metric('pfshare_zip_build_seconds', 'histogram', 'Time to build and send a folder ZIP')
+zip_size_bytes = Metric('pfshare_zip_size_bytes', 'histogram', 'Size of finished folder ZIPs', buckets=SIZE_BUCKETS)
+dir_walk_seconds = Metric('pfshare_dir_walk_seconds', 'histogram', 'Time spent walking a tree to compute folder sizes')
+socket_clients = Metric('pfshare_socket_clients', 'gauge', 'Connected Socket.IO clients per room', ('room',))
+socket_emits_total = Metric('pfshare_socket_emits_total', 'counter', 'Socket.IO events emitted', ('event',))
+
+def metrics_snapshot():
+    """This process's metric values as JSON-friendly data"""
+    update_socket_gauges()
+    with metrics_lock:
+        return {
+            metric.name: [[list(key), list(value) if isinstance(value, list) else value]
+                          for key, value in metric.values.items()]
+            for metric in metrics.values()
+        }
+
+def metrics_snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+def write_metrics_snapshot():
+    """Publish this worker's metrics for the other workers' /metrics"""
+    path = metrics_snapshot_path(os.getpid())
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(metrics_snapshot(), f)
+    os.replace(tmp, path)
+
+def metrics_snapshot_loop():
+    """Refresh this worker's snapshot so gauges stay current between scrapes"""
+    while True:
+        try:
+            write_metrics_snapshot()
+        except OSError as e:
+            log.warning("Failed to write metrics snapshot", extra={'error': str(e)})
+        time.sleep(METRICS_SNAPSHOT_INTERVAL)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def collect_metrics():
+    """Snapshots of this process and, in multi-worker mode, every other live worker"""
+    if not MESSAGE_QUEUE:
+        return [metrics_snapshot()]
+    
+    write_metrics_snapshot()
+    snapshots = []
+    for entry in os.scandir(METRICS_DIR):
+        name, ext = os.path.splitext(entry.name)
+        if ext != '.json' or not name.isdigit():
+            continue
+        if not process_alive(int(name)):
+            # Its counters go with it; Prometheus treats that as a counter reset
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(entry.path, 'r') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def format_metric_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def render_metrics(snapshots):
+    """Add up snapshots and write them in the Prometheus text exposition format"""
+    lines = []
+    for metric in metrics.values():
+        merged = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.get(metric.name, []):
+                key = tuple(key)
+                if isinstance(value, list):
+                    current = merged.setdefault(key, [0] * len(value))
+                    merged[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(merged.items()):
+            if metric.kind != 'histogram':
+                lines.append(f"{metric.name}{format_metric_labels(metric.labels, key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append(f"{metric.name}_bucket{format_metric_labels(metric.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric.name}_bucket{format_metric_labels(metric.labels, key, [('le', '+Inf')])} {value[-1]}")
+            lines.append(f"{metric.name}_sum{format_metric_labels(metric.labels, key)} {value[-2]}")
+            lines.append(f"{metric.name}_count{format_metric_labels(metric.labels, key)} {value[-1]}")
+    return '\n'.join(lines) + '\n'
+
+def update_socket_gauges():
+    """Count this process's Socket.IO clients per room"""
+    try:
+        rooms = socketio.server.manager.rooms.get('/', {})
+        connected = rooms.get(None, {})
+        counts = {room: len(sids) for room, sids in list(rooms.items())
+                  if room is not None and room not in connected}
+        counts['all'] = len(connected)
+    except (NameError, AttributeError, RuntimeError):
+        return  # Not started yet, or the rooms changed while being read
+    with metrics_lock:
+        socket_clients.values = {(room,): count for room, count in counts.items()}
+
+# Profiling: while switched on through POST /profiling, matching requests run
+# under cProfile and every hook in PROFILE_HOOKS is called with the finished profile.
+# Only one request is profiled at a time since Python allows one active profiler.
+profiling = {'enabled': False, 'routes': [], 'sample': 1.0}
+profile_lock = threading.Lock()
+
+def set_profiling(settings, publish=True):
+    """Switch request profiling on or off in this and every other worker"""
+    if publish:
+        bus_publish('profiling', settings)
+    profiling.update(
+        enabled=bool(settings.get('enabled')),
+        routes=[settings['routes']] if isinstance(settings.get('routes'), str) else [str(r) for r in settings.get('routes') or []],
+        sample=min(max(float(settings.get('sample', 1.0)), 0.0), 1.0)
+    )
+    log.info("Request profiling changed", extra=dict(profiling))
+
+def start_profile(environ, route):
+    """Start profiling the current request if profiling applies to it"""
+    if profiling['routes'] and route not in profiling['routes']:
+        return
+    if random.random() >= profiling['sample'] or not profile_lock.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except (ValueError, RuntimeError):
+        profile_lock.release()  # Another profiling tool is active
+        return
+    environ['pfshare.profiler'] = profiler
+
+def finish_profile(environ, route, duration):
+    """Stop the request's profiler and hand the result to the profile hooks"""
+    profiler = environ.pop('pfshare.profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    profile_lock.release()
+    for hook in PROFILE_HOOKS:
+        try:
+            hook(route, environ['REQUEST_METHOD'], duration, profiler)
+        except Exception:
+            log.exception("Profile hook failed", extra={'route': route})
+
+def save_profile(route, method, duration, profiler):
+    """Profile hook: dump the stats to PROFILE_DIR and log the costliest calls"""
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', route or 'unmatched').strip('_') or 'index'
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{method}-{slug}.prof"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    
+    stats = pstats.Stats(profiler).sort_stats('cumulative')
+    top = [
+        f"{pstats.func_std_string(func)} {stats.stats[func][3]:.3f}s"
+        for func in stats.fcn_list[:5]
+    ]
+    log.info("Profiled request", extra={'route': route, 'method': method,
+                                        'duration': round(duration, 4), 'profile': name, 'top': top})
+    
+    profiles = sorted(e.path for e in os.scandir(PROFILE_DIR) if e.name.endswith('.prof'))
+    for path in profiles[:-PROFILE_KEEP]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+PROFILE_HOOKS = [save_profile]  # Callables taking (route, method, duration, profiler)
+
+class MetricsInput:
+    """Request body stream that counts the bytes read from it"""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.received = 0
+    
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.received += len(data)
+        return data
+    
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.received += len(data)
+        return data
+    
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.received += sum(len(line) for line in lines)
+        return lines
+    
+    def readinto(self, buffer):
+        # Werkzeug reads request bodies this way when the stream offers it
+        size = self.stream.readinto(buffer)
+        self.received += size or 0
+        return size
+    
+    def __iter__(self):
+        for line in self.stream:
+            self.received += len(line)
+            yield line
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class MetricsBody:
+    """Response body that counts the bytes sent and records the request once it is closed"""
+    
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+        self.sent = 0
+    
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish(self.sent)
+
+class MetricsMiddleware:
+    """Times every request until its body has been sent and counts bytes in and out"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        body_in = environ['wsgi.input'] = MetricsInput(environ['wsgi.input'])
+        response = {'status': '500', 'length': None}
+        
+        def capture(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['length'] = next((int(v) for k, v in headers if k.lower() == 'content-length'), None)
+            return start_response(status, headers, exc_info)
+        
+        def finish(sent):
+            route = environ.get('pfshare.route') or '<unmatched>'
+            method = environ['REQUEST_METHOD']
+            duration = time.perf_counter() - started
+            finish_profile(environ, route, duration)
+            http_requests_total.inc(route=route, method=method, status=response['status'])
+            http_request_seconds.observe(duration, route=route, method=method)
+            if body_in.received:
+                received_bytes_total.inc(body_in.received, route=route)
+            if sent:
+                sent_bytes_total.inc(sent, route=route)
+            log.debug("Request", extra={'method': method, 'route': route, 'path': environ.get('PATH_INFO'),
+                                        'status': response['status'], 'duration': round(duration, 4),
+                                        'received': body_in.received, 'sent': sent})
+        
+        try:
+            body = self.wsgi_app(environ, capture)
+        except Exception:
+            finish(0)
+            raise
+        
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # The server sends this itself (e.g. with sendfile), so it has to stay unwrapped
+            finish(response['length'] or 0)
+            return body
+        return MetricsBody(body, finish)
+
+# Bandwidth shaping: request and response bodies pass through token buckets, one per
+# direction for the whole server and one per direction and client address. Transfers
+# waiting on a bucket are served in start-time fair order, so concurrent downloads (and
+# uploads) get equal shares, and a transfer that cannot use its share leaves it to the
+# others. The first interactive_bytes of every body are counted but never held back, which
+# keeps listings, previews and thumbnails quick next to bulk transfers. Limits are bytes
+# per second (0 for none) in the "bandwidth" section of config.json; each worker applies
+# them on its own.
+BANDWIDTH_DEFAULTS = {
+    'download_limit': 0,  # All downloads together
+    'upload_limit': 0,  # All uploads together
+    'client_download_limit': 0,  # Downloads of one client address
+    'client_upload_limit': 0,  # Uploads of one client address
+    'interactive_bytes': 256 * 1024,  # Bytes at the start of each body that are never held back
+}
+BANDWIDTH_BURST = 0.25  # Seconds of its limit a bucket can save up while idle
+BANDWIDTH_QUANTUM = 64 * 1024  # Largest piece of a body let through at once
+BANDWIDTH_CLIENT_IDLE = 60  # Seconds before the buckets of an idle client are dropped
+bandwidth = dict(BANDWIDTH_DEFAULTS)
+bandwidth_wait_seconds = Metric('pfshare_bandwidth_wait_seconds_total', 'counter',
+                                'Time transfers were held back by bandwidth limits', ('direction',))
+
+class FairBucket:
+    """Token bucket shared by transfers, which take their turns in start-time fair order"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate * BANDWIDTH_BURST
+        self.updated = time.monotonic()
+        self.virtual = 0.0  # Start tag of the latest grant
+        self.waiting = []  # Heap of (start tag, ticket) of waiting transfers
+        self.tickets = 0
+        self.cond = threading.Condition()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * BANDWIDTH_BURST)
+        self.updated = now
+    
+    def set_rate(self, rate):
+        with self.cond:
+            self.refill()
+            self.rate = rate
+            self.cond.notify_all()
+    
+    def take(self, tags, size, wait=True):
+        """Take size bytes for the transfer whose finish tags are in tags; False unless it waited"""
+        with self.cond:
+            if not self.rate:
+                return False
+            self.refill()
+            if not wait:
+                self.tokens -= size
+                return False
+            
+            # Tokens may go negative; the debt delays whoever comes next
+            entry = (max(self.virtual, tags.get(self, 0.0)), self.tickets)
+            self.tickets += 1
+            heapq.heappush(self.waiting, entry)
+            waited = False
+            try:
+                while self.rate and not (self.waiting[0] == entry and self.tokens >= 0):
+                    waited = True
+                    self.cond.wait(-self.tokens / self.rate if self.waiting[0] == entry else 1.0)
+                    self.refill()
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.tokens -= size
+                self.virtual = entry[0]
+                tags[self] = entry[0] + size
+                self.cond.notify_all()
+            return waited
+
+download_bucket = FairBucket(0)
+upload_bucket = FairBucket(0)
+client_buckets = {}  # (direction, client address) -> FairBucket
+client_buckets_lock = threading.Lock()
+
+def get_client_bucket(direction, client):
+    """The bucket of one client's transfers in one direction, or None without a per-client limit"""
+    rate = bandwidth[f'client_{direction}_limit']
+    if not rate:
+        return None
+    with client_buckets_lock:
+        bucket = client_buckets.get((direction, client))
+        if bucket is None:
+            now = time.monotonic()
+            for key, idle in list(client_buckets.items()):
+                if now - idle.updated > BANDWIDTH_CLIENT_IDLE and not idle.waiting:
+                    del client_buckets[key]
+            bucket = client_buckets[(direction, client)] = FairBucket(rate)
+        return bucket
+
+def set_bandwidth(settings, publish=True):
+    """Change the bandwidth limits in this and every other worker"""
+    values = {key: max(int(settings.get(key, default)), 0) for key, default in BANDWIDTH_DEFAULTS.items()}
+    if publish:
+        bus_publish('bandwidth', values)
+    bandwidth.update(values)
+    config['bandwidth'] = dict(values)  # Kept current for whichever worker saves config.json next
+    download_bucket.set_rate(values['download_limit'])
+    upload_bucket.set_rate(values['upload_limit'])
+    with client_buckets_lock:
+        for (direction, _), bucket in client_buckets.items():
+            bucket.set_rate(values[f'client_{direction}_limit'])
+    log.info("Bandwidth limits changed", extra=values)
+
+def shaping_downloads():
+    """Whether response bodies are subject to a limit, so they must go through Python"""
+    return bool(bandwidth['download_limit'] or bandwidth['client_download_limit'])
+
+class Transfer:
+    """One request or response body going through the bandwidth limits"""
+    
+    def __init__(self, direction, client):
+        self.direction = direction
+        self.buckets = [b for b in (get_client_bucket(direction, client),
+                                    download_bucket if direction == 'download' else upload_bucket) if b]
+        self.tags = {}  # Bucket -> finish tag of this transfer's last grant
+        self.free = bandwidth['interactive_bytes']
+    
+    def pass_bytes(self, size):
+        """Wait until size more bytes may go through"""
+        wait = self.free <= 0
+        self.free -= size
+        started = time.perf_counter()
+        waited = False
+        for bucket in self.buckets:
+            waited = bucket.take(self.tags, size, wait) or waited
+        if waited:
+            bandwidth_wait_seconds.inc(time.perf_counter() - started, direction=self.direction)
+
+class ShapedInput:
+    """Request body stream read no faster than the upload limits allow"""
+    
+    def __init__(self, stream, transfer):
+        self.stream = stream
+        self.transfer = transfer
+    
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.transfer.pass_bytes(len(data))
+        return data
+    
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.transfer.pass_bytes(len(data))
+        return data
+    
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.transfer.pass_bytes(sum(len(line) for line in lines))
+        return lines
+    
+    def readinto(self, buffer):
+        size = self.stream.readinto(buffer)
+        self.transfer.pass_bytes(size or 0)
+        return size
+    
+    def __iter__(self):
+        for line in self.stream:
+            self.transfer.pass_bytes(len(line))
+            yield line
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class ShapedBody:
+    """Response body sent in pieces of at most BANDWIDTH_QUANTUM as the download limits allow"""
+    
+    def __init__(self, body, transfer):
+        self.body = body
+        self.transfer = transfer
+    
+    def __iter__(self):
+        for chunk in self.body:
+            for start in range(0, len(chunk), BANDWIDTH_QUANTUM):
+                piece = chunk[start:start + BANDWIDTH_QUANTUM]
+                self.transfer.pass_bytes(len(piece))
+                yield piece
+    
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+class ShapingMiddleware:
+    """Passes request and response bodies through the bandwidth limits while any are set"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        client = environ.get('REMOTE_ADDR') or ''
+        if bandwidth['upload_limit'] or bandwidth['client_upload_limit']:
+            environ['wsgi.input'] = ShapedInput(environ['wsgi.input'], Transfer('upload', client))
+        body = self.wsgi_app(environ, start_response)
+        if shaping_downloads():
+            # Server-side sendfile would bypass the limits, so file wrappers are iterated as well
+            return ShapedBody(body, Transfer('download', client))
+        return body
+
+app.wsgi_app = MetricsMiddleware(ShapingMiddleware(app.wsgi_app))  # Wrapped before SocketIO, so Socket.IO traffic bypasses them
+
+@app.before_request
+def tag_request_route():
+    """Remember the matched route for metrics and start profiling the request if enabled"""
+    route = request.url_rule.rule if request.url_rule else None
+    request.environ['pfshare.route'] = route
+    if profiling['enabled']:
+        start_profile(request.environ, route)
+
+# Worker processes share Socket.IO rooms and events through a message queue, and use the
+# same queue to keep their in-memory caches in step: bus_publish() sends a message that
+# BUS_HANDLERS applies in every other worker.
+BUS_HANDLERS = {}
+
+class StateBusMixin:
+    """Adds PFshare's own messages to a Socket.IO pub/sub client manager"""
+    listening = False
+    
+    def initialize(self):
+        """Start listening to the queue; only the first call does anything
+
+        Socket.IO calls this on its first client connection, but the caches need bus messages
+        from the start, so start_services calls it as well.
+        """
+        if not self.listening:
+            self.listening = True
+            super().initialize()
+    
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if not isinstance(data, dict):
+                try:
+                    data = self.json.loads(message)
+                except Exception:
+                    yield message
+                    continue
+            if isinstance(data, dict) and data.get('method') == 'pfshare':
+                if data.get('host_id') != self.host_id and data.get('kind') in BUS_HANDLERS:
+                    try:
+                        BUS_HANDLERS[data['kind']](*data.get('args', []))
+                    except Exception:
+                        log.exception("Failed to apply bus message", extra={'kind': data['kind']})
+                continue
+            yield message
+
+class SQLiteManager(PubSubManager):
+    """Socket.IO message queue in a local SQLite database, for workers on one machine"""
+    name = 'sqlite'
+    
+    def __init__(self, path=BUS_DB, channel='flask-socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.last_cleanup = 0
+    
+    def _publish(self, data):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT INTO messages (channel, payload, created) VALUES (?, ?, ?)',
+                            (self.channel, self.json.dumps(data), now))
+            if now - self.last_cleanup > 10:
+                # Every listener is well past messages this old
+                self.db.execute('DELETE FROM messages WHERE created < ?', (now - 60,))
+                self.last_cleanup = now
+            self.db.commit()
+    
+    def _listen(self):
+        with self.lock:
+            last_id = self.db.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT id, payload FROM messages WHERE id > ? AND channel = ? ORDER BY id',
+                                       (last_id, self.channel)).fetchall()
+            for message_id, payload in rows:
+                last_id = message_id
+                yield payload
+            if not rows:
+                time.sleep(BUS_POLL_INTERVAL)
+
+class EmitCountingMixin:
+    """Counts the events emitted through a Socket.IO client manager"""
+    def emit(self, event, *args, **kwargs):
+        socket_emits_total.inc(event=event)
+        return super().emit(event, *args, **kwargs)
+
+def create_client_manager(url):
+    """Socket.IO client manager for a MESSAGE_QUEUE setting; None keeps everything in this process"""
+    if not url:
+        return type("PFshareManager", (EmitCountingMixin, Manager), {})()
+    if url == 'sqlite':
+        base = SQLiteManager
+        args = ()
+    else:
+        if url.startswith(('redis://', 'rediss://')):
+            base = RedisManager
+        elif url.startswith('kafka://'):
+            base = KafkaManager
+        elif url.startswith('zmq'):
+            base = ZmqManager
+        else:
+            base = KombuManager
+        args = (url,)
+    # Events relayed from other workers skip emit(), so each one is counted once by its sender
+    manager_class = type(f"PFshare{base.__name__}", (EmitCountingMixin, StateBusMixin, base), {})
+    return manager_class(*args, channel='flask-socketio')
+
+def bus_publish(kind, *args):
+    """Send a state change to the other workers; does nothing in a single process"""
+    manager = socketio.server.manager
+    if isinstance(manager, PubSubManager):
+        manager._publish({'method': 'pfshare', 'host_id': manager.host_id, 'kind': kind, 'args': list(args)})
+
+# Initialize SocketIO
+socketio = SocketIO(app, cors_allowed_origins="*", client_manager=create_client_manager(MESSAGE_QUEUE))
+
+def load_config():
+    """Load configuration from file"""
+    default_config = {
+        "shared_text": "Welcome",
+        "bandwidth": dict(BANDWIDTH_DEFAULTS)
+    }
+    
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8-sig') as f:
+                loaded_config = json.load(f)
+                log.info("Loaded config", extra={'path': CONFIG_FILE})
+                return loaded_config
+        except (json.JSONDecodeError, IOError) as e:
+            log.error("Error loading config", extra={'path': CONFIG_FILE, 'error': str(e)})
+            pass
+    else:
+        log.info("Config file not found, using defaults", extra={'path': CONFIG_FILE})
+    
+    return default_config
+
+def save_config(config):
+    """Save configuration to file, replacing it atomically so a crash never leaves half a file"""
+    temp_path = f"{CONFIG_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8-sig') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, CONFIG_FILE)
+    except (IOError, OSError) as e:
+        log.warning("Failed to save config", extra={'path': CONFIG_FILE, 'error': str(e)})
+        return False
+    return True
+
+# Load initial configuration
+config = load_config()
+shared_text_content = {"content": config.get("shared_text", ""), "version": 0}
+
+# Ensure config file exists with current data
+if not os.path.exists(CONFIG_FILE):
+    log.info("Creating initial config file", extra={'path': CONFIG_FILE})
+    save_config(config)
+
+# Bandwidth limits; config files from before they existed get the section with its defaults
+if 'bandwidth' not in config:
+    config['bandwidth'] = dict(BANDWIDTH_DEFAULTS)
+    save_config(config)
+try:
+    set_bandwidth(config['bandwidth'], publish=False)
+except (TypeError, ValueError, AttributeError) as e:
+    log.error("Invalid bandwidth settings in config file, using no limits", extra={'path': CONFIG_FILE, 'error': str(e)})
+    set_bandwidth(BANDWIDTH_DEFAULTS, publish=False)
+BUS_HANDLERS['bandwidth'] = lambda settings: set_bandwidth(settings, publish=False)
+
+# Shared text engine: clients send operations against the version they last saw and the
+# server transforms them over anything applied since, so concurrent edits merge instead of
+# overwriting each other. An operation is a list of components over UTF-16 code units (the
+# unit of JavaScript string indices): n > 0 keeps n units, n < 0 deletes -n units and a
+# string inserts it. Operations are stored in STATE_DB as they are applied, which keeps
+# worker processes in step; the full text is written there and to config.json behind the
+# edits, after SHARED_TEXT_SAVE_DELAY seconds without changes (SHARED_TEXT_SAVE_MAX_DELAY at most).
+SHARED_TEXT_HISTORY = 500  # Recent operations kept for clients that are a few versions behind
+SHARED_TEXT_SAVE_DELAY = 2.0
+SHARED_TEXT_SAVE_MAX_DELAY = 10.0
+shared_text_lock = threading.Lock()
+shared_text_save_timer = None
+shared_text_dirty_since = None
+
+# Autocommit mode, so BEGIN IMMEDIATE can serialize updates across processes
+state_db = sqlite3.connect(STATE_DB, check_same_thread=False, timeout=30, isolation_level=None)
+state_db.execute('PRAGMA journal_mode=WAL')
+state_db.executescript('''
+    CREATE TABLE IF NOT EXISTS shared_text (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        content TEXT NOT NULL,
+        version INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS shared_text_ops (version INTEGER PRIMARY KEY, op TEXT NOT NULL);
+''')
+state_db.execute('INSERT OR IGNORE INTO shared_text VALUES (1, ?, 0)', (shared_text_content['content'],))
+shared_text_content.update(zip(('content', 'version'), state_db.execute(
+    'SELECT content, version FROM shared_text WHERE id = 1').fetchone()))
+
+def text_units(text):
+    """Length of a string in UTF-16 code units"""
+    return len(text.encode('utf-16-le', 'surrogatepass')) // 2
+
+def text_op_push(op, component):
+    """Append a component to an operation, merging it with a previous one of the same kind"""
+    if component == 0 or component == '':
+        return
+    if op and type(op[-1]) is type(component) and (isinstance(component, str) or (op[-1] > 0) == (component > 0)):
+        op[-1] += component
+    else:
+        op.append(component)
+
+def apply_text_op(text, op):
+    """Apply an operation to text; raises ValueError if it does not fit"""
+    units = text.encode('utf-16-le', 'surrogatepass')
+    parts = []
+    pos = 0
+    for component in op:
+        if isinstance(component, str):
+            parts.append(component.encode('utf-16-le', 'surrogatepass'))
+        elif not isinstance(component, int) or isinstance(component, bool) or component == 0:
+            raise ValueError('Invalid operation component')
+        elif component > 0:
+            if pos + 2 * component > len(units):
+                raise ValueError('Operation is longer than the text')
+            parts.append(units[pos:pos + 2 * component])
+            pos += 2 * component
+        else:
+            pos -= 2 * component
+    if pos != len(units):
+        raise ValueError('Operation does not cover the whole text')
+    try:
+        # Strict decoding rejects operations that split a surrogate pair
+        return b''.join(parts).decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise ValueError('Operation splits a character')
+
+def transform_text_ops(a, b):
+    """Transform two concurrent operations on the same text into (a', b') such that
+    applying a then b' equals applying b then a'. Inserts of a go first at equal positions."""
+    a_prime, b_prime = [], []
+    ops_a, ops_b = list(a), list(b)
+    i = j = 0
+    x = ops_a[0] if ops_a else None
+    y = ops_b[0] if ops_b else None
+    while x is not None or y is not None:
+        if isinstance(x, str):
+            text_op_push(a_prime, x)
+            text_op_push(b_prime, text_units(x))
+            i += 1
+            x = ops_a[i] if i < len(ops_a) else None
+            continue
+        if isinstance(y, str):
+            text_op_push(a_prime, text_units(y))
+            text_op_push(b_prime, y)
+            j += 1
+            y = ops_b[j] if j < len(ops_b) else None
+            continue
+        if x is None or y is None:
+            raise ValueError('Operations apply to texts of different lengths')
+        
+        length = min(abs(x), abs(y))
+        if x > 0 and y > 0:
+            text_op_push(a_prime, length)
+            text_op_push(b_prime, length)
+        elif x < 0 and y > 0:
+            text_op_push(a_prime, -length)
+        elif x > 0 and y < 0:
+            text_op_push(b_prime, -length)
+        # Both deleting the same units: nothing left to do for either
+        
+        x = x - length if x > 0 else x + length
+        y = y - length if y > 0 else y + length
+        if x == 0:
+            i += 1
+            x = ops_a[i] if i < len(ops_a) else None
+        if y == 0:
+            j += 1
+            y = ops_b[j] if j < len(ops_b) else None
+    return a_prime, b_prime
+
+def shared_text_catch_up():
+    """Bring the in-memory text up to the newest stored version; call with shared_text_lock held"""
+    rows = state_db.execute('SELECT version, op FROM shared_text_ops WHERE version > ? ORDER BY version',
+                            (shared_text_content['version'],)).fetchall()
+    if rows and rows[0][0] != shared_text_content['version'] + 1:
+        # Too far behind to replay the operations: start from the saved text
+        content, version = state_db.execute('SELECT content, version FROM shared_text WHERE id = 1').fetchone()
+        if version > shared_text_content['version']:
+            shared_text_content.update(content=content, version=version)
+            rows = [row for row in rows if row[0] > version]
+    for version, op in rows:
+        if version != shared_text_content['version'] + 1:
+            break
+        shared_text_content['content'] = apply_text_op(shared_text_content['content'], json.loads(op))
+        shared_text_content['version'] = version
+
+def shared_text_state():
+    """Current shared text and its version"""
+    with shared_text_lock:
+        shared_text_catch_up()
+        return dict(shared_text_content)
+
+def shared_text_apply(op, base_version):
+    """Transform an operation made at base_version over newer ones and apply it
+
+    Returns (version, applied operation), or None if base_version is too old to catch up.
+    Call with shared_text_lock held.
+    """
+    state_db.execute('BEGIN IMMEDIATE')
+    try:
+        shared_text_catch_up()
+        current = shared_text_content['version']
+        if base_version > current:
+            raise ValueError('Unknown version')
+        if base_version < current:
+            newer = state_db.execute('SELECT version, op FROM shared_text_ops WHERE version > ? ORDER BY version',
+                                     (base_version,)).fetchall()
+            if not newer or newer[0][0] != base_version + 1:
+                state_db.execute('ROLLBACK')
+                return None
+            for version, applied in newer:
+                op, _ = transform_text_ops(op, json.loads(applied))
+        
+        shared_text_content['content'] = apply_text_op(shared_text_content['content'], op)
+        shared_text_content['version'] = current + 1
+        state_db.execute('INSERT INTO shared_text_ops VALUES (?, ?)', (current + 1, json.dumps(op, ensure_ascii=False)))
+        state_db.execute('COMMIT')
+    except BaseException:
+        if state_db.in_transaction:
+            state_db.execute('ROLLBACK')
+        raise
+    schedule_shared_text_save()
+    return current + 1, op
+
+def schedule_shared_text_save():
+    """Write the shared text behind the edits once they pause; call with shared_text_lock held"""
+    global shared_text_save_timer, shared_text_dirty_since
+    now = time.monotonic()
+    if shared_text_dirty_since is None:
+        shared_text_dirty_since = now
+    if shared_text_save_timer is not None:
+        if now - shared_text_dirty_since >= SHARED_TEXT_SAVE_MAX_DELAY:
+            return  # Keep the pending timer so a long typing session is still saved
+        shared_text_save_timer.cancel()
+    delay = min(SHARED_TEXT_SAVE_DELAY, max(SHARED_TEXT_SAVE_MAX_DELAY - (now - shared_text_dirty_since), 0))
+    shared_text_save_timer = threading.Timer(delay, save_shared_text)
+    shared_text_save_timer.daemon = True
+    shared_text_save_timer.start()
+
+def save_shared_text():
+    """Persist the shared text to STATE_DB and config.json if it changed since the last save"""
+    global shared_text_save_timer, shared_text_dirty_since
+    with shared_text_lock:
+        if shared_text_dirty_since is None:
+            return
+        if shared_text_save_timer is not None:
+            shared_text_save_timer.cancel()
+        shared_text_save_timer = None
+        shared_text_dirty_since = None
+        
+        state_db.execute('BEGIN IMMEDIATE')
+        try:
+            shared_text_catch_up()
+            version = shared_text_content['version']
+            state_db.execute('UPDATE shared_text SET content = ?, version = ? WHERE id = 1 AND version < ?',
+                             (shared_text_content['content'], version, version))
+            state_db.execute('DELETE FROM shared_text_ops WHERE version <= ?', (version - SHARED_TEXT_HISTORY,))
+            state_db.execute('COMMIT')
+        except BaseException:
+            if state_db.in_transaction:
+                state_db.execute('ROLLBACK')
+            raise
+        config['shared_text'] = shared_text_content['content']
+        snapshot = dict(config)
+    if not save_config(snapshot):
+        log.error("Failed to save shared text to config file")
+
+atexit.register(save_shared_text)
+
+# Directory size index: absolute directory path -> total size of everything below it.
+# Built lazily by walking a tree once and kept up to date by the mutation routes.
+dir_size_cache = {}
+dir_size_lock = threading.Lock()
+dir_size_epoch = 0  # Bumped on every change so stale background walks are discarded
+dir_size_pending = set()  # Directories queued for a background walk
+dir_size_waiters = {}  # Directories a listing is waiting on -> relative path for the client
+dir_size_executor = ThreadPoolExecutor(max_workers=DIR_SIZE_WORKERS)
+
+def compute_dir_sizes(path):
+    """Walk a directory tree once and return the total size of every directory in it"""
+    started = time.perf_counter()
+    sizes = {}
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        total = 0
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except (OSError, IOError):
+                pass
+        for dirname in dirnames:
+            total += sizes.get(os.path.join(dirpath, dirname), 0)
+        sizes[dirpath] = total
+    dir_walk_seconds.observe(time.perf_counter() - started)
+    return sizes
+
+def store_dir_sizes(sizes, epoch):
+    """Merge walked sizes into the index unless something changed during the walk"""
+    with dir_size_lock:
+        if epoch != dir_size_epoch:
+            return False
+        dir_size_cache.update(sizes)
+    # Other workers take the sizes instead of walking the same trees again. A walk of a big
+    # tree sizes many folders, so they go in bounded batches, deepest first as walked.
+    paths = list(sizes)
+    for i in range(0, len(paths), DIR_SIZE_BUS_BATCH):
+        bus_publish('dir_sizes', {path: sizes[path] for path in paths[i:i + DIR_SIZE_BUS_BATCH]})
+    # Listings showed these folders as still being sized
+    listing_changed(*{os.path.dirname(path) for path in sizes})
+    return True
+
+def merge_dir_sizes(sizes):
+    """Take the sizes another worker walked for folders this one has not sized
+
+    Sizes this worker already has are kept: its own bus messages keep them current, and a
+    change made here could still be on its way to the walking worker.
+    """
+    with dir_size_lock:
+        new = {path: size for path, size in sizes.items() if path not in dir_size_cache}
+        dir_size_cache.update(new)
+    if new:
+        listing_changed(*{os.path.dirname(path) for path in new})
+
+def get_dir_size(path, wait=True):
+    """Get a directory size from the index, or None if a background walk was queued"""
+    with dir_size_lock:
+        if path in dir_size_cache:
+            return dir_size_cache[path]
+        epoch = dir_size_epoch
+    
+    if not wait:
+        schedule_dir_size(path)
+        return None
+    
+    sizes = compute_dir_sizes(path)
+    store_dir_sizes(sizes, epoch)
+    return sizes.get(path, 0)
+
+def schedule_dir_size(path):
+    """Queue a background walk for a directory and notify clients once it is sized"""
+    with dir_size_lock:
+        dir_size_waiters[path] = os.path.relpath(path, BASE_DIR).replace('\\', '/')
+        # A walk of the directory or any of its parents will size it as well
+        parent = path
+        while True:
+            if parent in dir_size_pending:
+                return
+            if parent == BASE_DIR or not is_safe_path(parent, BASE_DIR):
+                break
+            parent = os.path.dirname(parent)
+        dir_size_pending.add(path)
+    dir_size_executor.submit(dir_size_task, path)
+
+def dir_size_task(path):
+    """Background worker that sizes a directory tree and publishes the results"""
+    try:
+        while True:
+            with dir_size_lock:
+                if path in dir_size_cache:
+                    break  # Sized by another worker's walk while this one waited
+                epoch = dir_size_epoch
+            sizes = compute_dir_sizes(path)
+            if store_dir_sizes(sizes, epoch):
+                break
+    finally:
+        with dir_size_lock:
+            dir_size_pending.discard(path)
+            ready = {p: rel for p, rel in dir_size_waiters.items() if p in dir_size_cache}
+            for p in ready:
+                del dir_size_waiters[p]
+            sizes = {rel: dir_size_cache[p] for p, rel in ready.items()}
+    
+    for rel_path, size in sizes.items():
+        socketio.emit('dir_size_updated', {
+            'path': rel_path,
+            'size': size,
+            'size_formatted': format_file_size(size)
+        }, room=dir_room(rel_path.rpartition('/')[0]))
+
+def dir_size_add(path, delta, publish=True):
+    """Add a size change at path to every indexed parent directory"""
+    global dir_size_epoch
+    if publish:
+        bus_publish('dir_size_add', path, delta)
+    with dir_size_lock:
+        dir_size_epoch += 1
+        parent = os.path.dirname(path)
+        while is_safe_path(parent, BASE_DIR):
+            if parent in dir_size_cache:
+                dir_size_cache[parent] += delta
+            if parent == BASE_DIR:
+                break
+            parent = os.path.dirname(parent)
+    listing_changed(os.path.dirname(path), parents=True)
+
+def dir_size_forget(path, parents=False, publish=True):
+    """Drop indexed sizes for path and everything below it, optionally its parents too"""
+    global dir_size_epoch
+    if publish:
+        bus_publish('dir_size_forget', path, parents)
+    prefix = path + os.sep
+    with dir_size_lock:
+        dir_size_epoch += 1
+        for key in [k for k in dir_size_cache if k == path or k.startswith(prefix)]:
+            del dir_size_cache[key]
+        if parents:
+            parent = os.path.dirname(path)
+            while is_safe_path(parent, BASE_DIR):
+                dir_size_cache.pop(parent, None)
+                if parent == BASE_DIR:
+                    break
+                parent = os.path.dirname(parent)
+    listing_changed(os.path.dirname(path), parents=parents)
+
+def dir_size_move(old_path, new_path, publish=True):
+    """Re-key indexed sizes after a directory was renamed"""
+    global dir_size_epoch
+    if publish:
+        bus_publish('dir_size_move', old_path, new_path)
+    prefix = old_path + os.sep
+    with dir_size_lock:
+        dir_size_epoch += 1
+        for key in [k for k in dir_size_cache if k == old_path or k.startswith(prefix)]:
+            dir_size_cache[new_path + key[len(old_path):]] = dir_size_cache.pop(key)
+    listing_changed(os.path.dirname(old_path), os.path.dirname(new_path))
+
+def dir_size_set(path, size, publish=True):
+    """Record the size of a directory whose contents are known"""
+    if publish:
+        bus_publish('dir_size_set', path, size)
+    with dir_size_lock:
+        dir_size_cache[path] = size
+    listing_changed(os.path.dirname(path))
+
+# Other workers apply the same changes to their own size index
+BUS_HANDLERS.update({
+    'dir_size_add': lambda path, delta: dir_size_add(path, delta, publish=False),
+    'dir_size_forget': lambda path, parents: dir_size_forget(path, parents, publish=False),
+    'dir_size_move': lambda old_path, new_path: dir_size_move(old_path, new_path, publish=False),
+    'dir_size_set': lambda path, size: dir_size_set(path, size, publish=False),
+    'dir_sizes': merge_dir_sizes,
+})
+
+def get_file_size(path, wait=True):
+    """Get file or directory size in bytes"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    elif os.path.isdir(path):
+        return get_dir_size(path, wait)
+    return 0
+
+# Search index: every file and folder below BASE_DIR in SQLite, with an FTS5 trigram
+# table over names and paths for substring search. Rebuilt in the background at
+# startup and kept current by the mutation routes.
+search_lock = threading.Lock()
+search_db = sqlite3.connect(SEARCH_DB, check_same_thread=False)
+search_db.execute('PRAGMA journal_mode=WAL')
+search_db.execute('PRAGMA synchronous=NORMAL')
+search_db.executescript('''
+    CREATE TABLE IF NOT EXISTS entries (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        parent TEXT NOT NULL,
+        name TEXT NOT NULL,
+        ext TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        generation INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+    CREATE INDEX IF NOT EXISTS entries_ext ON entries(ext);
+    CREATE INDEX IF NOT EXISTS entries_size ON entries(size);
+    CREATE INDEX IF NOT EXISTS entries_mtime ON entries(mtime);
+    CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT);
+''')
+try:
+    search_db.executescript('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+            name, path, content='entries', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts(rowid, name, path) VALUES (new.id, new.name, new.path);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, name, path) VALUES ('delete', old.id, old.name, old.path);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE OF name, path ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, name, path) VALUES ('delete', old.id, old.name, old.path);
+            INSERT INTO entries_fts(rowid, name, path) VALUES (new.id, new.name, new.path);
+        END;
+    ''')
+    search_fts = True
+except sqlite3.OperationalError:
+    # SQLite without FTS5 or the trigram tokenizer (before 3.34); search falls back to LIKE
+    search_fts = False
+search_db.commit()
+search_db.execute('PRAGMA busy_timeout=30000')  # Other workers may be writing
+
+def current_search_generation():
+    """Generation of the last (or running) full rebuild; rows not seen by a rebuild are dropped
+
+    Kept in the database rather than in memory so every worker process agrees on it.
+    """
+    with search_lock:
+        return int(search_db.execute(
+            "SELECT COALESCE(MAX(CAST(value AS INTEGER)), 0) FROM search_meta WHERE key IN ('generation', 'building')"
+        ).fetchone()[0])
+
+def search_rel_path(full_path):
+    """Relative, slash-separated path used as the key in the search index"""
+    rel_path = os.path.relpath(full_path, BASE_DIR).replace('\\', '/')
+    return '' if rel_path == '.' else rel_path
+
+def search_row(rel_path, name, is_dir, st, generation):
+    """Build the column values for one search index entry"""
+    return (
+        rel_path,
+        rel_path.rpartition('/')[0],
+        name,
+        '' if is_dir else os.path.splitext(name)[1].lower(),
+        int(is_dir),
+        0 if is_dir else st.st_size,
+        st.st_mtime,
+        generation
+    )
+
+def search_upsert(rows):
+    """Insert or refresh search index entries"""
+    search_db.executemany('''
+        INSERT INTO entries (path, parent, name, ext, is_dir, size, mtime, generation)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            parent = excluded.parent, name = excluded.name, ext = excluded.ext, is_dir = excluded.is_dir,
+            size = excluded.size, mtime = excluded.mtime, generation = excluded.generation
+    ''', rows)
+
+def scan_search_rows(full_path, generation):
+    """Yield search index rows for everything below a directory"""
+    stack = [full_path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if is_dir:
+                        stack.append(entry.path)
+                    yield search_row(search_rel_path(entry.path), entry.name, is_dir, st, generation)
+        except OSError:
+            continue
+
+def search_index_add(full_path, recursive=True):
+    """Index a new or restored file or folder, including everything inside a folder"""
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return
+    is_dir = os.path.isdir(full_path)
+    generation = current_search_generation()
+    rows = [search_row(search_rel_path(full_path), os.path.basename(full_path), is_dir, st, generation)]
+    if is_dir and recursive:
+        rows.extend(scan_search_rows(full_path, generation))
+    with search_lock:
+        search_upsert(rows)
+        search_db.commit()
+
+def search_index_entry(full_path):
+    """Indexed (is_dir, size, mtime) of a path, or None if it is not in the index"""
+    with search_lock:
+        return search_db.execute('SELECT is_dir, size, mtime FROM entries WHERE path = ?',
+                                 (search_rel_path(full_path),)).fetchone()
+
+def search_index_children(full_path):
+    """Indexed entries directly inside a folder: name -> (is_dir, size, mtime)"""
+    with search_lock:
+        rows = search_db.execute('SELECT name, is_dir, size, mtime FROM entries WHERE parent = ?',
+                                 (search_rel_path(full_path),)).fetchall()
+    return {name: (is_dir, size, mtime) for name, is_dir, size, mtime in rows}
+
+def search_like_escape(text):
+    """Escape LIKE wildcards so text matches literally"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_index_remove(full_path):
+    """Drop a file or folder and everything inside it from the search index"""
+    rel_path = search_rel_path(full_path)
+    with search_lock:
+        search_db.execute("DELETE FROM entries WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                          (rel_path, search_like_escape(rel_path) + '/%'))
+        search_db.commit()
+
+def search_index_move(old_path, new_path):
+    """Re-key a renamed file or folder and everything inside it"""
+    old_rel, new_rel = search_rel_path(old_path), search_rel_path(new_path)
+    name = os.path.basename(new_path)
+    with search_lock:
+        # Stale entries left at the destination by changes made outside PFshare
+        search_db.execute("DELETE FROM entries WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                          (new_rel, search_like_escape(new_rel) + '/%'))
+        search_db.execute('''
+            UPDATE entries SET path = ?, parent = ?, name = ?,
+                ext = CASE WHEN is_dir THEN '' ELSE ? END
+            WHERE path = ?
+        ''', (new_rel, new_rel.rpartition('/')[0], name, os.path.splitext(name)[1].lower(), old_rel))
+        search_db.execute('''
+            UPDATE entries SET path = ? || substr(path, ?), parent = ? || substr(parent, ?)
+            WHERE path LIKE ? ESCAPE '\\'
+        ''', (new_rel, len(old_rel) + 1, new_rel, len(old_rel) + 1, search_like_escape(old_rel) + '/%'))
+        search_db.commit()
+
+def rebuild_search_index():
+    """Walk BASE_DIR and bring the search index in line with the disk"""
+    generation = current_search_generation() + 1
+    with search_lock:
+        search_db.execute("INSERT OR REPLACE INTO search_meta VALUES ('building', ?)", (str(generation),))
+        search_db.commit()
+    
+    batch = []
+    for row in scan_search_rows(BASE_DIR, generation):
+        batch.append(row)
+        if len(batch) >= 5000:
+            with search_lock:
+                search_upsert(batch)
+                search_db.commit()
+            batch = []
+    
+    with search_lock:
+        search_upsert(batch)
+        # Anything neither the walk nor a mutation route touched since it started is gone
+        search_db.execute('DELETE FROM entries WHERE generation < ?', (generation,))
+        search_db.execute("INSERT OR REPLACE INTO search_meta VALUES ('generation', ?)", (str(generation),))
+        search_db.commit()
+    log.info("Search index rebuilt", extra={'generation': generation})
+
+def search_index_ready():
+    """Whether the search index has been built at least once"""
+    with search_lock:
+        return search_db.execute("SELECT 1 FROM search_meta WHERE key = 'generation'").fetchone() is not None
+
+def search_files(query, under='', extensions=None, min_size=None, max_size=None,
+                 modified_after=None, modified_before=None, kind=None,
+                 sort_by='name', reverse=False, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Search names below a folder with optional filters; returns (rows, has_more)"""
+    where = []
+    params = []
+    table = 'entries'
+    
+    if query:
+        if search_fts and len(query) >= 3:
+            table = 'entries JOIN entries_fts ON entries_fts.rowid = entries.id'
+            where.append('entries_fts MATCH ?')
+            params.append('name : "' + query.replace('"', '""') + '"')
+        else:
+            where.append("entries.name LIKE ? ESCAPE '\\'")
+            params.append('%' + search_like_escape(query) + '%')
+    
+    if under:
+        where.append("entries.path LIKE ? ESCAPE '\\'")
+        params.append(search_like_escape(under) + '/%')
+    
+    if extensions:
+        where.append(f"entries.ext IN ({','.join('?' * len(extensions))})")
+        params.extend(extensions)
+    
+    for clause, value in (('entries.size >= ?', min_size), ('entries.size <= ?', max_size),
+                          ('entries.mtime >= ?', modified_after), ('entries.mtime < ?', modified_before)):
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    
+    if kind in ('file', 'dir'):
+        where.append('entries.is_dir = ?')
+        params.append(int(kind == 'dir'))
+    
+    order_column = {'size': 'entries.size', 'modified': 'entries.mtime'}.get(sort_by, 'entries.name COLLATE NOCASE')
+    direction = 'DESC' if reverse else 'ASC'
+    sql = f'''
+        SELECT entries.path, entries.name, entries.is_dir, entries.size, entries.mtime FROM {table}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY entries.is_dir DESC, {order_column} {direction}, entries.path
+        LIMIT ? OFFSET ?
+    '''
+    params.extend([per_page + 1, (page - 1) * per_page])
+    
+    with search_lock:
+        rows = search_db.execute(sql, params).fetchall()
+    return rows[:per_page], len(rows) > per_page
+
+# Thumbnails are rendered by a process pool into THUMBNAIL_DIR, named after the source
+# file's inode, size and mtime so renames keep them and edits replace them.
+thumbnail_executor = None
+thumbnail_jobs = {}  # Cache path -> Future of a render in progress
+thumbnail_lock = threading.Lock()
+thumbnail_cache_bytes = None  # Approximate cache size, counted on first use
+thumbnail_evicting = False
+
+def render_thumbnail(source_path, thumb_path, size):
+    """Process pool worker: write a JPEG thumbnail and return its size in bytes"""
+    with Image.open(source_path) as img:
+        # Let the JPEG decoder scale down while decoding instead of loading every pixel
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        temp_path = f"{thumb_path}.{os.getpid()}.tmp"
+        try:
+            img.save(temp_path, 'JPEG', quality=80, optimize=True)
+            os.replace(temp_path, thumb_path)
+        except Exception:
+            # A truncated image or a full disk must not leave a partial file in the cache
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+    return os.path.getsize(thumb_path)
+
+def thumbnail_path(full_path, size):
+    """Cache file for a thumbnail of full_path, or None if it cannot have one"""
+    if Image is None or os.path.splitext(full_path)[1].lower() not in THUMBNAIL_EXTENSIONS:
+        return None
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    key = hashlib.sha1(f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}:{size}".encode()).hexdigest()
+    return os.path.join(THUMBNAIL_DIR, key[:2], f"{key}.jpg")
+
+def queue_thumbnail(full_path, thumb_path, size):
+    """Start rendering a thumbnail unless it is already being rendered; returns the Future"""
+    global thumbnail_executor
+    with thumbnail_lock:
+        future = thumbnail_jobs.get(thumb_path)
+        if future is not None:
+            return future
+        if thumbnail_executor is None:
+            thumbnail_executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        future = thumbnail_executor.submit(render_thumbnail, full_path, thumb_path, size)
+        thumbnail_jobs[thumb_path] = future
+    future.add_done_callback(lambda f: thumbnail_rendered(thumb_path, f))
+    return future
+
+def thumbnail_rendered(thumb_path, future):
+    """Account for a finished render and evict old thumbnails when the cache is full"""
+    global thumbnail_cache_bytes, thumbnail_evicting
+    with thumbnail_lock:
+        thumbnail_jobs.pop(thumb_path, None)
+        if future.exception() is not None or thumbnail_cache_bytes is None:
+            evict = thumbnail_cache_bytes is None and not thumbnail_evicting
+        else:
+            thumbnail_cache_bytes += future.result()
+            evict = thumbnail_cache_bytes > THUMBNAIL_CACHE_MAX_BYTES and not thumbnail_evicting
+        if evict:
+            thumbnail_evicting = True
+    if evict:
+        threading.Thread(target=evict_thumbnails, daemon=True).start()
+
+def evict_thumbnails():
+    """Remove the least recently used thumbnails until the cache is below 90% of its limit"""
+    global thumbnail_cache_bytes, thumbnail_evicting
+    try:
+        entries = []
+        for root, dirs, files in os.walk(THUMBNAIL_DIR):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= THUMBNAIL_CACHE_MAX_BYTES * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        
+        with thumbnail_lock:
+            thumbnail_cache_bytes = total
+    finally:
+        with thumbnail_lock:
+            thumbnail_evicting = False
+
+def warm_thumbnails(full_paths, size=THUMBNAIL_SIZES[0]):
+    """Render missing thumbnails for files that were just listed, without waiting for them"""
+    for full_path in full_paths:
+        thumb_path = thumbnail_path(full_path, size)
+        if thumb_path and not os.path.exists(thumb_path):
+            queue_thumbnail(full_path, thumb_path, size)
+
+# Live updates: browsers subscribe to the room of the folder they are viewing. Changes are
+# collected per folder and broadcast as one dir_delta event once the folder has been quiet
+# for DELTA_DEBOUNCE seconds, with entries re-read from disk so bursts collapse to their outcome.
+dir_deltas = {}  # Relative folder -> pending change names, renames and timing
+dir_delta_cond = threading.Condition()
+dir_delta_thread = None
+dir_delta_holds = 0  # Bulk operations running; their changes are broadcast once they end
+
+def dir_room(rel_path):
+    """Socket.IO room for browsers viewing a folder"""
+    return f"dir:{rel_path.strip('/')}"
+
+def pending_dir_delta(rel_dir, now):
+    """Collected changes for a folder, created on first use; call with dir_delta_cond held"""
+    global dir_delta_thread
+    delta = dir_deltas.setdefault(rel_dir, {'names': set(), 'renamed': [], 'reset': False, 'first': now})
+    delta['last'] = now
+    if dir_delta_thread is None:
+        dir_delta_thread = threading.Thread(target=dir_delta_loop, daemon=True)
+        dir_delta_thread.start()
+    return delta
+
+def notify_dir_change(full_path, old_path=None):
+    """Queue a live update for a changed, added or removed path (and a rename's old path)
+
+    Parent folders are notified too, since their sizes changed.
+    """
+    now = time.monotonic()
+    with dir_delta_cond:
+        path = full_path
+        while path != BASE_DIR and is_safe_path(path, BASE_DIR):
+            delta = pending_dir_delta(search_rel_path(os.path.dirname(path)), now)
+            if path == full_path and old_path and os.path.dirname(old_path) == os.path.dirname(full_path):
+                delta['renamed'].append((os.path.basename(old_path), os.path.basename(full_path)))
+            else:
+                delta['names'].add(os.path.basename(path))
+            path = os.path.dirname(path)
+        dir_delta_cond.notify()
+    listing_changed(os.path.dirname(full_path), parents=True, publish=True)
+    
+    # A move out of another folder is a removal there
+    if old_path and os.path.dirname(old_path) != os.path.dirname(full_path):
+        notify_dir_change(old_path)
+
+@contextmanager
+def dir_deltas_held():
+    """Collect folder changes without broadcasting them until the block ends"""
+    global dir_delta_holds
+    with dir_delta_cond:
+        dir_delta_holds += 1
+    try:
+        yield
+    finally:
+        with dir_delta_cond:
+            dir_delta_holds -= 1
+            dir_delta_cond.notify()
+
+def stat_list_item(rel_dir, name):
+    """Current list entry for a name in a folder, or None if it no longer exists"""
+    full_path = os.path.join(safe_join(BASE_DIR, rel_dir), name)
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        return None
+    is_dir = os.path.isdir(full_path)
+    size = get_dir_size(full_path, wait=not DIR_SIZE_LAZY) if is_dir else st.st_size
+    rel_path = f"{rel_dir}/{name}" if rel_dir else name
+    return make_list_item(name, rel_path, is_dir, size, st.st_mtime)
+
+def build_dir_delta(rel_dir, delta):
+    """Turn collected changes into a dir_delta payload with fresh entry metadata"""
+    payload = {'path': rel_dir, 'added': [], 'removed': [], 'renamed': []}
+    if delta['reset']:
+        payload['reset'] = True
+        return payload
+    
+    names = set(delta['names'])
+    for old_name, new_name in delta['renamed']:
+        item = stat_list_item(rel_dir, new_name)
+        if item is not None:
+            payload['renamed'].append({'from': old_name, 'to': new_name, 'item': item})
+            names.discard(new_name)
+            # A later change might have brought the old name back
+            if stat_list_item(rel_dir, old_name) is not None:
+                names.add(old_name)
+        else:
+            names.update((old_name, new_name))
+    
+    for name in sorted(names):
+        item = stat_list_item(rel_dir, name)
+        if item is None:
+            payload['removed'].append(name)
+        else:
+            payload['added'].append(item)
+    return payload
+
+def dir_delta_loop():
+    """Background thread that broadcasts folder changes once they settle"""
+    while True:
+        with dir_delta_cond:
+            while not dir_deltas or dir_delta_holds:
+                dir_delta_cond.wait()
+            
+            now = time.monotonic()
+            due = [d for d, delta in dir_deltas.items()
+                   if now - delta['last'] >= DELTA_DEBOUNCE or now - delta['first'] >= DELTA_MAX_DELAY]
+            if not due:
+                wait = min(min(DELTA_DEBOUNCE - (now - delta['last']), DELTA_MAX_DELAY - (now - delta['first']))
+                           for delta in dir_deltas.values())
+                dir_delta_cond.wait(max(wait, 0.01))
+                continue
+            batch = {d: dir_deltas.pop(d) for d in due}
+        
+        for rel_dir, delta in batch.items():
+            try:
+                payload = build_dir_delta(rel_dir, delta)
+            except Exception:
+                log.exception("Failed to build folder update", extra={'folder': '/' + rel_dir})
+                payload = {'path': rel_dir, 'reset': True}
+            socketio.emit('dir_delta', payload, room=dir_room(rel_dir))
+
+# Filesystem watcher: inotify (Linux) reports changes made to BASE_DIR outside PFshare.
+# Folders inotify cannot watch (out of watches, or no inotify at all) are scanned every
+# WATCH_POLL_INTERVAL seconds and compared with the search index instead. Changed paths go
+# through a bounded queue, are deduplicated per batch and compared with the search index, so
+# changes the routes already recorded are skipped and the rest update sizes, search and clients.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+watch_queue = queue.Queue(maxsize=WATCH_QUEUE_SIZE)  # (full path, old path of a move or None)
+watch_overflow = threading.Event()  # Events were lost; resync everything
+watch_lock = threading.Lock()
+watch_fd = None
+watch_libc = None
+watch_paths = {}  # inotify watch descriptor -> folder
+watch_descriptors = {}  # Folder -> inotify watch descriptor
+watch_polled = set()  # Folders (with everything below them) scanned instead of watched
+watch_busy = {}  # Path a route is changing -> number of routes changing it
+
+def watch_set_busy(paths, step, publish=True):
+    """Count routes changing paths up or down, in this worker and (via the bus) the watching one"""
+    if publish:
+        bus_publish('watch_busy', list(paths), step)
+    with watch_lock:
+        for path in paths:
+            count = watch_busy.get(path, 0) + step
+            if count > 0:
+                watch_busy[path] = count
+            else:
+                watch_busy.pop(path, None)
+
+BUS_HANDLERS['watch_busy'] = lambda paths, step: watch_set_busy(paths, step, publish=False)
+
+@contextmanager
+def watch_paused(*paths):
+    """Keep the watcher off paths while a route changes them and records the change itself"""
+    watch_set_busy(paths, 1)
+    try:
+        yield
+    finally:
+        watch_set_busy(paths, -1)
+
+def watch_is_busy(full_path):
+    """Whether a route is in the middle of changing a path or a folder above it"""
+    with watch_lock:
+        return any(full_path == p or full_path.startswith(p + os.sep) for p in watch_busy)
+
+def watch_ignored(full_path):
+    """Whether a path belongs to PFshare's own state rather than the shared files"""
+    return full_path == DATA_DIR or full_path.startswith(DATA_DIR + os.sep)
+
+def watch_enqueue(full_path, old_path=None):
+    """Hand a changed path to the watcher; events that do not fit trigger a resync"""
+    if watch_ignored(full_path):
+        return
+    try:
+        watch_queue.put_nowait((full_path, old_path))
+    except queue.Full:
+        watch_overflow.set()
+
+def watch_add_tree(path):
+    """Watch a folder and every folder below it, polling what cannot be watched"""
+    for dirpath, dirnames, filenames in os.walk(path):
+        if watch_ignored(dirpath):
+            dirnames[:] = []
+            continue
+        wd = watch_libc.inotify_add_watch(watch_fd, os.fsencode(dirpath), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == 28:  # ENOSPC: fs.inotify.max_user_watches reached
+                with watch_lock:
+                    if not watch_polled:
+                        log.warning("Out of inotify watches; scanning unwatched folders instead "
+                                    "(raise fs.inotify.max_user_watches to avoid this)",
+                                    extra={'path': dirpath, 'interval': WATCH_POLL_INTERVAL})
+                    watch_polled.add(dirpath)
+            dirnames[:] = []
+            continue
+        with watch_lock:
+            watch_paths[wd] = dirpath
+            watch_descriptors[dirpath] = wd
+
+def watch_forget_tree(path, remove_watches=False):
+    """Drop bookkeeping for a folder that was deleted or moved out of BASE_DIR"""
+    prefix = path + os.sep
+    with watch_lock:
+        for folder in [f for f in watch_descriptors if f == path or f.startswith(prefix)]:
+            wd = watch_descriptors.pop(folder)
+            watch_paths.pop(wd, None)
+            if remove_watches:
+                watch_libc.inotify_rm_watch(watch_fd, wd)
+        watch_polled.difference_update([f for f in watch_polled if f == path or f.startswith(prefix)])
+
+def watch_move_tree(old_path, new_path):
+    """Re-key watched folders after a folder was renamed inside BASE_DIR"""
+    prefix = old_path + os.sep
+    with watch_lock:
+        for folder in [f for f in watch_descriptors if f == old_path or f.startswith(prefix)]:
+            wd = watch_descriptors.pop(folder)
+            moved = new_path + folder[len(old_path):]
+            watch_descriptors[moved] = wd
+            watch_paths[wd] = moved
+        for folder in [f for f in watch_polled if f == old_path or f.startswith(prefix)]:
+            watch_polled.discard(folder)
+            watch_polled.add(new_path + folder[len(old_path):])
+
+def watch_read_loop():
+    """Background thread turning inotify events into watcher queue entries"""
+    header = struct.calcsize('iIII')
+    while True:
+        data = os.read(watch_fd, 256 * 1024)
+        moved_from = {}  # Cookie -> (old path, is_dir) waiting for its IN_MOVED_TO
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + header:offset + header + length].rstrip(b'\0')
+            offset += header + length
+            
+            if mask & IN_Q_OVERFLOW:
+                watch_overflow.set()
+                continue
+            with watch_lock:
+                folder = watch_paths.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                with watch_lock:
+                    watch_paths.pop(wd, None)
+                    if watch_descriptors.get(folder) == wd:
+                        del watch_descriptors[folder]
+                continue
+            if mask & IN_DELETE_SELF or not name:
+                continue
+            
+            path = os.path.join(folder, os.fsdecode(name))
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & IN_MOVED_TO and cookie in moved_from:
+                old_path, _ = moved_from.pop(cookie)
+                if is_dir:
+                    watch_move_tree(old_path, path)
+                watch_enqueue(path, old_path)
+            else:
+                if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                    watch_add_tree(path)
+                watch_enqueue(path)
+        
+        # Moved out of BASE_DIR: the kernel keeps watching those folders unless told otherwise
+        for old_path, is_dir in moved_from.values():
+            if is_dir:
+                watch_forget_tree(old_path, remove_watches=True)
+            watch_enqueue(old_path)
+
+def watch_poll_loop():
+    """Background thread comparing unwatched folders with the search index"""
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        if not search_index_ready():
+            continue
+        with watch_lock:
+            roots = sorted(watch_polled) if watch_fd is not None else [BASE_DIR]
+        for root in roots:
+            if not os.path.isdir(root):
+                watch_forget_tree(root)
+                watch_enqueue(root)
+                continue
+            stack = [root]
+            while stack:
+                folder = stack.pop()
+                known = search_index_children(folder)
+                try:
+                    with os.scandir(folder) as it:
+                        entries = list(it)
+                except OSError:
+                    continue
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if watch_ignored(entry.path):
+                        continue
+                    row = known.pop(entry.name, None)
+                    if row is None or bool(row[0]) != is_dir:
+                        watch_enqueue(entry.path)
+                        continue
+                    if is_dir:
+                        stack.append(entry.path)
+                    elif row[1] != st.st_size or row[2] != st.st_mtime:
+                        watch_enqueue(entry.path)
+                for name in known:
+                    watch_enqueue(os.path.join(folder, name))
+
+def watch_apply(full_path, old_path=None):
+    """Bring sizes, the search index and clients in line with one changed path"""
+    if old_path is not None:
+        old_row = search_index_entry(old_path)
+        if old_row is not None and os.path.lexists(full_path):
+            # Renamed outside PFshare; routes have already re-keyed their own renames
+            search_index_move(old_path, full_path)
+            if old_row[0]:
+                dir_size_move(old_path, full_path)
+            notify_dir_change(full_path, old_path=old_path)
+        elif old_row is not None:
+            watch_apply(old_path)
+    
+    row = search_index_entry(full_path)
+    try:
+        st = os.stat(full_path)
+        is_dir = os.path.isdir(full_path)
+    except OSError:
+        st = None
+    
+    if st is not None and row is not None and bool(row[0]) == is_dir:
+        if row[2] == st.st_mtime and (is_dir or row[1] == st.st_size):
+            return  # Already recorded, most likely by the route that made the change
+        if not is_dir:
+            dir_size_add(full_path, st.st_size - row[1])
+        search_index_add(full_path, recursive=False)
+        if not is_dir:
+            notify_dir_change(full_path)
+        return
+    
+    if row is not None:
+        # Gone (or replaced by something of another type)
+        if row[0]:
+            with dir_size_lock:
+                size = dir_size_cache.get(full_path)
+            if size is None:
+                dir_size_forget(full_path, parents=True)
+            else:
+                dir_size_forget(full_path)
+                dir_size_add(full_path, -size)
+        else:
+            dir_size_add(full_path, -row[1])
+        search_index_remove(full_path)
+        if st is None:
+            notify_dir_change(full_path)
+            return
+    elif st is None:
+        return  # Never recorded and already gone
+    
+    # New to the index
+    if is_dir:
+        dir_size_add(full_path, get_dir_size(full_path))
+    else:
+        dir_size_add(full_path, st.st_size)
+    search_index_add(full_path)
+    notify_dir_change(full_path)
+
+def watch_resync():
+    """Recover from lost events: rebuild caches and make every browser reload"""
+    log.warning("Filesystem events were lost; resyncing the whole tree")
+    dir_size_forget(BASE_DIR)
+    rebuild_search_index()
+    # Browsers may be connected to any worker, so this goes to everyone
+    socketio.emit('dir_delta', {'path': None, 'reset': True})
+
+def watch_apply_loop():
+    """Background thread applying queued filesystem changes in deduplicated batches"""
+    while True:
+        item = watch_queue.get()
+        batch = {}
+        deadline = time.monotonic() + WATCH_COALESCE
+        while True:
+            full_path, old_path = item
+            batch[full_path] = old_path or batch.get(full_path)
+            try:
+                item = watch_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+        
+        if watch_overflow.is_set():
+            watch_overflow.clear()
+            watch_resync()
+            continue
+        if not search_index_ready():
+            # Nothing to compare with yet; the initial rebuild will pick the changes up
+            for full_path in batch:
+                dir_size_forget(full_path, parents=True)
+                notify_dir_change(full_path)
+            continue
+        
+        # Parents before children, so a new folder is indexed before events inside it
+        for full_path in sorted(batch):
+            if watch_is_busy(full_path) or (batch[full_path] and watch_is_busy(batch[full_path])):
+                continue
+            try:
+                watch_apply(full_path, batch[full_path])
+            except Exception:
+                log.exception("Failed to apply filesystem change", extra={'path': full_path})
+
+def start_watcher():
+    """Watch BASE_DIR with inotify where available, otherwise poll it"""
+    global watch_fd, watch_libc
+    try:
+        watch_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = watch_libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        fd = -1
+    
+    if fd >= 0:
+        watch_fd = fd
+        watch_add_tree(BASE_DIR)
+        threading.Thread(target=watch_read_loop, daemon=True).start()
+        log.info("Watching folders for outside changes", extra={'folders': len(watch_descriptors)})
+    else:
+        log.info("inotify unavailable; scanning for outside changes", extra={'interval': WATCH_POLL_INTERVAL})
+    threading.Thread(target=watch_apply_loop, daemon=True).start()
+    threading.Thread(target=watch_poll_loop, daemon=True).start()
+
+# Undo journal: every upload, folder creation, delete, rename, move and copy is recorded in SQLite
+# under the browser session that made it, newest last, so each session can step back
+# through its own history (UNDO_HISTORY steps, UNDO_MAX_AGE seconds). Deleted items are
+# renamed into TRASH_DIR instead of being removed; a background purge removes them for
+# good once their journal entry expires or the trash grows past TRASH_MAX_BYTES.
+undo_lock = threading.Lock()
+undo_db = sqlite3.connect(UNDO_DB, check_same_thread=False)
+undo_db.execute('PRAGMA journal_mode=WAL')
+undo_db.executescript('''
+    CREATE TABLE IF NOT EXISTS operations (
+        id INTEGER PRIMARY KEY,
+        session TEXT NOT NULL,
+        type TEXT NOT NULL,
+        data TEXT NOT NULL,
+        trash TEXT,
+        size INTEGER,
+        created REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS operations_session ON operations(session, id);
+    CREATE INDEX IF NOT EXISTS operations_created ON operations(created);
+''')
+undo_db.commit()
+trash_purge_wanted = threading.Event()
+
+def undo_session_id():
+    """Journal key of the current browser session"""
+    if 'undo_id' not in session:
+        session['undo_id'] = secrets.token_hex(16)
+    return session['undo_id']
+
+def journal_record(op_type, data, trash=None, size=None, session_id=None):
+    """Add an undoable operation to the current session's history (or session_id's, outside requests)"""
+    session_id = session_id or undo_session_id()
+    with undo_lock:
+        undo_db.execute('INSERT INTO operations (session, type, data, trash, size, created) VALUES (?, ?, ?, ?, ?, ?)',
+                        (session_id, op_type, json.dumps(data), trash, size, time.time()))
+        # Steps beyond the history limit can no longer be undone
+        undo_db.execute('''
+            DELETE FROM operations WHERE session = ? AND id NOT IN (
+                SELECT id FROM operations WHERE session = ? ORDER BY id DESC LIMIT ?)
+        ''', (session_id, session_id, UNDO_HISTORY))
+        undo_db.commit()
+    if trash is not None:
+        trash_purge_wanted.set()
+
+def journal_history(limit=UNDO_HISTORY):
+    """Undoable operations of the current session, newest first"""
+    with undo_lock:
+        rows = undo_db.execute('''
+            SELECT id, type, data, trash, size, created FROM operations
+            WHERE session = ? AND created >= ? ORDER BY id DESC LIMIT ?
+        ''', (undo_session_id(), time.time() - UNDO_MAX_AGE, limit)).fetchall()
+    return [{'id': op_id, 'type': op_type, 'trash': trash, 'size': size, 'created': created, **json.loads(data)}
+            for op_id, op_type, data, trash, size, created in rows]
+
+def journal_remove(op_id):
+    """Drop an operation from the journal, leaving its trash (if any) to the purge"""
+    with undo_lock:
+        undo_db.execute('DELETE FROM operations WHERE id = ?', (op_id,))
+        undo_db.commit()
+
+def new_trash_slot():
+    """Name for a new folder in the trash"""
+    return f"{int(time.time())}-{secrets.token_hex(4)}"
+
+def move_to_trash(full_path, slot=None):
+    """Move a file or folder into the trash and return its path there, relative to TRASH_DIR
+
+    Bulk deletes pass a numbered folder inside one slot for each item.
+    """
+    slot = slot or new_trash_slot()
+    os.makedirs(os.path.join(TRASH_DIR, slot))
+    trash_rel = f"{slot}/{os.path.basename(full_path)}"
+    try:
+        os.rename(full_path, os.path.join(TRASH_DIR, trash_rel))
+    except OSError as e:
+        if e.errno != 18:  # EXDEV: DATA_DIR is on another filesystem, so this is a copy
+            os.rmdir(os.path.join(TRASH_DIR, slot))
+            raise
+        shutil.move(full_path, os.path.join(TRASH_DIR, trash_rel))
+    return trash_rel
+
+def trash_item(full_path, slot=None):
+    """Delete a file or folder into the trash; returns its trash path and size (None if unknown)"""
+    # Size to take off the parent folders; unknown folder sizes just drop the parents from the index
+    with dir_size_lock:
+        removed_size = os.path.getsize(full_path) if os.path.isfile(full_path) else dir_size_cache.get(full_path)
+    
+    with watch_paused(full_path):
+        # Moved into the trash for undo, which is a rename and does not copy anything
+        trash_rel = move_to_trash(full_path, slot)
+        
+        if removed_size is None:
+            dir_size_forget(full_path, parents=True)
+        else:
+            dir_size_forget(full_path)
+            dir_size_add(full_path, -removed_size)
+        search_index_remove(full_path)
+        notify_dir_change(full_path)
+    return trash_rel, removed_size
+
+def move_item(old_path, new_path):
+    """Move a file or folder to another place in BASE_DIR"""
+    with dir_size_lock:
+        size = os.path.getsize(old_path) if os.path.isfile(old_path) else dir_size_cache.get(old_path)
+    
+    with watch_paused(old_path, new_path):
+        try:
+            os.rename(old_path, new_path)
+        except OSError as e:
+            if e.errno != 18:  # EXDEV: another filesystem is mounted below BASE_DIR
+                raise
+            shutil.move(old_path, new_path, copy_function=copy_file)
+        dir_size_move(old_path, new_path)
+        if size is None:
+            dir_size_forget(old_path, parents=True)
+            dir_size_forget(new_path, parents=True)
+        else:
+            dir_size_add(old_path, -size)
+            dir_size_add(new_path, size)
+        search_index_move(old_path, new_path)
+        notify_dir_change(new_path, old_path=old_path)
+
+copied_bytes_total = Metric('pfshare_copied_bytes_total', 'counter', 'Bytes copied within the share, by how they were copied', ('method',))
+
+def copy_file_data(src_fd, dst_fd, size, progress=None):
+    """Copy size bytes between open files the cheapest way available; returns the way used
+
+    A reflink shares the data on filesystems that support it (btrfs, XFS). Otherwise
+    copy_file_range lets the kernel (or a network filesystem's server) copy without passing
+    the data through Python, and sendfile does the same on kernels without it. Both go in
+    COPY_CHUNK_SIZE steps so progress can be reported in between.
+    """
+    if size and fcntl is not None:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            if progress:
+                progress(size)
+            return 'reflink'
+        except OSError:
+            pass  # Not supported here; copy the data instead
+    
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                count = min(COPY_CHUNK_SIZE, size - copied)
+                if method == 'copy_file_range':
+                    done = os.copy_file_range(src_fd, dst_fd, count, copied, copied)
+                else:
+                    os.lseek(dst_fd, copied, os.SEEK_SET)
+                    done = os.sendfile(dst_fd, src_fd, copied, count)
+                if not done:
+                    break  # The source shrank while being copied
+                copied += done
+                if progress:
+                    progress(copied)
+            return method
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while copied < size:
+        data = os.read(src_fd, min(DOWNLOAD_CHUNK_SIZE, size - copied))
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        copied += len(data)
+        if progress:
+            progress(copied)
+    return 'read'
+
+def copy_file(src, dst, progress=None):
+    """Copy one file with its permissions and times; returns dst, like shutil.copy2"""
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        src_st = os.fstat(src_fd)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            method = copy_file_data(src_fd, dst_fd, src_st.st_size, progress)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+    copied_bytes_total.inc(os.path.getsize(dst), method=method)
+    
+    # The copy has the same contents, so it has the same digests if the source did not change meanwhile
+    digests = cached_checksums(src_st)
+    if digests and checksum_key(os.stat(src)) == checksum_key(src_st):
+        store_checksums(dst, os.stat(dst), digests)
+    return dst
+
+def copy_tree(src, dst, progress=None):
+    """Copy a file or folder tree to dst, which must not exist; returns its size as folder sizes count it
+
+    progress, if given, is called with the bytes copied so far. Symlinks are copied as links.
+    On failure (or when progress raises, e.g. to cancel) the partial copy is removed.
+    """
+    copied = 0
+    
+    def copy_one(source, target):
+        nonlocal copied
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+            if os.path.isfile(target):
+                copied += os.path.getsize(target)  # Folder sizes follow links to files
+            return
+        base = copied
+        copy_file(source, target, (lambda n: progress(base + n)) if progress else None)
+        copied = base + os.path.getsize(target)
+    
+    try:
+        if not os.path.isdir(src) or os.path.islink(src):
+            copy_one(src, dst)
+            return copied
+        
+        folders = []
+        for root, dirs, files in os.walk(src):
+            target_root = dst + root[len(src):]
+            os.mkdir(target_root)
+            folders.append((root, target_root))
+            for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                copy_one(os.path.join(root, name), os.path.join(target_root, name))
+        # Folder times last, since filling a folder changes its mtime
+        for root, target_root in reversed(folders):
+            shutil.copystat(root, target_root)
+        return copied
+    except BaseException:
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst, ignore_errors=True)
+        elif os.path.lexists(dst):
+            os.remove(dst)
+        raise
+
+def copy_item(old_path, new_path, progress=None):
+    """Copy a file or folder to another place in BASE_DIR; returns the bytes copied"""
+    with watch_paused(new_path):
+        size = copy_tree(old_path, new_path, progress)
+        if os.path.isdir(new_path) and not os.path.islink(new_path):
+            dir_size_forget(new_path)
+        dir_size_add(new_path, size)
+        search_index_add(new_path)
+        notify_dir_change(new_path)
+    return size
+
+def remove_copy(full_path):
+    """Delete a copy for good; it is only a duplicate, so it skips the trash"""
+    with dir_size_lock:
+        size = os.path.getsize(full_path) if os.path.isfile(full_path) else dir_size_cache.get(full_path)
+    with watch_paused(full_path):
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path)
+        else:
+            os.remove(full_path)
+        if size is None:
+            dir_size_forget(full_path, parents=True)
+        else:
+            dir_size_forget(full_path)
+            dir_size_add(full_path, -size)
+        search_index_remove(full_path)
+        notify_dir_change(full_path)
+
+def purge_trash():
+    """Forget expired operations and remove trash nobody can restore anymore"""
+    with undo_lock:
+        undo_db.execute('DELETE FROM operations WHERE created < ?', (time.time() - UNDO_MAX_AGE,))
+        undo_db.commit()
+        unsized = undo_db.execute('SELECT id, trash FROM operations WHERE trash IS NOT NULL AND size IS NULL').fetchall()
+    
+    # Folders deleted before their size was known are sized here, off the request path
+    for op_id, trash_rel in unsized:
+        trash_path = os.path.join(TRASH_DIR, trash_rel)
+        size = compute_dir_sizes(trash_path).get(trash_path, 0) if os.path.isdir(trash_path) else get_file_size(trash_path)
+        with undo_lock:
+            undo_db.execute('UPDATE operations SET size = ? WHERE id = ?', (size, op_id))
+            undo_db.commit()
+    
+    with undo_lock:
+        rows = undo_db.execute('SELECT id, size FROM operations WHERE trash IS NOT NULL ORDER BY id DESC').fetchall()
+        total = 0
+        over_quota = []
+        for op_id, size in rows:
+            total += size or 0
+            if total > TRASH_MAX_BYTES:
+                over_quota.append(op_id)
+        if over_quota:
+            undo_db.executemany('DELETE FROM operations WHERE id = ?', [(op_id,) for op_id in over_quota])
+            undo_db.commit()
+        keep = {trash_rel.split('/', 1)[0] for (trash_rel,) in
+                undo_db.execute('SELECT trash FROM operations WHERE trash IS NOT NULL')}
+    
+    for slot in os.listdir(TRASH_DIR):
+        if slot not in keep:
+            slot_path = os.path.join(TRASH_DIR, slot)
+            # A slot made in the last minute may belong to a delete that is still being recorded
+            try:
+                if time.time() - os.path.getmtime(slot_path) < 60:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(slot_path, ignore_errors=True)
+
+def trash_purge_loop():
+    """Background thread purging the trash periodically and after deletes"""
+    while True:
+        trash_purge_wanted.wait(TRASH_PURGE_INTERVAL)
+        trash_purge_wanted.clear()
+        try:
+            purge_trash()
+        except Exception:
+            log.exception("Trash purge failed")
+
+def undo_operation(op):
+    """Reverse one journal entry; returns an error message if it cannot be undone"""
+    op_type = op['type']
+    
+    if op_type == 'upload':
+        # Delete uploaded files
+        for rel_path in op['files']:
+            file_path = safe_join(BASE_DIR, rel_path)
+            if os.path.isfile(file_path):
+                with watch_paused(file_path):
+                    size = os.path.getsize(file_path)
+                    os.remove(file_path)
+                    dir_size_add(file_path, -size)
+                    search_index_remove(file_path)
+                    notify_dir_change(file_path)
+    
+    elif op_type == 'create_folder':
+        # Remove created folder, unless something was put into it since
+        folder_path = safe_join(BASE_DIR, op['path'])
+        if os.path.isdir(folder_path):
+            if os.listdir(folder_path):
+                return f"Folder {op['path']} is no longer empty"
+            with watch_paused(folder_path):
+                os.rmdir(folder_path)
+                dir_size_forget(folder_path)
+                search_index_remove(folder_path)
+                notify_dir_change(folder_path)
+    
+    elif op_type == 'delete':
+        # Move back out of the trash
+        original_path = safe_join(BASE_DIR, op['path'])
+        trash_path = os.path.join(TRASH_DIR, op['trash'])
+        if not os.path.lexists(trash_path):
+            return f"{op['path']} is no longer in the trash"
+        if os.path.lexists(original_path):
+            return f"{op['path']} exists again"
+        if not os.path.isdir(os.path.dirname(original_path)):
+            return f"Folder of {op['path']} no longer exists"
+        with watch_paused(original_path):
+            try:
+                os.rename(trash_path, original_path)
+            except OSError as e:
+                if e.errno != 18:  # EXDEV
+                    raise
+                shutil.move(trash_path, original_path)
+            if op['size'] is None:
+                dir_size_forget(original_path, parents=True)
+            else:
+                dir_size_add(original_path, op['size'])
+            search_index_add(original_path)
+            notify_dir_change(original_path)
+        shutil.rmtree(os.path.dirname(trash_path), ignore_errors=True)
+    
+    elif op_type == 'rename':
+        # Restore original name
+        old_path, new_path = safe_join(BASE_DIR, op['old_path']), safe_join(BASE_DIR, op['new_path'])
+        if not os.path.lexists(new_path):
+            return f"{op['new_path']} no longer exists"
+        if os.path.lexists(old_path):
+            return f"{op['old_path']} exists again"
+        with watch_paused(new_path, old_path):
+            os.rename(new_path, old_path)
+            dir_size_move(new_path, old_path)
+            search_index_move(new_path, old_path)
+            notify_dir_change(old_path, old_path=new_path)
+    
+    elif op_type == 'move':
+        # Move back to where it was
+        old_path, new_path = safe_join(BASE_DIR, op['old_path']), safe_join(BASE_DIR, op['new_path'])
+        if not os.path.lexists(new_path):
+            return f"{op['new_path']} no longer exists"
+        if os.path.lexists(old_path):
+            return f"{op['old_path']} exists again"
+        if not os.path.isdir(os.path.dirname(old_path)):
+            return f"Folder of {op['old_path']} no longer exists"
+        move_item(new_path, old_path)
+    
+    elif op_type == 'copy':
+        # Remove the copy
+        copy_path = safe_join(BASE_DIR, op['path'])
+        if not os.path.lexists(copy_path):
+            return f"{op['path']} no longer exists"
+        remove_copy(copy_path)
+    
+    elif op_type == 'bulk':
+        # Undo every step, last first; steps that cannot be undone are reported together
+        errors = []
+        with dir_deltas_held():
+            for step in reversed(op['steps']):
+                error = undo_operation(step)
+                if error:
+                    errors.append(error)
+        if errors:
+            more = f" and {len(errors) - 3} more" if len(errors) > 3 else ''
+            return '; '.join(errors[:3]) + more
+        if op['trash']:
+            shutil.rmtree(os.path.join(TRASH_DIR, op['trash']), ignore_errors=True)
+    
+    return None
+
+def describe_operation(op):
+    """Short human-readable summary of a journal entry"""
+    if op['type'] == 'upload':
+        names = [rel_path.rpartition('/')[2] for rel_path in op['files']]
+        return f"upload of {names[0]}" if len(names) == 1 else f"upload of {len(names)} files"
+    if op['type'] == 'create_folder':
+        return f"creation of folder {op['path'].rpartition('/')[2]}"
+    if op['type'] == 'delete':
+        return f"deletion of {op['path'].rpartition('/')[2]}"
+    if op['type'] == 'rename':
+        return f"rename of {op['old_path'].rpartition('/')[2]} to {op['new_path'].rpartition('/')[2]}"
+    if op['type'] == 'move':
+        return f"move of {op['old_path'].rpartition('/')[2]}"
+    if op['type'] == 'copy':
+        return f"copy of {op['path'].rpartition('/')[2]}"
+    if op['type'] == 'bulk':
+        count = len(op['steps'])
+        action = {'delete': 'deletion', 'move': 'move', 'copy': 'copy'}[op['action']]
+        return f"{action} of {count} item{'s' if count != 1 else ''}"
+    return op['type']
+
+# Checksums: digests of the files in BASE_DIR, so transfers can be verified without the server
+# reading a file again. They are cached in SQLite under the file's device and inode with its
+# size and mtime, so renames and moves keep them and a changed file simply misses the cache.
+# Uploads are hashed as they arrive, a background scan hashes the rest on CHECKSUM_WORKERS
+# threads (hashlib releases the GIL while it hashes), and anything still missing is hashed
+# when asked for. All algorithms are computed in the same read of a file.
+CHECKSUM_HASHES = {'sha256': hashlib.sha256, 'md5': hashlib.md5}
+if xxhash is not None:
+    CHECKSUM_HASHES['xxh128'] = xxhash.xxh3_128
+checksum_algorithms = tuple(dict.fromkeys(['sha256'] + [a for a in CHECKSUM_ALGORITHMS if a in CHECKSUM_HASHES]))
+checksum_lock = threading.Lock()
+checksum_db = sqlite3.connect(CHECKSUM_DB, check_same_thread=False, timeout=30)
+checksum_db.execute('PRAGMA journal_mode=WAL')
+checksum_db.executescript('''
+    CREATE TABLE IF NOT EXISTS checksums (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        algorithm TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (dev, ino, algorithm)
+    );
+    CREATE TABLE IF NOT EXISTS checksum_folders (folder BLOB PRIMARY KEY, generation INTEGER NOT NULL);
+''')
+checksum_db.commit()
+checksum_executor = ThreadPoolExecutor(max_workers=CHECKSUM_WORKERS, thread_name_prefix='checksum')
+checksum_scan_wanted = threading.Event()
+upload_hashes = {}  # Chunked upload ID -> digests of the part that arrived without gaps, in this process
+upload_hashes_lock = threading.Lock()
+checksum_hashed_bytes = Metric('pfshare_checksum_hashed_bytes_total', 'counter', 'Bytes read to compute checksums', ('source',))
+checksum_lookups_total = Metric('pfshare_checksum_lookups_total', 'counter', 'Checksum requests by digest cache result', ('result',))
+
+def new_hashers(algorithms=None):
+    """Fresh hash objects, {algorithm: hash}, for the given or all enabled algorithms"""
+    return {algorithm: CHECKSUM_HASHES[algorithm]() for algorithm in algorithms or checksum_algorithms}
+
+def hash_file(path, algorithms=None, progress=None, source='request'):
+    """Digests of a file's contents in one read, {algorithm: hex digest}
+
+    progress, if given, is called with the bytes hashed so far.
+    """
+    hashers = new_hashers(algorithms)
+    done = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            for hasher in hashers.values():
+                hasher.update(chunk)
+            done += len(chunk)
+            if progress:
+                progress(done)
+    checksum_hashed_bytes.inc(done, source=source)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+def save_hashed(stream, file_path):
+    """Write an upload stream to a file while hashing it; returns (size, {algorithm: hex digest})"""
+    hashers = new_hashers()
+    size = 0
+    with open(file_path, 'wb') as f:
+        while True:
+            chunk = stream.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            for hasher in hashers.values():
+                hasher.update(chunk)
+            size += len(chunk)
+    checksum_hashed_bytes.inc(size, source='upload')
+    return size, {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+def checksum_key(st):
+    """Cache key of a file in the state a stat result shows"""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def cached_checksums(st):
+    """Cached digests of a file unchanged since st was taken, {algorithm: hex digest}"""
+    with checksum_lock:
+        rows = checksum_db.execute(
+            'SELECT algorithm, digest FROM checksums WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+            checksum_key(st)).fetchall()
+    return dict(rows)
+
+def store_checksums(full_path, st, digests):
+    """Cache digests of a file as it was when st was taken, and bump its folder's checksum generation"""
+    with checksum_lock:
+        checksum_db.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                                [(*checksum_key(st), algorithm, digest) for algorithm, digest in digests.items()])
+        checksum_db.execute('INSERT INTO checksum_folders VALUES (?, 1) '
+                            'ON CONFLICT (folder) DO UPDATE SET generation = generation + 1',
+                            (os.fsencode(os.path.dirname(full_path)),))
+        checksum_db.commit()
+
+def checksum_generation(folder):
+    """Count of digests stored for files in a folder, which listings use as the version of their checksums"""
+    with checksum_lock:
+        row = checksum_db.execute('SELECT generation FROM checksum_folders WHERE folder = ?',
+                                  (os.fsencode(folder),)).fetchone()
+    return row[0] if row else 0
+
+def file_checksums(full_path, progress=None, source='request'):
+    """Digests of a file, {algorithm: hex digest}, from the cache or hashed now and cached"""
+    st = os.stat(full_path)
+    digests = cached_checksums(st)
+    missing = [algorithm for algorithm in checksum_algorithms if algorithm not in digests]
+    if not missing:
+        checksum_lookups_total.inc(result='hit')
+        return digests
+    
+    checksum_lookups_total.inc(result='miss')
+    digests.update(hash_file(full_path, missing, progress, source))
+    # A file written to while it was read has no single digest to remember
+    if checksum_key(os.stat(full_path)) == checksum_key(st):
+        store_checksums(full_path, st, {algorithm: digests[algorithm] for algorithm in missing})
+    return digests
+
+def listed_checksums(full_paths, algorithm=CHECKSUM_LISTED):
+    """Cached digests of listed files, {full path: hex digest}; files without one are left out"""
+    keys = {}
+    for full_path in full_paths:
+        try:
+            # Hard links (deduplicated files) share an inode, and so a digest
+            keys.setdefault(checksum_key(os.stat(full_path)), []).append(full_path)
+        except OSError:
+            continue
+    # By device, so the lookups use the (dev, ino, algorithm) primary key
+    inodes = {}
+    for dev, ino, size, mtime_ns in keys:
+        inodes.setdefault(dev, set()).add(ino)
+    found = {}
+    for dev, dev_inodes in inodes.items():
+        dev_inodes = list(dev_inodes)
+        for i in range(0, len(dev_inodes), 500):
+            batch = dev_inodes[i:i + 500]
+            with checksum_lock:
+                rows = checksum_db.execute(
+                    f"SELECT ino, size, mtime_ns, digest FROM checksums "
+                    f"WHERE dev = ? AND ino IN ({','.join('?' * len(batch))}) AND algorithm = ?",
+                    (dev, *batch, algorithm)).fetchall()
+            for ino, size, mtime_ns, digest in rows:
+                for full_path in keys.get((dev, ino, size, mtime_ns), ()):
+                    found[full_path] = digest
+    return found
+
+def checksum_many(full_paths, source='request'):
+    """(full path, digests) for each file in order, hashing CHECKSUM_WORKERS at a time; unreadable files are skipped"""
+    pending = deque()
+    
+    def result(entry):
+        try:
+            return entry[0], entry[1].result()
+        except OSError:
+            return None
+    
+    try:
+        for full_path in full_paths:
+            pending.append((full_path, checksum_executor.submit(file_checksums, full_path, None, source)))
+            if len(pending) >= CHECKSUM_WORKERS * 4:
+                done = result(pending.popleft())
+                if done:
+                    yield done
+        while pending:
+            done = result(pending.popleft())
+            if done:
+                yield done
+    finally:
+        for full_path, future in pending:
+            future.cancel()
+
+def advance_upload_hash(upload):
+    """Hash the start of a chunked upload that has arrived without gaps, so completing it reads little
+
+    The digests live in this process; a chunk handled by another worker is left to the
+    next chunk here, or to upload_digests() when the upload is completed.
+    """
+    received = upload['received']
+    end = received[0][1] if received and received[0][0] == 0 else 0
+    with upload_hashes_lock:
+        state = upload_hashes.setdefault(upload['id'], {'offset': 0, 'hashers': new_hashers(), 'lock': threading.Lock()})
+    if end <= state['offset'] or not state['lock'].acquire(blocking=False):
+        return  # Nothing new in order, or another request is hashing it already
+    try:
+        hash_upload_part(upload, state, end)
+    except OSError:
+        pass  # Completing the upload hashes whatever is left
+    finally:
+        state['lock'].release()
+
+def hash_upload_part(upload, state, end):
+    """Feed the part file of a chunked upload from state's offset up to end into its digests"""
+    with open(upload_part_path(upload['id']), 'rb') as f:
+        f.seek(state['offset'])
+        while state['offset'] < end:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, end - state['offset']))
+            if not chunk:
+                break
+            for hasher in state['hashers'].values():
+                hasher.update(chunk)
+            state['offset'] += len(chunk)
+            checksum_hashed_bytes.inc(len(chunk), source='upload')
+
+def forget_upload_hash(upload_id, publish=True):
+    """Drop the digests of a finished or abandoned chunked upload, in every worker that hashed some of it"""
+    if publish:
+        bus_publish('upload_hash_forget', upload_id)
+    with upload_hashes_lock:
+        upload_hashes.pop(upload_id, None)
+
+BUS_HANDLERS['upload_hash_forget'] = lambda upload_id: forget_upload_hash(upload_id, publish=False)
+
+def upload_digests(upload):
+    """Digests of a complete chunked upload, {algorithm: hex digest}, hashing only what was not hashed yet"""
+    with upload_hashes_lock:
+        state = upload_hashes.pop(upload['id'], None) or {'offset': 0, 'hashers': new_hashers(), 'lock': threading.Lock()}
+    with state['lock']:
+        hash_upload_part(upload, state, upload['size'])
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in state['hashers'].items()}
+
+def checksum_scan():
+    """Hash the files in BASE_DIR the cache does not know in their current state, and forget removed ones"""
+    started = time.time()
+    with checksum_lock:
+        counts = checksum_db.execute('SELECT dev, ino, size, mtime_ns, COUNT(*) FROM checksums GROUP BY dev, ino').fetchall()
+    known = {(dev, ino, size, mtime_ns) for dev, ino, size, mtime_ns, count in counts if count >= len(checksum_algorithms)}
+    seen = set()
+    
+    def unknown_files():
+        for dirpath, dirnames, filenames in os.walk(BASE_DIR):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(file_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                if checksum_key(st) not in known:
+                    yield file_path
+    
+    hashed = 0
+    for full_path, digests in checksum_many(unknown_files(), source='scan'):
+        hashed += 1
+    
+    with checksum_lock:
+        gone = [(dev, ino) for dev, ino, size, mtime_ns, count in counts if (dev, ino) not in seen]
+        checksum_db.executemany('DELETE FROM checksums WHERE dev = ? AND ino = ?', gone)
+        checksum_db.commit()
+    log.info("Checksum scan finished", extra={'hashed': hashed, 'forgotten': len(gone),
+                                              'seconds': round(time.time() - started, 1)})
+
+def checksum_scan_loop():
+    """Background thread scanning BASE_DIR at startup and then periodically"""
+    while True:
+        try:
+            checksum_scan()
+        except Exception:
+            log.exception("Checksum scan failed")
+        checksum_scan_wanted.wait(CHECKSUM_SCAN_INTERVAL)
+        checksum_scan_wanted.clear()
+
+def checksum_job(job, full_path):
+    """Job: digests of one file, hashing it if they are not cached"""
+    size = os.path.getsize(full_path)
+    digests = file_checksums(full_path, progress=lambda done: job_progress(job, done, size))
+    return {'path': search_rel_path(full_path), 'size': size, 'checksums': digests}
+
+def manifest_line(digest, rel_path):
+    """A line of a sha256sum-style manifest; names with a backslash or newline are escaped like GNU coreutils does"""
+    escaped = rel_path.replace('\\', '\\\\').replace('\n', '\\n')
+    if escaped != rel_path:
+        return f"\\{digest}  {escaped}\n"
+    return f"{digest}  {rel_path}\n"
+
+# Deduplication: uploads are hashed while they are written and looked up in a persistent
+# SHA-256 index of BASE_DIR. A duplicate is replaced by a reflink (a copy-on-write clone on
+# btrfs, XFS and the like) or a hard link to the existing copy. Hard-linked copies share one
+# inode, so an in-place edit of one shows up in all of them; PFshare itself never edits in place.
+# A background scan hashes files that reached BASE_DIR some other way and links them too.
+FICLONE = 0x40049409  # Linux ioctl sharing a file's extents with another file
+dedup_lock = threading.Lock()
+dedup_db = sqlite3.connect(DEDUP_DB, check_same_thread=False, timeout=30)
+dedup_db.execute('PRAGMA journal_mode=WAL')
+dedup_db.executescript('''
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        hash TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        cloned INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS files_hash ON files(hash, size);
+    CREATE TABLE IF NOT EXISTS dedup_meta (key TEXT PRIMARY KEY, value TEXT);
+''')
+dedup_db.commit()
+dedup_scan_wanted = threading.Event()
+dedup_saved_bytes = Metric('pfshare_dedup_saved_bytes_total', 'counter', 'Bytes not stored again thanks to deduplication')
+
+def dedup_record(full_path, digest, st, cloned=False):
+    """Remember the content hash of a file as it is on disk now"""
+    with dedup_lock:
+        dedup_db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (search_rel_path(full_path), digest, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, int(cloned)))
+        dedup_db.commit()
+
+def dedup_find(digest, size, exclude=None):
+    """An indexed file with this content that is unchanged since it was hashed: (path, stat) or None"""
+    with dedup_lock:
+        rows = dedup_db.execute('SELECT path, mtime_ns, dev, ino FROM files WHERE hash = ? AND size = ?',
+                                (digest, size)).fetchall()
+    match = None
+    stale = []
+    for rel_path, mtime_ns, dev, ino in rows:
+        path = safe_join(BASE_DIR, rel_path)
+        if path == exclude:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            stale.append(rel_path)
+            continue
+        if (st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino) != (size, mtime_ns, dev, ino):
+            stale.append(rel_path)
+            continue
+        match = (path, st)
+        break
+    if stale:
+        with dedup_lock:
+            dedup_db.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in stale])
+            dedup_db.commit()
+    return match
+
+def dedup_clone(source):
+    """Reflink or hard-link a file to a new temporary path; returns (path, 'reflink'/'hardlink') or (None, None)"""
+    tmp = os.path.join(UPLOAD_TMP_DIR, f"dedup-{secrets.token_hex(8)}")
+    if DEDUP_LINK in ('auto', 'reflink') and fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(tmp, 'xb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return tmp, 'reflink'
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    if DEDUP_LINK in ('auto', 'hardlink'):
+        try:
+            os.link(source, tmp)
+            return tmp, 'hardlink'
+        except OSError:
+            pass  # Another filesystem, no link support, or too many links to the source
+    return None, None
+
+def dedup_replace(full_path, digest, st):
+    """Turn a file into a link to an existing copy of its contents; returns the bytes saved"""
+    match = dedup_find(digest, st.st_size, exclude=full_path)
+    if match is None or (match[1].st_dev, match[1].st_ino) == (st.st_dev, st.st_ino):
+        dedup_record(full_path, digest, st)
+        return 0
+    
+    tmp, method = dedup_clone(match[0])
+    if tmp is None:
+        dedup_record(full_path, digest, st)
+        return 0
+    try:
+        if method == 'reflink':
+            shutil.copystat(full_path, tmp)
+        os.replace(tmp, full_path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        dedup_record(full_path, digest, st)
+        return 0
+    
+    dedup_record(full_path, digest, os.stat(full_path), cloned=method == 'reflink')
+    dedup_saved_bytes.inc(st.st_size)
+    return st.st_size
+
+def dedup_stats():
+    """Files in the hash index and the bytes deduplication saves"""
+    with dedup_lock:
+        files, logical, cloned = dedup_db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * cloned), 0) FROM files').fetchone()
+        physical = dedup_db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM files GROUP BY dev, ino)').fetchone()[0]
+        last_scan = dedup_db.execute("SELECT value FROM dedup_meta WHERE key = 'last_scan'").fetchone()
+    # Hard links show up as one inode for several paths; reflinked copies are counted as shared
+    saved = logical - physical + cloned
+    return {
+        'files': files,
+        'saved_bytes': saved,
+        'saved_formatted': format_file_size(saved),
+        'last_scan': float(last_scan[0]) if last_scan else None
+    }
+
+def dedup_scan():
+    """Hash files the index does not know in their current state and link duplicates together"""
+    started = time.time()
+    with dedup_lock:
+        known = {path: (size, mtime_ns, ino) for path, size, mtime_ns, ino in
+                 dedup_db.execute('SELECT path, size, mtime_ns, ino FROM files')}
+    seen = set()
+    saved = 0
+    for dirpath, dirnames, filenames in os.walk(BASE_DIR):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(file_path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_size < DEDUP_MIN_SIZE:
+                continue
+            rel_path = search_rel_path(file_path)
+            seen.add(rel_path)
+            if known.get(rel_path) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                continue
+            try:
+                digest = file_checksums(file_path, source='dedup')['sha256']
+                with watch_paused(file_path):
+                    current = os.lstat(file_path)
+                    if (current.st_size, current.st_mtime_ns, current.st_ino) != (st.st_size, st.st_mtime_ns, st.st_ino):
+                        continue  # Changed while it was being hashed; the next scan picks it up
+                    file_saved = dedup_replace(file_path, digest, st)
+                    if file_saved:
+                        search_index_add(file_path, recursive=False)
+                        notify_dir_change(file_path)
+                saved += file_saved
+            except OSError:
+                continue
+    
+    with dedup_lock:
+        gone = [(path,) for path in known if path not in seen]
+        dedup_db.executemany('DELETE FROM files WHERE path = ?', gone)
+        dedup_db.execute("INSERT OR REPLACE INTO dedup_meta VALUES ('last_scan', ?)", (str(started),))
+        dedup_db.commit()
+    log.info("Deduplication scan finished", extra={'saved': saved, 'seconds': round(time.time() - started, 1)})
+
+def dedup_scan_loop():
+    """Background thread scanning BASE_DIR at startup, periodically and on request"""
+    while True:
+        try:
+            dedup_scan()
+        except Exception:
+            log.exception("Deduplication scan failed")
+        dedup_scan_wanted.wait(DEDUP_SCAN_INTERVAL)
+        dedup_scan_wanted.clear()
+
+BUS_HANDLERS['dedup_scan'] = lambda: dedup_scan_wanted.set()
+
+def format_file_size(size_bytes):
+    """Convert bytes to human readable format"""
+    if size_bytes == 0:
+        return "0 B"
+    size_names = ["B", "KB", "MB", "GB", "TB"]
+    i = 0
+    while size_bytes >= 1024 and i < len(size_names) - 1:
+        size_bytes /= 1024.0
+        i += 1
+    return f"{size_bytes:.1f} {size_names[i]}"
+
+def get_file_icon(filename):
+    """Get appropriate icon class for file type"""
+    ext = os.path.splitext(filename)[1].lower()
+    icon_map = {
+        # Images
+        '.jpg': 'fas fa-image', '.jpeg': 'fas fa-image', '.png': 'fas fa-image',
+        '.gif': 'fas fa-image', '.bmp': 'fas fa-image', '.svg': 'fas fa-image',
+        # Videos
+        '.mp4': 'fas fa-video', '.avi': 'fas fa-video', '.mkv': 'fas fa-video',
+        '.mov': 'fas fa-video', '.wmv': 'fas fa-video', '.flv': 'fas fa-video',
+        # Audio
+        '.mp3': 'fas fa-music', '.wav': 'fas fa-music', '.flac': 'fas fa-music',
+        '.aac': 'fas fa-music', '.ogg': 'fas fa-music',
+        # Documents
+        '.pdf': 'fas fa-file-pdf', '.doc': 'fas fa-file-word', '.docx': 'fas fa-file-word',
+        '.xls': 'fas fa-file-excel', '.xlsx': 'fas fa-file-excel',
+        '.ppt': 'fas fa-file-powerpoint', '.pptx': 'fas fa-file-powerpoint',
+        '.txt': 'fas fa-file-alt', '.md': 'fas fa-file-alt', '.rtf': 'fas fa-file-alt',
+        # Code
+        '.py': 'fas fa-file-code', '.js': 'fas fa-file-code', '.html': 'fas fa-file-code',
+        '.css': 'fas fa-file-code', '.php': 'fas fa-file-code', '.cpp': 'fas fa-file-code',
+        '.java': 'fas fa-file-code', '.c': 'fas fa-file-code',
+        # Archives
+        '.zip': 'fas fa-file-archive', '.rar': 'fas fa-file-archive', '.7z': 'fas fa-file-archive',
+        '.tar': 'fas fa-file-archive', '.gz': 'fas fa-file-archive',
+    }
+    return icon_map.get(ext, 'fas fa-file')
+
+def get_zip_compression(filename):
+    """Pick the ZIP compression method for a file based on its extension"""
+    ext = os.path.splitext(filename)[1].lower()
+    return zipfile.ZIP_STORED if ext in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+def content_disposition(disposition, filename):
+    """Build a Content-Disposition header value that survives Unicode filenames"""
+    try:
+        filename.encode('ascii')
+        return f'{disposition}; filename="{filename}"'
+    except UnicodeEncodeError:
+        fallback = secure_filename(filename) or 'download'
+        return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+def read_file_range(path, start, length):
+    """Yield length bytes of a file starting at start"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def parse_byte_ranges(size):
+    """Resolve the request's Range header to (start, end) pairs, end exclusive
+
+    Returns None when the whole file should be sent and [] when no range can be satisfied.
+    """
+    rng = request.range
+    if rng is None or rng.units != 'bytes' or len(rng.ranges) > MAX_RANGES:
+        return None
+    
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+# Files shown inline run on this origin, so only media types are shown as they are. Other
+# text is shown as plain text and the rest downloaded; uploads need no login, so an uploaded
+# page must never render as one. SVG can hold scripts, but the sandbox policy sent with every
+# inline file keeps them from running when one is opened directly, and <img> never runs them.
+INLINE_MEDIA_PREFIXES = ('image/', 'video/', 'audio/')
+INLINE_TEXT_TYPES = {'application/json', 'application/xml', 'application/javascript', 'application/x-sh'}
+INLINE_HEADERS = {'X-Content-Type-Options': 'nosniff', 'Content-Security-Policy': 'sandbox'}
+
+def inline_type(name):
+    """Content type and disposition for showing a file inline: (mimetype, 'inline' or 'attachment')"""
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if mimetype.startswith(INLINE_MEDIA_PREFIXES):
+        return mimetype, 'inline'
+    if mimetype.startswith('text/') or mimetype in INLINE_TEXT_TYPES:
+        return 'text/plain', 'inline'
+    return mimetype, 'attachment'
+
+def send_file_ranged(full_path, download_name=None, as_attachment=True):
+    """Send a file with ETag/Last-Modified validation and single or multi-range support
+
+    Whole files and single ranges go out through the WSGI server's file wrapper, so servers
+    such as gunicorn can use sendfile(2) instead of copying the bytes through Python.
+    """
+    st = os.stat(full_path)
+    size = st.st_size
+    etag = f"{st.st_ino:x}-{size:x}-{st.st_mtime_ns:x}"
+    name = download_name or os.path.basename(full_path)
+    if as_attachment:
+        mimetype, disposition = mimetypes.guess_type(full_path)[0] or 'application/octet-stream', 'attachment'
+    else:
+        mimetype, disposition = inline_type(name)
+    
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(int(st.st_mtime)),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-cache',  # Always revalidate, which is cheap thanks to the validators
+        'Content-Disposition': content_disposition(disposition, name),
+    }
+    if not as_attachment:
+        headers.update(INLINE_HEADERS)
+    
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+    
+    ranges = None
+    if request.range is not None and (request.if_range.etag is None or request.if_range.etag == etag):
+        if request.if_range.date is None or last_modified <= request.if_range.date:
+            ranges = parse_byte_ranges(size)
+    
+    if ranges == []:
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+    
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    
+    if ranges and len(ranges) > 1:
+        boundary = secrets.token_hex(16)
+        parts = [(
+            f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode('ascii') for start, stop in ranges]
+        closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+        
+        def generate():
+            for i, (start, stop) in enumerate(ranges):
+                yield (b'\r\n' if i else b'') + parts[i]
+                yield from read_file_range(full_path, start, stop - start)
+            yield closing
+        
+        headers['Content-Length'] = str(
+            sum(len(part) for part in parts) + 2 * (len(parts) - 1) + len(closing)
+            + sum(stop - start for start, stop in ranges)
+        )
+        return Response(generate(), status=206, headers=headers,
+                        mimetype=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
+    
+    if ranges:
+        start, stop = ranges[0]
+        status = 206
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        start, stop = 0, size
+        status = 200
+    headers['Content-Length'] = str(stop - start)
+    
+    if USE_X_SENDFILE and status == 200 and not shaping_downloads():
+        headers['X-Sendfile'] = full_path
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    
+    # Plain WSGI file wrappers read to EOF, so ranges only use them where Content-Length is honoured
+    server = request.environ.get('SERVER_SOFTWARE', '')
+    if file_wrapper is not None and not shaping_downloads() and (status == 200 or server.startswith(SENDFILE_RANGE_SERVERS)):
+        f = open(full_path, 'rb')
+        f.seek(start)
+        body = wrap_file(request.environ, f, DOWNLOAD_CHUNK_SIZE)
+    else:
+        body = read_file_range(full_path, start, stop - start)
+    
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+# Folder ZIPs are written by a small ZIP writer of our own so that entries can be deflated
+# in parallel: files are cut into ZIP_CHUNK_SIZE chunks, the process pool deflates them
+# independently and the chunks are joined into one deflate stream per entry. Finished
+# archives are kept in ZIP_CACHE_DIR under a fingerprint of the folder's contents.
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_VERSION_MADE_BY = (3 << 8) | 45  # Unix, ZIP 4.5
+zip_executor = None
+zip_executor_lock = threading.Lock()
+crc32_zero_ops = None  # crc32_zero_ops[k] appends 2**k zero bytes to a CRC-32
+zip_cache_total = Metric('pfshare_zip_cache_total', 'counter', 'Folder ZIP requests by archive cache result', ('result',))
+
+def gf2_times(matrix, vector):
+    """Multiply a 32x32 GF(2) matrix, given as its columns, by a 32-bit vector"""
+    total = 0
+    for column in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= column
+        vector >>= 1
+    return total
+
+def crc32_combine(crc1, crc2, length2):
+    """CRC-32 of A followed by B from the CRC-32s of A and B and the length of B"""
+    global crc32_zero_ops
+    if crc32_zero_ops is None:
+        op = [0xEDB88320] + [1 << n for n in range(31)]  # One zero bit
+        for _ in range(3):
+            op = [gf2_times(op, column) for column in op]
+        ops = []
+        for _ in range(64):
+            ops.append(op)
+            op = [gf2_times(op, column) for column in op]
+        crc32_zero_ops = ops
+    k = 0
+    while length2:
+        if length2 & 1:
+            crc1 = gf2_times(crc32_zero_ops[k], crc1)
+        length2 >>= 1
+        k += 1
+    return crc1 ^ crc2
+
+def deflate_zip_chunk(path, offset, length, level, last):
+    """Process pool worker: raw-deflate one chunk of a file; returns (data, crc, length)
+
+    Every chunk but a file's last ends on a sync flush, which leaves the stream byte
+    aligned and unfinished, so the chunks can simply be concatenated.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+    except OSError:
+        data = b''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, zlib.crc32(data), len(data)
+
+def submit_zip_chunk(*args):
+    """Deflate a chunk on the ZIP process pool, or right away with ZIP_WORKERS = 0"""
+    global zip_executor
+    if ZIP_WORKERS <= 0:
+        future = Future()
+        future.set_result(deflate_zip_chunk(*args))
+        return future
+    with zip_executor_lock:
+        if zip_executor is None:
+            zip_executor = ProcessPoolExecutor(max_workers=ZIP_WORKERS)
+    return zip_executor.submit(deflate_zip_chunk, *args)
+
+def zip_dos_time(mtime):
+    """(time, date) fields of a ZIP entry; dates before 1980 are clamped like zipfile does"""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    year = min(t.tm_year, 2107)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def zip_entries(full_path, selected=None):
+    """Files of a folder ZIP as (path, archive name, stat) in a stable order
+
+    selected limits the archive to some files and folders below full_path. Also returns
+    the total size and a fingerprint of the names, sizes, modes and modification times,
+    which keys the archive cache.
+    """
+    def walk(top):
+        if not os.path.isdir(top):
+            yield os.path.dirname(top), [os.path.basename(top)]
+            return
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            yield root, sorted(files)
+    
+    entries = []
+    total = 0
+    digest = hashlib.sha256(f"level={ZIP_COMPRESSION_LEVEL}\n".encode())
+    for top in sorted(selected) if selected else [full_path]:
+        for root, files in walk(top):
+            for name in files:
+                file_path = os.path.join(root, name)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode) or not os.access(file_path, os.R_OK):
+                    continue
+                arc_name = os.path.relpath(file_path, full_path).replace(os.sep, '/')
+                entries.append((file_path, arc_name, st))
+                total += st.st_size
+                digest.update(f"{arc_name}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_mode}\n".encode('utf-8', 'surrogateescape'))
+    return entries, total, digest.hexdigest()
+
+def generate_zip(entries, progress=None):
+    """Yield a ZIP of entries from zip_entries(), deflating up to ZIP_WORKERS chunks at once
+
+    Sizes and CRCs follow each entry in a data descriptor, so nothing needs to seek and the
+    archive can be sent while it is built. ZIP64 records are used where sizes need them.
+    progress, if given, is called with the number of file bytes archived so far.
+    """
+    started = time.perf_counter()
+    
+    def chunk_tasks():
+        for file_path, arc_name, st in entries:
+            if get_zip_compression(arc_name) == zipfile.ZIP_DEFLATED:
+                count = max(1, -(-st.st_size // ZIP_CHUNK_SIZE))
+                for n in range(count):
+                    yield file_path, n * ZIP_CHUNK_SIZE, ZIP_CHUNK_SIZE, ZIP_COMPRESSION_LEVEL, n == count - 1
+    
+    tasks = chunk_tasks()
+    in_flight = deque()  # (last chunk of its file, Future) in archive order
+    
+    def next_chunk():
+        while len(in_flight) < max(ZIP_WORKERS, 1) * 4:
+            task = next(tasks, None)
+            if task is None:
+                break
+            in_flight.append((task[-1], submit_zip_chunk(*task)))
+        return in_flight.popleft()
+    
+    pending = bytearray()
+    offset = 0
+    archived = 0
+    central = []
+    for file_path, arc_name, st in entries:
+        name = arc_name.encode('utf-8', 'surrogateescape')
+        deflated = get_zip_compression(arc_name) == zipfile.ZIP_DEFLATED
+        zip64 = st.st_size * 1.05 > ZIP64_LIMIT
+        dostime, dosdate = zip_dos_time(st.st_mtime)
+        flags = 0x08 | 0x800  # Data descriptor follows, UTF-8 name
+        method = 8 if deflated else 0
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        unknown = ZIP64_LIMIT if zip64 else 0
+        header_offset = offset
+        header = struct.pack('<I5H3I2H', 0x04034b50, 45 if zip64 else 20, flags, method, dostime, dosdate,
+                             0, unknown, unknown, len(name), len(extra))
+        pending += header + name + extra
+        
+        crc = size = compressed = 0
+        if deflated:
+            last = False
+            while not last:
+                last, future = next_chunk()
+                data, chunk_crc, length = future.result()
+                crc = crc32_combine(crc, chunk_crc, length)
+                size += length
+                compressed += len(data)
+                pending += data
+                if progress:
+                    progress(archived + size)
+                if len(pending) >= ZIP_CHUNK_SIZE:
+                    yield bytes(pending)
+                    pending.clear()
+        else:
+            try:
+                with open(file_path, 'rb') as src:
+                    while size < st.st_size:
+                        data = src.read(min(ZIP_CHUNK_SIZE, st.st_size - size))
+                        if not data:
+                            break
+                        crc = zlib.crc32(data, crc)
+                        size += len(data)
+                        pending += data
+                        if progress:
+                            progress(archived + size)
+                        if len(pending) >= ZIP_CHUNK_SIZE:
+                            yield bytes(pending)
+                            pending.clear()
+            except OSError:
+                pass
+            compressed = size
+        archived += size
+        
+        descriptor = struct.pack('<IIQQ' if zip64 else '<IIII', 0x08074b50, crc, compressed, size)
+        pending += descriptor
+        offset += len(header) + len(name) + len(extra) + compressed + len(descriptor)
+        central.append((name, zip64, flags, method, dostime, dosdate, crc, compressed, size, header_offset, st.st_mode))
+    
+    cd_offset = offset
+    for name, zip64, flags, method, dostime, dosdate, crc, compressed, size, header_offset, mode in central:
+        values = []
+        if size >= ZIP64_LIMIT:
+            values.append(size)
+            size = ZIP64_LIMIT
+        if compressed >= ZIP64_LIMIT:
+            values.append(compressed)
+            compressed = ZIP64_LIMIT
+        if header_offset >= ZIP64_LIMIT:
+            values.append(header_offset)
+            header_offset = ZIP64_LIMIT
+        extra = struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+        record = struct.pack('<I6H3I5H2I', 0x02014b50, ZIP_VERSION_MADE_BY, 45 if zip64 or values else 20,
+                             flags, method, dostime, dosdate, crc, compressed, size,
+                             len(name), len(extra), 0, 0, 0, (mode & 0xFFFF) << 16, header_offset)
+        pending += record + name + extra
+        offset += len(record) + len(name) + len(extra)
+    
+    cd_size = offset - cd_offset
+    count = len(central)
+    if count >= 0xFFFF or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+        pending += struct.pack('<IQ2H2I4Q', 0x06064b50, 44, ZIP_VERSION_MADE_BY, 45, 0, 0,
+                               count, count, cd_size, cd_offset)
+        pending += struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+        offset += 56 + 20
+    pending += struct.pack('<I4H2IH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                           min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0)
+    offset += 22
+    yield bytes(pending)
+    zip_build_seconds.observe(time.perf_counter() - started)
+    zip_size_bytes.observe(offset)
+
+def zip_cache_path(fingerprint):
+    """Where the archive of a folder with this fingerprint is cached"""
+    return os.path.join(ZIP_CACHE_DIR, f"{fingerprint}.zip")
+
+def claim_zip_build(cache_path):
+    """Take on building cache_path: (fd, part_path) if the caller is to write the partial file,
+    (None, part_path) if another build is writing it, or (None, None) once it is in the cache
+    """
+    part_path = f"{cache_path}.part"
+    os.makedirs(ZIP_CACHE_DIR, exist_ok=True)
+    while not os.path.exists(cache_path):
+        try:
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(part_path).st_mtime < ZIP_STALL_TIMEOUT:
+                    return None, part_path
+                os.remove(part_path)  # Left behind by a build that died
+            except FileNotFoundError:
+                pass
+            continue
+        return fd, part_path
+    return None, None
+
+def start_zip_build(entries, cache_path):
+    """Build cache_path in the background unless it exists or is being built already
+
+    Returns the partial file the archive is being written to, or None once it is in the
+    cache. The partial file has a fixed name, so any worker can follow a build in progress.
+    """
+    fd, part_path = claim_zip_build(cache_path)
+    if fd is not None:
+        threading.Thread(target=build_cached_zip, args=(entries, fd, part_path, cache_path), daemon=True).start()
+    return part_path
+
+def write_zip_file(entries, fd, part_path, final_path, progress=None):
+    """Write an archive to its partial file and move it to final_path; on failure the partial file goes"""
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for data in generate_zip(entries, progress):
+                f.write(data)
+                f.flush()  # Followers read the partial file as it grows
+        os.replace(part_path, final_path)
+    except Exception:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+
+def build_cached_zip(entries, fd, part_path, cache_path):
+    """Background thread: write an archive to its partial file and move it into the cache"""
+    try:
+        write_zip_file(entries, fd, part_path, cache_path)
+    except Exception:
+        log.exception("Failed to build folder ZIP", extra={'path': cache_path})
+        return
+    evict_zip_cache()
+
+def follow_zip_build(f, cache_path):
+    """Yield a partial archive as it is written until its build moves it into the cache"""
+    idle_since = time.monotonic()
+    try:
+        while True:
+            data = f.read(DOWNLOAD_CHUNK_SIZE)
+            if data:
+                idle_since = time.monotonic()
+                yield data
+                continue
+            st = os.fstat(f.fileno())
+            try:
+                finished = os.stat(cache_path).st_ino == st.st_ino
+            except OSError:
+                finished = False
+            if finished:
+                yield from iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b'')
+                return
+            if st.st_nlink == 0 or time.monotonic() - idle_since > ZIP_STALL_TIMEOUT:
+                # Ending the body normally would pass a truncated archive off as complete
+                raise IOError(f"Folder ZIP build stopped: {cache_path}")
+            time.sleep(0.05)
+    finally:
+        f.close()
+
+def wait_zip_build(part_path, cache_path):
+    """Wait until a build finishes; False if it failed or stalled"""
+    while not os.path.exists(cache_path):
+        try:
+            if time.time() - os.stat(part_path).st_mtime > ZIP_STALL_TIMEOUT:
+                return False
+        except FileNotFoundError:
+            return os.path.exists(cache_path)
+        time.sleep(0.1)
+    return True
+
+def evict_zip_cache():
+    """Remove the least recently downloaded archives until the cache fits ZIP_CACHE_MAX_BYTES"""
+    entries = []
+    try:
+        names = os.listdir(ZIP_CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(ZIP_CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if name.endswith('.zip'):
+            entries.append((st.st_atime, st.st_size, path))
+        elif time.time() - st.st_mtime > ZIP_STALL_TIMEOUT:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= ZIP_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# Background jobs: folder ZIPs, deletes and undos can run on a small thread pool instead of
+# inside the request. A job has an ID, reports how far it got (done of total, in bytes or
+# items) in job_progress events to the Socket.IO room job:<ID>, and can be cancelled. Jobs
+# are kept in JOBS_DB under the browser session that started them, so any worker can answer
+# for them; a cancel request reaches the worker running the job through the bus.
+class JobCancelled(Exception):
+    """Raised inside a job that has been cancelled"""
+
+class OperationError(Exception):
+    """An operation failed in a way worth showing to the user as it is"""
+
+job_lock = threading.Lock()
+jobs_db = sqlite3.connect(JOBS_DB, check_same_thread=False, timeout=30)
+jobs_db.execute('PRAGMA journal_mode=WAL')
+jobs_db.executescript('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        session TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        result TEXT,
+        error TEXT,
+        worker INTEGER NOT NULL,
+        created REAL NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_session ON jobs(session, created);
+''')
+jobs_db.commit()
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+job_cancels = {}  # Job ID -> cancel Event, for the unfinished jobs of this worker
+jobs_total = Metric('pfshare_jobs_total', 'counter', 'Finished background jobs', ('kind', 'status'))
+JOB_ACTIVE = ('queued', 'running')
+
+def job_room(job_id):
+    """Socket.IO room following a job"""
+    return f"job:{job_id}"
+
+def job_view(row):
+    """Client view of a jobs table row"""
+    job_id, kind, status, done, total, result, error, worker, created = row
+    if status in JOB_ACTIVE and not process_alive(worker):
+        status, error = 'failed', 'The server stopped while the job was running'
+    return {'id': job_id, 'kind': kind, 'status': status, 'done': done, 'total': total,
+            'percent': min(100, done * 100 // total) if total else None,
+            'result': json.loads(result) if result else None, 'error': error, 'created': created}
+
+def get_job(job_id, session_id=None):
+    """A job of the current session (or session_id's), or None"""
+    with job_lock:
+        row = jobs_db.execute('''
+            SELECT id, kind, status, done, total, result, error, worker, created FROM jobs
+            WHERE id = ? AND session = ?
+        ''', (job_id, session_id or undo_session_id())).fetchone()
+    return job_view(row) if row else None
+
+def purge_jobs():
+    """Forget jobs that finished more than JOB_KEEP seconds ago, with their files"""
+    cutoff = time.time() - JOB_KEEP
+    with job_lock:
+        jobs_db.execute(f"DELETE FROM jobs WHERE updated < ? AND status NOT IN {JOB_ACTIVE}", (cutoff,))
+        jobs_db.commit()
+    for entry in os.scandir(JOB_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def start_job(kind, func, *args, total=None):
+    """Queue func(job, *args) as a job of the current session; returns the job's ID
+
+    func reports progress with job_progress(), returns a JSON-able result and fails with
+    OperationError (shown as it is) or any other exception (logged).
+    """
+    purge_jobs()
+    job = {'id': secrets.token_hex(8), 'kind': kind, 'session': undo_session_id(),
+           'cancel': threading.Event(), 'reported': 0.0}
+    now = time.time()
+    with job_lock:
+        jobs_db.execute('''
+            INSERT INTO jobs (id, session, kind, status, done, total, worker, created, updated)
+            VALUES (?, ?, ?, 'queued', 0, ?, ?, ?, ?)
+        ''', (job['id'], job['session'], kind, total, os.getpid(), now, now))
+        jobs_db.commit()
+        job_cancels[job['id']] = job['cancel']
+    job_executor.submit(run_job, job, func, args)
+    return job['id']
+
+def update_job(job, status, done=None, total=None, result=None, error=None):
+    """Store a job's state and send it to the clients following the job"""
+    with job_lock:
+        jobs_db.execute('''
+            UPDATE jobs SET status = ?, done = COALESCE(?, done), total = COALESCE(?, total),
+                result = COALESCE(?, result), error = COALESCE(?, error), updated = ? WHERE id = ?
+        ''', (status, done, total, None if result is None else json.dumps(result), error, time.time(), job['id']))
+        jobs_db.commit()
+    view = get_job(job['id'], job['session'])
+    if view:
+        socketio.emit('job_progress', view, to=job_room(job['id']))
+
+def job_progress(job, done, total=None):
+    """Report how far a job got, at most every JOB_PROGRESS_INTERVAL seconds; raises JobCancelled once cancelled"""
+    if job['cancel'].is_set():
+        raise JobCancelled()
+    if time.monotonic() - job['reported'] >= JOB_PROGRESS_INTERVAL:
+        job['reported'] = time.monotonic()
+        update_job(job, 'running', done=done, total=total)
+
+def run_job(job, func, args):
+    """Job pool thread: run a job and record how it ended"""
+    try:
+        if job['cancel'].is_set():
+            raise JobCancelled()
+        update_job(job, 'running')
+        result = func(job, *args)
+        with job_lock:
+            done = jobs_db.execute('SELECT COALESCE(total, done) FROM jobs WHERE id = ?', (job['id'],)).fetchone()[0]
+        update_job(job, 'done', done=done, result=result)
+        status = 'done'
+    except JobCancelled:
+        update_job(job, 'cancelled')
+        status = 'cancelled'
+    except OperationError as e:
+        update_job(job, 'failed', error=str(e))
+        status = 'failed'
+    except Exception as e:
+        log.exception("Background job failed", extra={'job': job['id'], 'kind': job['kind']})
+        update_job(job, 'failed', error=str(e))
+        status = 'failed'
+    finally:
+        with job_lock:
+            job_cancels.pop(job['id'], None)
+    jobs_total.inc(kind=job['kind'], status=status)
+
+def cancel_job(job_id, publish=True):
+    """Ask a job to stop; a running job stops at its next progress report"""
+    if publish:
+        bus_publish('job_cancel', job_id)
+    with job_lock:
+        cancel = job_cancels.get(job_id)
+    if cancel:
+        cancel.set()
+
+BUS_HANDLERS['job_cancel'] = lambda job_id: cancel_job(job_id, publish=False)
+
+def zip_job(job, entries, total_size, fingerprint, download_name):
+    """Job: build a folder ZIP into the archive cache, or into JOB_DIR if it does not fit there"""
+    report = lambda done: job_progress(job, done, total_size)
+    cached = 0 < ZIP_CACHE_MAX_BYTES and total_size <= ZIP_CACHE_MAX_BYTES
+    if cached:
+        path = zip_cache_path(fingerprint)
+        fd, part_path = claim_zip_build(path)
+        zip_cache_total.inc(result='miss' if part_path else 'hit')
+        if fd is None and part_path:
+            # Another download is building this archive already
+            while not os.path.exists(path):
+                try:
+                    report(min(os.path.getsize(part_path), total_size))
+                except FileNotFoundError:
+                    break
+                if time.time() - os.stat(part_path).st_mtime > ZIP_STALL_TIMEOUT:
+                    break
+                time.sleep(0.1)
+            if not os.path.exists(path):
+                raise OperationError('Failed to create ZIP')
+    else:
+        zip_cache_total.inc(result='uncached')
+        path = os.path.join(JOB_DIR, f"{job['id']}.zip")
+        part_path = f"{path}.part"
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    
+    if fd is not None:
+        write_zip_file(entries, fd, part_path, path, report)
+        if cached:
+            evict_zip_cache()
+    return {'name': download_name, 'size': os.path.getsize(path), 'file': os.path.basename(path), 'cached': cached,
+            'download': f"/jobs/{job['id']}/download"}
+
+def delete_job(job, full_path, session_id):
+    """Job: move an item to the trash as an undoable delete"""
+    job_progress(job, 0, 1)
+    trash_rel, removed_size = trash_item(full_path)
+    journal_record('delete', {'path': search_rel_path(full_path)}, trash=trash_rel, size=removed_size,
+                   session_id=session_id)
+    return {'deleted': search_rel_path(full_path)}
+
+def undo_job(job, op):
+    """Job: undo a journal operation"""
+    job_progress(job, 0, 1)
+    error = undo_operation(op)
+    # Either undone or impossible to undo; in both cases the next undo goes one step further back
+    journal_remove(op['id'])
+    if error:
+        raise OperationError(f'Cannot undo {describe_operation(op)}: {error}')
+    return {'undone': describe_operation(op)}
 
-# Create base directory if it doesn't exist
-os.makedirs(BASE_DIR, exist_ok=True)
+# Text preview: pages of large files are read through mmap by byte offset, by line number
+# or from the end. A sparse line index with a checkpoint about every LINE_INDEX_STRIDE
+# bytes turns a jump to line N into a short scan; appends extend it instead of rebuilding.
+line_indexes = OrderedDict()  # Absolute path -> line index, least recently used first
+line_index_lock = threading.Lock()
+line_index_building = set()  # Paths with a background index build running
 
-# Initialize SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+@contextmanager
+def open_mmap(full_path):
+    """Map a file read-only; yields (mm, stat) with mm None for an empty file"""
+    with open(full_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            yield None, st
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm, st
 
-# Global variables for undo functionality and shared text
-last_operation = None
+def line_index_valid(index, st, mm):
+    """Whether an index still describes the file, i.e. it was only appended to"""
+    if (index['ino'], index['dev']) != (st.st_ino, st.st_dev):
+        return False
+    size = len(mm) if mm else 0
+    offset = index['checkpoints'][-1][0]
+    if size < offset or (mm[:len(index['head'])] if mm else b'') != index['head']:
+        return False
+    return (mm[offset - len(index['mark']):offset] if mm else b'') == index['mark']
 
-def load_config():
-    """Load configuration from file"""
-    default_config = {
-        "shared_text": "Welcome"
-    }
+def get_line_index(full_path, st, mm):
+    """Cached line index of a file; a fresh one if the file was replaced or rewritten"""
+    with line_index_lock:
+        index = line_indexes.get(full_path)
+        if index is not None and line_index_valid(index, st, mm):
+            line_indexes.move_to_end(full_path)
+            return index
+        index = {
+            'ino': st.st_ino,
+            'dev': st.st_dev,
+            'head': bytes(mm[:64]) if mm else b'',
+            'mark': b'',  # Bytes just before the last checkpoint
+            'checkpoints': [(0, 0)],  # (byte offset of a line start, 0-based line number)
+            'lock': threading.Lock()
+        }
+        line_indexes[full_path] = index
+        while len(line_indexes) > LINE_INDEX_CACHE_SIZE:
+            line_indexes.popitem(last=False)
+        return index
+
+def extend_line_index(index, mm, until_line=None, until_offset=None):
+    """Add checkpoints until the line or offset is covered, or the end of the mapping is reached"""
+    if mm is None:
+        return
+    size = len(mm)
+    with index['lock']:
+        checkpoints = index['checkpoints']
+        offset, line = checkpoints[-1]
+        while offset + LINE_INDEX_STRIDE < size:
+            if until_line is not None and line >= until_line:
+                break
+            if until_offset is not None and offset + LINE_INDEX_STRIDE > until_offset:
+                break
+            newline = mm.find(b'\n', offset + LINE_INDEX_STRIDE)
+            if newline < 0:
+                break
+            line += mm[offset:newline + 1].count(b'\n')
+            offset = newline + 1
+            checkpoints.append((offset, line))
+        index['mark'] = bytes(mm[max(offset - 32, 0):offset])
+
+def build_line_index_later(full_path):
+    """Index a whole file in the background so later pages can show line numbers"""
+    with line_index_lock:
+        if full_path in line_index_building:
+            return
+        line_index_building.add(full_path)
     
-    if os.path.exists(CONFIG_FILE):
+    def build():
         try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8-sig') as f:
-                loaded_config = json.load(f)
-                print(f"Loaded config from {CONFIG_FILE}: {loaded_config}")
-                return loaded_config
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"Error loading config: {e}")
+            with open_mmap(full_path) as (mm, st):
+                extend_line_index(get_line_index(full_path, st, mm), mm)
+        except (OSError, ValueError):
             pass
-    else:
-        print(f"Config file {CONFIG_FILE} not found, using defaults")
+        finally:
+            with line_index_lock:
+                line_index_building.discard(full_path)
     
-    return default_config
+    threading.Thread(target=build, daemon=True).start()
 
-def save_config(config):
-    """Save configuration to file"""
-    try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8-sig') as f:
-            json.dump(config, f, indent=2, ensure_ascii=False)
-        print(f"Config saved to {CONFIG_FILE}: {config}")
-    except IOError as e:
-        print(f"Warning: Failed to save config: {e}")
-        return False
-    return True
+def line_start_offset(index, mm, line):
+    """Byte offset where a 0-based line starts, or None past the end of the file"""
+    if line == 0:
+        return 0
+    extend_line_index(index, mm, until_line=line)
+    checkpoints = index['checkpoints']
+    offset, current = checkpoints[bisect.bisect_right([c[1] for c in checkpoints], line) - 1]
+    while current < line:
+        newline = mm.find(b'\n', offset)
+        if newline < 0:
+            return None
+        offset = newline + 1
+        current += 1
+    return offset if offset < len(mm) else None
 
-# Load initial configuration
-config = load_config()
-shared_text_content = {"content": config.get("shared_text", "")}
-print(f"Initial shared text content: {shared_text_content}")
+def line_number_at(index, mm, offset):
+    """0-based number of the line at a byte offset, or None while that needs a long scan"""
+    if mm is None or offset == 0:
+        return 0
+    checkpoints = index['checkpoints']
+    start, line = checkpoints[bisect.bisect_right(checkpoints, (offset, float('inf'))) - 1]
+    if offset - start > 4 * LINE_INDEX_STRIDE:
+        return None
+    return line + mm[start:offset].count(b'\n')
 
-# Ensure config file exists with current data
-if not os.path.exists(CONFIG_FILE):
-    print("Creating initial config file...")
-    save_config(config)
+def utf8_boundary(mm, start, end):
+    """Move end back so a multi-byte UTF-8 character is not cut in half"""
+    lead = end
+    while lead > start and end - lead < 4 and mm[lead - 1] & 0xC0 == 0x80:
+        lead -= 1
+    if lead > start and mm[lead - 1] >= 0xC0:
+        needed = 2 if mm[lead - 1] < 0xE0 else 3 if mm[lead - 1] < 0xF0 else 4
+        if end - (lead - 1) < needed:
+            return lead - 1
+    return end
 
-def get_file_size(path):
-    """Get file or directory size in bytes"""
-    if os.path.isfile(path):
-        return os.path.getsize(path)
-    elif os.path.isdir(path):
-        total = 0
-        for dirpath, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
+def next_line_start(mm, offset, limit):
+    """First line start at or after offset within limit, else the next character boundary"""
+    if offset == 0 or mm[offset - 1] == 0x0A:
+        return offset
+    newline = mm.find(b'\n', offset, limit)
+    if newline >= 0 and newline + 1 < limit:
+        return newline + 1
+    while offset < limit and mm[offset] & 0xC0 == 0x80:
+        offset += 1
+    return offset
+
+def page_end(mm, start, limit):
+    """End a page at its last complete line, unless it is the end of the file"""
+    if limit >= len(mm):
+        return len(mm)
+    newline = mm.rfind(b'\n', start, limit)
+    if newline >= 0:
+        return newline + 1
+    return utf8_boundary(mm, start, limit)
+
+def read_text_page(full_path, offset=None, before=None, line=None, tail=None, length=PREVIEW_PAGE_BYTES, lines=None):
+    """One page of a text file, located by byte offset, end offset (before), 1-based line or tail line count"""
+    length = min(max(length, 1), PREVIEW_MAX_BYTES)
+    with open_mmap(full_path) as (mm, st):
+        if mm is None:
+            return {'content': '', 'offset': 0, 'end': 0, 'size': 0, 'eof': True,
+                    'first_line': 1, 'total_lines': 0, 'next_offset': None}
+        size = len(mm)
+        index = get_line_index(full_path, st, mm)
+        first_line = None
+        
+        if line is not None:
+            first_line = max(line, 1) - 1
+            start = line_start_offset(index, mm, first_line)
+            if start is None:
+                start = end = size
+            else:
+                limit = min(size, start + PREVIEW_MAX_BYTES)
+                end = start
+                for _ in range(min(max(lines or PREVIEW_MAX_LINES, 1), PREVIEW_MAX_LINES)):
+                    newline = mm.find(b'\n', end, limit)
+                    if newline < 0:
+                        if limit == size:
+                            end = size  # Last line of the file without a newline
+                        elif end == start:
+                            end = utf8_boundary(mm, start, limit)  # A line longer than a page
+                        break
+                    end = newline + 1
+        elif tail is not None:
+            lower = max(0, size - PREVIEW_MAX_BYTES)
+            search_end = size - 1 if mm[size - 1] == 0x0A else size
+            start = size
+            for _ in range(min(max(tail, 1), PREVIEW_MAX_LINES)):
+                newline = mm.rfind(b'\n', lower, search_end)
+                if newline < 0:
+                    start = next_line_start(mm, lower, size)
+                    break
+                start = newline + 1
+                search_end = newline
+            end = size
+        elif before is not None:
+            end = min(max(before, 0), size)
+            start = next_line_start(mm, max(0, end - length), end)
+        else:
+            start = next_line_start(mm, min(max(offset or 0, 0), size), size)
+            end = page_end(mm, start, start + length)
+        
+        if first_line is None:
+            first_line = line_number_at(index, mm, start)
+            if first_line is None:
+                build_line_index_later(full_path)
+        
+        last = index['checkpoints'][-1]
+        total_lines = None
+        if size - last[0] <= 4 * LINE_INDEX_STRIDE:
+            total_lines = last[1] + mm[last[0]:size].count(b'\n') + (mm[size - 1] != 0x0A)
+        
+        data = mm[start:end]
+        if start == 0 and data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
+        return {
+            'content': data.decode('utf-8', errors='replace'),
+            'offset': start,
+            'end': end,
+            'size': size,
+            'eof': end >= size,
+            'first_line': first_line + 1 if first_line is not None else None,
+            'total_lines': total_lines,
+            'next_offset': end if end < size else None
+        }
+
+def read_appended_text(full_path, offset):
+    """Text appended to a file since offset: (content, end, size), or None if it shrank or was replaced"""
+    with open(full_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < offset:
+            return None
+        if size == offset:
+            return '', offset, size
+        if size - offset > PREVIEW_MAX_BYTES:
+            return None  # Too far behind to stream; the browser reloads the tail instead
+        f.seek(offset)
+        data = f.read(size - offset)
+    cut = utf8_boundary(data, 0, len(data))  # A partial character waits for the next update
+    return data[:cut].decode('utf-8', errors='replace'), offset + cut, size
+
+# Archive browsing: the members of ZIP and tar archives (plain, gzip, bzip2 or xz) are
+# listed from an index built once per version of the archive and kept in memory and in
+# ARCHIVE_INDEX_DIR, keyed like thumbnails by inode, size and mtime. A ZIP member is read
+# straight from its local header at the offset in the index, so large archives are not
+# parsed again for each member; tar members are read at their data offset, which in a
+# compressed tar means decompressing up to it.
+ARCHIVE_SUFFIXES = {
+    '.zip': 'zip', '.tar': 'tar', '.tar.gz': 'tar', '.tgz': 'tar',
+    '.tar.bz2': 'tar', '.tbz2': 'tar', '.tar.xz': 'tar', '.txz': 'tar',
+}
+ARCHIVE_INDEX_VERSION = 1
+archive_index_cache = OrderedDict()  # Index key -> archive index
+archive_index_builds = {}  # Index key -> lock held while that index is loaded or built
+archive_index_lock = threading.Lock()
+
+def archive_kind(filename):
+    """'zip' or 'tar' for archives that can be browsed, else None"""
+    name = filename.lower()
+    return next((kind for suffix, kind in ARCHIVE_SUFFIXES.items() if name.endswith(suffix)), None)
+
+def archive_member_name(name):
+    """Normalized member path, or None for names that cannot be shown as a path"""
+    name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    if name in ('', '.') or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+def build_archive_index(full_path, kind):
+    """Read an archive's member list; members are [name, is_dir, size, mtime, offset, method, compressed size, crc]
+
+    offset is where a ZIP member's local header or a tar member's data starts; method is the
+    ZIP compression method, or None for members that cannot be read (encrypted ones).
+    """
+    members = []
+    compression = None
+    if kind == 'zip':
+        with zipfile.ZipFile(full_path) as zf:
+            for info in zf.infolist():
+                name = archive_member_name(info.filename)
+                if name is None:
+                    continue
+                method = None if info.flag_bits & 0x1 else info.compress_type
+                members.append([name, info.is_dir(), info.file_size, time.mktime(info.date_time + (0, 0, -1)),
+                                info.header_offset, method, info.compress_size, info.CRC])
+    else:
+        with open(full_path, 'rb') as f:
+            magic = f.read(6)
+        compression = ('gz' if magic.startswith(b'\x1f\x8b') else 'bz2' if magic.startswith(b'BZh')
+                       else 'xz' if magic.startswith(b'\xfd7zXZ\x00') else None)
+        with tarfile.open(full_path, 'r:*') as tf:
+            while (info := tf.next()) is not None:
+                tf.members = []  # Only the index is kept; huge archives would otherwise pile up TarInfos
+                name = archive_member_name(info.name)
+                if name is None or not (info.isdir() or info.isreg()):
+                    continue
+                members.append([name, info.isdir(), info.size if info.isreg() else 0, info.mtime,
+                                info.offset_data, 0, info.size, None])
+    return {'version': ARCHIVE_INDEX_VERSION, 'kind': kind, 'compression': compression, 'members': members}
+
+def get_archive_index(full_path, kind):
+    """Index of an archive from memory, ARCHIVE_INDEX_DIR or a fresh read of the archive"""
+    st = os.stat(full_path)
+    key = hashlib.sha1(f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+    with archive_index_lock:
+        if key in archive_index_cache:
+            archive_index_cache.move_to_end(key)
+            return archive_index_cache[key]
+        build_lock = archive_index_builds.setdefault(key, threading.Lock())
+    
+    # One thread per archive version reads it; others asking meanwhile wait for its result
+    with build_lock:
+        with archive_index_lock:
+            index = archive_index_cache.get(key)
+        if index is not None:
+            return index
+        
+        try:
+            index_path = os.path.join(ARCHIVE_INDEX_DIR, f"{key}.json.gz")
+            try:
+                with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+                    index = json.load(f)
+                if index.get('version') != ARCHIVE_INDEX_VERSION:
+                    raise ValueError('Outdated archive index')
+                os.utime(index_path, (time.time(), os.stat(index_path).st_mtime))  # Eviction goes by access time
+            except (OSError, ValueError, EOFError):
+                index = build_archive_index(full_path, kind)
+                os.makedirs(ARCHIVE_INDEX_DIR, exist_ok=True)
+                temp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
                 try:
-                    total += os.path.getsize(filepath)
-                except (OSError, IOError):
-                    pass
-        return total
-    return 0
+                    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+                        json.dump(index, f, separators=(',', ':'))
+                    os.replace(temp_path, index_path)
+                    evict_archive_indexes()
+                except OSError as e:
+                    # A full disk must not leave a partial file next to the indexes
+                    try:
+                        os.remove(temp_path)
+                    except OSError:
+                        pass
+                    log.warning("Failed to save archive index", extra={'path': full_path, 'error': str(e)})
+            
+            index['lookup'] = {member[0]: member for member in index['members']}
+            with archive_index_lock:
+                archive_index_cache[key] = index
+                while len(archive_index_cache) > ARCHIVE_INDEX_CACHE_SIZE:
+                    archive_index_cache.popitem(last=False)
+        finally:
+            # Also after a corrupt archive failed to read, so its lock does not stay behind
+            with archive_index_lock:
+                archive_index_builds.pop(key, None)
+    return index
 
-def format_file_size(size_bytes):
-    """Convert bytes to human readable format"""
-    if size_bytes == 0:
-        return "0 B"
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    return f"{size_bytes:.1f} {size_names[i]}"
+def evict_archive_indexes():
+    """Remove the least recently used archive indexes until they fit ARCHIVE_INDEX_MAX_BYTES"""
+    entries = []
+    for entry in os.scandir(ARCHIVE_INDEX_DIR):
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        entries.append((st.st_atime, st.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= ARCHIVE_INDEX_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
 
-def get_file_icon(filename):
-    """Get appropriate icon class for file type"""
-    ext = os.path.splitext(filename)[1].lower()
-    icon_map = {
-        # Images
-        '.jpg': 'fas fa-image', '.jpeg': 'fas fa-image', '.png': 'fas fa-image',
-        '.gif': 'fas fa-image', '.bmp': 'fas fa-image', '.svg': 'fas fa-image',
-        # Videos
-        '.mp4': 'fas fa-video', '.avi': 'fas fa-video', '.mkv': 'fas fa-video',
-        '.mov': 'fas fa-video', '.wmv': 'fas fa-video', '.flv': 'fas fa-video',
-        # Audio
-        '.mp3': 'fas fa-music', '.wav': 'fas fa-music', '.flac': 'fas fa-music',
-        '.aac': 'fas fa-music', '.ogg': 'fas fa-music',
-        # Documents
-        '.pdf': 'fas fa-file-pdf', '.doc': 'fas fa-file-word', '.docx': 'fas fa-file-word',
-        '.xls': 'fas fa-file-excel', '.xlsx': 'fas fa-file-excel',
-        '.ppt': 'fas fa-file-powerpoint', '.pptx': 'fas fa-file-powerpoint',
-        '.txt': 'fas fa-file-alt', '.md': 'fas fa-file-alt', '.rtf': 'fas fa-file-alt',
-        # Code
-        '.py': 'fas fa-file-code', '.js': 'fas fa-file-code', '.html': 'fas fa-file-code',
-        '.css': 'fas fa-file-code', '.php': 'fas fa-file-code', '.cpp': 'fas fa-file-code',
-        '.java': 'fas fa-file-code', '.c': 'fas fa-file-code',
-        # Archives
-        '.zip': 'fas fa-file-archive', '.rar': 'fas fa-file-archive', '.7z': 'fas fa-file-archive',
-        '.tar': 'fas fa-file-archive', '.gz': 'fas fa-file-archive',
+def list_archive_dir(index, folder):
+    """List items directly inside a folder of an archive, including folders only implied by member paths"""
+    prefix = f"{folder}/" if folder else ''
+    items = {}
+    for name, is_dir, size, mtime, *_ in index['members']:
+        if not name.startswith(prefix) or name == folder:
+            continue
+        child, _, rest = name[len(prefix):].partition('/')
+        item = items.get(child)
+        if rest or is_dir:
+            if item is None:
+                item = items[child] = make_list_item(child, prefix + child, True, 0, mtime)
+            item['size'] += size
+            item['mtime'] = max(item['mtime'], mtime)
+        else:
+            items[child] = make_list_item(child, name, False, size, mtime)
+    
+    for item in items.values():
+        if item['is_dir']:
+            item['size_formatted'] = format_file_size(item['size'])
+            item['modified'] = datetime.fromtimestamp(item['mtime']).strftime('%Y-%m-%d %H:%M:%S')
+    return sorted(items.values(), key=lambda item: (not item['is_dir'], item['name'].lower()))
+
+def read_archive_member(full_path, index, member, limit=None):
+    """Yield the contents of an archive member, or its first limit bytes"""
+    name, is_dir, size, mtime, offset, method, compressed_size, crc = member
+    wanted = size if limit is None else min(size, limit)
+    
+    if index['kind'] == 'tar':
+        opener = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}.get(index['compression'], open)
+        with opener(full_path, 'rb') as f:
+            f.seek(offset)
+            while wanted > 0:
+                data = f.read(min(DOWNLOAD_CHUNK_SIZE, wanted))
+                if not data:
+                    raise IOError(f"Archive ends inside {name}")
+                wanted -= len(data)
+                yield data
+        return
+    
+    with open(full_path, 'rb') as f:
+        f.seek(offset)
+        header = f.read(30)
+        if len(header) < 30 or header[:4] != b'PK\x03\x04':
+            raise IOError(f"Damaged archive: no local header for {name}")
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        
+        inflater = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        
+        def pieces():
+            remaining = compressed_size
+            while remaining:
+                data = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError(f"Archive ends inside {name}")
+                remaining -= len(data)
+                if inflater is None:
+                    yield data
+                    continue
+                # Output is bounded per step, so a small member cannot inflate into a huge buffer
+                while data:
+                    yield inflater.decompress(data, DOWNLOAD_CHUNK_SIZE)
+                    data = inflater.unconsumed_tail
+            if inflater is not None:
+                yield inflater.flush()
+        
+        produced = checksum = 0
+        for piece in pieces():
+            if produced >= wanted:
+                break
+            piece = piece[:wanted - produced]
+            produced += len(piece)
+            checksum = zlib.crc32(piece, checksum)
+            if piece:
+                yield piece
+        if limit is None and (produced != size or checksum != crc):
+            # Ending the body normally would pass damaged data off as the member
+            raise IOError(f"Damaged archive: {name} does not match its size or CRC")
+
+def resolve_archive_request(member_required=False):
+    """Archive path, kind, index and member (or None) of an /archive request; returns (values, None) or (None, error response)"""
+    full_path = safe_join(BASE_DIR, request.args.get('path', ''))
+    if not is_safe_path(full_path, BASE_DIR):
+        return None, (jsonify({'error': 'Invalid path'}), 400)
+    if not os.path.isfile(full_path):
+        return None, (jsonify({'error': 'File not found'}), 404)
+    kind = archive_kind(full_path)
+    if kind is None:
+        return None, (jsonify({'error': 'Not a supported archive (ZIP or tar)'}), 400)
+    try:
+        index = get_archive_index(full_path, kind)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, ValueError, lzma.LZMAError) as e:
+        return None, (jsonify({'error': f'Failed to read archive: {str(e)}'}), 400)
+    
+    member = None
+    if member_required:
+        member = index['lookup'].get(archive_member_name(request.args.get('member', '')) or '')
+        if member is None or member[1]:
+            return None, (jsonify({'error': 'Archive member not found'}), 404)
+        if member[5] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return None, (jsonify({'error': 'This member is encrypted or uses an unsupported compression method'}), 415)
+    return (full_path, index, member), None
+
+def parse_search_args(args):
+    """Read search filters from query arguments (ext, min_size, max_size, after, before, type, page)"""
+    def as_int(name):
+        try:
+            return int(args[name])
+        except (KeyError, ValueError):
+            return None
+    
+    def as_timestamp(name):
+        try:
+            return datetime.strptime(args[name], '%Y-%m-%d').timestamp()
+        except (KeyError, ValueError):
+            return None
+    
+    extensions = [
+        ext.strip().lower() if ext.strip().startswith('.') else '.' + ext.strip().lower()
+        for ext in args.get('ext', '').split(',') if ext.strip()
+    ]
+    
+    return {
+        'extensions': extensions or None,
+        'min_size': as_int('min_size'),
+        'max_size': as_int('max_size'),
+        'modified_after': as_timestamp('after'),
+        'modified_before': as_timestamp('before'),
+        'kind': args.get('type'),
+        'page': max(as_int('page') or 1, 1),
+        'per_page': min(max(as_int('per_page') or SEARCH_PAGE_SIZE, 1), 1000)
     }
-    return icon_map.get(ext, 'fas fa-file')
+
+def make_list_item(name, rel_path, is_dir, size, mtime):
+    """File list entry as rendered by the browser; size is None while a folder is being sized"""
+    return {
+        'name': name,
+        'is_dir': is_dir,
+        'size': size,
+        'size_pending': size is None,
+        'size_formatted': format_file_size(size) if size is not None else '...',
+        'mtime': mtime,
+        'modified': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'),
+        'icon': 'fas fa-folder' if is_dir else get_file_icon(name),
+        'path': rel_path
+    }
+
+def search_result_item(row, current_path):
+    """Turn a search index row into a file list item relative to the current folder"""
+    rel_path, name, is_dir, size, mtime = row
+    if is_dir:
+        size = get_file_size(safe_join(BASE_DIR, rel_path), wait=not DIR_SIZE_LAZY)
+    
+    location = rel_path.rpartition('/')[0]
+    if current_path:
+        location = location[len(current_path.strip('/')) + 1:]
+    
+    item = make_list_item(name, rel_path, bool(is_dir), size, mtime)
+    item['location'] = location
+    return item
 
 def is_admin():
     """Check if current user is admin"""
@@ -157,9 +4341,96 @@ def is_safe_path(path, base_path):
     """Check if path is within base directory"""
     return os.path.commonpath([path, base_path]) == base_path
 
+# Static assets: the interface's CSS and JavaScript live in static/. At startup every file
+# gets a name with a hash of its content and gzip (plus brotli, if installed) copies in
+# ASSET_DIR, so browsers can cache it for good and only fetch it again after it changed.
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+asset_manifest = {}  # Path in static/ -> fingerprinted path
+asset_sources = {}  # Fingerprinted path -> file in static/
+
+def build_assets():
+    """Fingerprint the static files and write their compressed copies where missing"""
+    for root, dirs, files in os.walk(app.static_folder):
+        for name in files:
+            source = os.path.join(root, name)
+            rel_path = os.path.relpath(source, app.static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(rel_path)
+            fingerprinted = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            asset_manifest[rel_path] = fingerprinted
+            asset_sources[fingerprinted] = source
+            
+            if not (mimetypes.guess_type(name)[0] or '').startswith(ASSET_TYPES):
+                continue
+            encoders = [('.gz', lambda d: gzip.compress(d, 9, mtime=0))]
+            if brotli is not None:
+                encoders.append(('.br', lambda d: brotli.compress(d, quality=11)))
+            for suffix, encode in encoders:
+                target = os.path.join(ASSET_DIR, fingerprinted + suffix)
+                if os.path.exists(target):
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                temp_path = f"{target}.{os.getpid()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(encode(data))
+                os.replace(temp_path, target)
+
+def asset_url(rel_path):
+    """URL of a file in static/ that changes whenever the file does"""
+    if rel_path not in asset_manifest:
+        return url_for('static', filename=rel_path)
+    return url_for('static_asset', name=asset_manifest[rel_path])
+
+build_assets()
+app.jinja_env.globals['asset_url'] = asset_url
+asset_version = hashlib.sha1(json.dumps(asset_manifest, sort_keys=True).encode()).hexdigest()
+
+@app.route('/assets/<path:name>')
+def static_asset(name):
+    """Fingerprinted static file, precompressed where the browser accepts it"""
+    source = asset_sources.get(name)
+    if source is None:
+        return jsonify({'error': 'Not found'}), 404
+    
+    path, encoding = source, None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        variant = os.path.join(ASSET_DIR, name + suffix)
+        if request.accept_encodings[candidate] and os.path.exists(variant):
+            path, encoding = variant, candidate
+            break
+    
+    response = send_file(path, mimetype=mimetypes.guess_type(source)[0] or 'application/octet-stream')
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress HTML and JSON responses for browsers that accept it"""
+    if (response.mimetype not in COMPRESS_MIMETYPES or response.direct_passthrough or response.is_streamed
+            or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    accepted = request.accept_encodings
+    encoding = 'br' if brotli is not None and accepted['br'] else 'gzip' if accepted['gzip'] else None
+    if encoding is None or response.content_length is None or response.content_length < COMPRESS_MIN_SIZE:
+        return response
+    
+    data = response.get_data()
+    response.set_data(brotli.compress(data, quality=4) if encoding == 'br' else gzip.compress(data, COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)  # Same content, different bytes
+    return response
+
 @app.route('/')
 def index():
-    """Main file browser page"""
+    """Main file browser page; the file list itself is loaded from /api/list"""
     current_path = request.args.get('path', '')
     search_query = request.args.get('search', '')
     
@@ -171,42 +4442,17 @@ def index():
     if not os.path.exists(full_path):
         return redirect(url_for('index'))
     
-    # Get directory contents
-    items = []
-    if os.path.isdir(full_path):
-        try:
-            for item in os.listdir(full_path):
-                if search_query and search_query.lower() not in item.lower():
-                    continue
-                    
-                item_path = os.path.join(full_path, item)
-                is_dir = os.path.isdir(item_path)
-                size = get_file_size(item_path)
-                modified = datetime.fromtimestamp(os.path.getmtime(item_path))
-                
-                items.append({
-                    'name': item,
-                    'is_dir': is_dir,
-                    'size': size,
-                    'size_formatted': format_file_size(size),
-                    'modified': modified.strftime('%Y-%m-%d %H:%M:%S'),
-                    'icon': 'fas fa-folder' if is_dir else get_file_icon(item),
-                    'path': os.path.join(current_path, item).replace('\\', '/')
-                })
-        except PermissionError:
-            flash('Permission denied accessing this directory', 'error')
-            return redirect(url_for('index'))
-    
-    # Sort items (directories first, then by name)
     sort_by = request.args.get('sort', 'name')
-    reverse = request.args.get('order') == 'desc'
     
-    if sort_by == 'size':
-        items.sort(key=lambda x: (not x['is_dir'], x['size']), reverse=reverse)
-    elif sort_by == 'modified':
-        items.sort(key=lambda x: (not x['is_dir'], x['modified']), reverse=reverse)
-    else:  # name
-        items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()), reverse=reverse)
+    # The page does not contain the listing, so it only changes with these and the template
+    order = request.args.get('order', 'asc')
+    template_mtime = os.stat(os.path.join(app.root_path, app.template_folder, 'index.html')).st_mtime_ns
+    etag = hashlib.sha1(json.dumps([template_mtime, asset_version, current_path, search_query, sort_by, order, is_admin()],
+                                   ensure_ascii=False).encode('utf-8', 'surrogateescape')).hexdigest()
+    response = not_modified(etag)
+    if response is not None:
+        response.vary.add('Cookie')
+        return response
     
     # Breadcrumb navigation
     breadcrumbs = []
@@ -218,14 +4464,234 @@ def index():
                 path = os.path.join(path, part).replace('\\', '/')
                 breadcrumbs.append({'name': part, 'path': path})
     
-    return render_template('index.html', 
-                         items=items, 
+    response = app.make_response(render_template('index.html', 
                          current_path=current_path,
                          breadcrumbs=breadcrumbs,
                          is_admin=is_admin(),
+                         thumbnails=Image is not None,
+                         websocket_only=MESSAGE_QUEUE is not None,
                          search_query=search_query,
                          sort_by=sort_by,
-                         order=request.args.get('order', 'asc'))
+                         order=order))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')  # Admins get a different page
+    return response
+
+def scan_directory(full_path, current_path):
+    """List a directory with a single scandir pass and one stat per entry"""
+    items = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:
+                continue
+            size = get_dir_size(entry.path, wait=not DIR_SIZE_LAZY) if is_dir else st.st_size
+            rel_path = f"{current_path.strip('/')}/{entry.name}" if current_path.strip('/') else entry.name
+            items.append(make_list_item(entry.name, rel_path, is_dir, size, st.st_mtime))
+    return items
+
+def list_sort_key(item, sort_by):
+    """Sort key within the folder or file group of a listing"""
+    if sort_by == 'size':
+        return [item['size'] or 0, item['name']]
+    if sort_by == 'modified':
+        return [item['mtime'], item['name']]
+    return [item['name'].lower(), item['name']]
+
+def sort_list_items(items, sort_by, reverse):
+    """Sort a listing with folders first, then by the chosen key"""
+    dirs = sorted((i for i in items if i['is_dir']), key=lambda i: list_sort_key(i, sort_by), reverse=reverse)
+    files = sorted((i for i in items if not i['is_dir']), key=lambda i: list_sort_key(i, sort_by), reverse=reverse)
+    return dirs + files
+
+def encode_list_cursor(item, sort_by):
+    """Opaque cursor pointing just after item in a sorted listing"""
+    data = json.dumps([int(not item['is_dir']), list_sort_key(item, sort_by)], ensure_ascii=False)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+def list_cursor_position(items, cursor, sort_by, reverse):
+    """Index of the first item after a cursor; entries added or removed before it do not shift pages"""
+    try:
+        group, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return 0
+    
+    # A made-up cursor, or one from another sort order, starts over like an unreadable one
+    first_type = (int, float) if sort_by in ('size', 'modified') else str
+    if (type(group) is not int or not isinstance(key, list) or len(key) != 2
+            or not isinstance(key[0], first_type) or isinstance(key[0], bool) or not isinstance(key[1], str)):
+        return 0
+    
+    try:
+        for index, item in enumerate(items):
+            item_group = int(not item['is_dir'])
+            if item_group != group:
+                if item_group > group:
+                    return index
+                continue
+            item_key = list_sort_key(item, sort_by)
+            if (item_key < key) if reverse else (item_key > key):
+                return index
+    except TypeError:
+        return 0
+    return len(items)
+
+# Listing cache: sorted listings are kept per folder, sort order and name filter, and
+# reused while the folder's mtime is unchanged and nothing bumped its listing generation.
+# Changes that leave the folder's mtime alone (a file edited in place, a subfolder's size)
+# bump the generation. Responses carry an ETag derived from the listing's content, so a
+# browser holding the current version gets a 304 after a single stat of the folder.
+listing_cache = OrderedDict()  # (folder, sort, reverse, filter) -> listing, least recently used first
+listing_cache_items = 0
+listing_generations = {}  # Folder -> count of changes its mtime does not show
+listing_lock = threading.Lock()
+listing_cache_total = Metric('pfshare_listing_cache_total', 'counter', 'Folder listings by cache result', ('result',))
+
+def listing_changed(*folders, parents=False, publish=False):
+    """Invalidate cached listings of folders, and with parents those of every folder above"""
+    if publish:
+        bus_publish('listing_changed', list(folders))
+    with listing_lock:
+        for folder in folders:
+            while is_safe_path(folder, BASE_DIR):
+                listing_generations[folder] = listing_generations.get(folder, 0) + 1
+                if not parents or folder == BASE_DIR:
+                    break
+                folder = os.path.dirname(folder)
+
+# Sizes reach other workers through their own bus messages; only notify_dir_change needs this
+BUS_HANDLERS['listing_changed'] = lambda folders: listing_changed(*folders, parents=True)
+
+def cached_listing(full_path, current_path, sort_by, reverse, search_query):
+    """Sorted listing of a folder, filtered by name, and a digest of its content"""
+    global listing_cache_items
+    st = os.stat(full_path)
+    key = (full_path, sort_by, reverse, search_query.lower())
+    with listing_lock:
+        generation = listing_generations.get(full_path, 0)
+        entry = listing_cache.get(key)
+        if entry and entry['mtime_ns'] == st.st_mtime_ns and entry['generation'] == generation:
+            listing_cache.move_to_end(key)
+            listing_cache_total.inc(result='hit')
+            return entry['items'], entry['digest']
+    
+    listing_cache_total.inc(result='miss')
+    items = scan_directory(full_path, current_path)
+    # Name filter for when the search index is not available yet
+    if search_query:
+        items = [i for i in items if search_query.lower() in i['name'].lower()]
+    items = sort_list_items(items, sort_by, reverse)
+    digest = hashlib.sha1(json.dumps(items, sort_keys=True, ensure_ascii=False).encode('utf-8', 'surrogateescape')).hexdigest()
+    
+    # A change in the same timestamp tick as the scan would not show in the mtime
+    if time.time_ns() - st.st_mtime_ns < 2 * 10**9:
+        return items, digest
+    
+    with listing_lock:
+        old = listing_cache.pop(key, None)
+        if old:
+            listing_cache_items -= len(old['items'])
+        listing_cache[key] = {'mtime_ns': st.st_mtime_ns, 'generation': generation, 'items': items, 'digest': digest}
+        listing_cache_items += len(items)
+        while listing_cache and (len(listing_cache) > LISTING_CACHE_SIZE or listing_cache_items > LISTING_CACHE_MAX_ITEMS):
+            _, old = listing_cache.popitem(last=False)
+            listing_cache_items -= len(old['items'])
+    return items, digest
+
+def not_modified(etag):
+    """A 304 response when the browser already has this version, otherwise None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+@app.route('/api/list')
+def api_list():
+    """Paginated JSON listing of a folder, sorted on the server"""
+    current_path = request.args.get('path', '')
+    search_query = request.args.get('search', '')
+    sort_by = request.args.get('sort', 'name')
+    reverse = request.args.get('order') == 'desc'
+    cursor = request.args.get('cursor')
+    try:
+        limit = min(max(int(request.args.get('limit', LIST_PAGE_SIZE)), 1), 1000)
+    except ValueError:
+        limit = LIST_PAGE_SIZE
+    
+    # Security check
+    full_path = safe_join(BASE_DIR, current_path)
+    if not is_safe_path(full_path, BASE_DIR):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.isdir(full_path):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    try:
+        items, digest = cached_listing(full_path, current_path, sort_by, reverse, search_query)
+    except PermissionError:
+        return jsonify({'error': 'Permission denied accessing this directory'}), 403
+    
+    start = list_cursor_position(items, cursor, sort_by, reverse) if cursor else 0
+    page = items[start:start + limit]
+    has_more = start + limit < len(items)
+    
+    # Digests come from the checksum cache, not the listing, so the folder's checksum generation is part of its version
+    etag = hashlib.sha1(f"{digest}\0{current_path}\0{cursor}\0{limit}\0{checksum_generation(full_path)}".encode('utf-8', 'surrogateescape')).hexdigest()
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    # Cached listings are shared, so entries with a digest are copies
+    file_paths = {i['path']: safe_join(BASE_DIR, i['path']) for i in page if not i['is_dir']}
+    digests = listed_checksums(file_paths.values())
+    if digests:
+        page = [dict(i, checksum=digests[file_paths[i['path']]]) if file_paths.get(i['path']) in digests else i
+                for i in page]
+    
+    if Image is not None:
+        warm_thumbnails([safe_join(BASE_DIR, i['path']) for i in page if not i['is_dir']])
+    
+    response = jsonify({
+        'success': True,
+        'path': current_path,
+        'items': page,
+        'total': len(items),
+        'checksum_algorithm': CHECKSUM_LISTED,
+        'next_cursor': encode_list_cursor(page[-1], sort_by) if has_more and page else None
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # Always revalidate, which costs one stat of the folder
+    return response
+
+@app.route('/api/search')
+def api_search():
+    """Search file and folder names across the tree below path"""
+    current_path = request.args.get('path', '')
+    
+    # Security check
+    full_path = safe_join(BASE_DIR, current_path)
+    if not is_safe_path(full_path, BASE_DIR):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not search_index_ready():
+        return jsonify({'error': 'Search index is still being built'}), 503
+    
+    search = parse_search_args(request.args)
+    search.update(sort_by=request.args.get('sort', 'name'), reverse=request.args.get('order') == 'desc')
+    rows, has_more = search_files(request.args.get('q', ''), under=search_rel_path(full_path), **search)
+    
+    return jsonify({
+        'success': True,
+        'results': [search_result_item(row, current_path) for row in rows],
+        'page': search['page'],
+        'per_page': search['per_page'],
+        'has_more': has_more
+    })
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -237,94 +4703,416 @@ def login():
             flash('Logged in as admin', 'success')
             return redirect(request.args.get('next') or url_for('index'))
         else:
-            flash('Invalid password', 'error')
-    
-    return render_template('login.html')
+            flash('Invalid password', 'error')
+    
+    return render_template('login.html')
+
+@app.route('/logout')
+def logout():
+    """Logout and return to viewer mode"""
+    session.pop('admin', None)
+    flash('Logged out', 'info')
+    return redirect(url_for('index'))
+
+def resolve_upload_filename(upload_dir, original_filename):
+    """Pick a safe, unused filename for an upload; returns (filename, file_path)"""
+    # Handle Unicode filenames properly
+    filename = secure_filename(original_filename)
+    
+    # If secure_filename stripped all characters (e.g., Cyrillic), use a fallback
+    if not filename:
+        import uuid
+        ext = os.path.splitext(original_filename)[1] if original_filename else '.txt'
+        filename = f"upload_{uuid.uuid4().hex[:8]}{ext}"
+    elif filename != original_filename:
+        # Try to preserve original filename if it's safe
+        try:
+            # Check if original filename is safe for filesystem
+            test_path = os.path.join(upload_dir, original_filename)
+            os.path.normpath(test_path)  # This will raise an exception for unsafe paths
+            if os.path.commonpath([test_path, upload_dir]) == upload_dir:
+                filename = original_filename
+        except (ValueError, OSError):
+            pass  # Use the secure filename
+    
+    file_path = os.path.join(upload_dir, filename)
+    
+    # Handle duplicate filenames
+    counter = 1
+    original_name = filename
+    while os.path.exists(file_path):
+        name, ext = os.path.splitext(original_name)
+        filename = f"{name}_{counter}{ext}"
+        file_path = os.path.join(upload_dir, filename)
+        counter += 1
+    
+    return filename, file_path
+
+@app.route('/upload', methods=['POST'])
+def upload_files():
+    """Handle file uploads"""
+    if 'files' not in request.files:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    files = request.files.getlist('files')
+    current_path = request.form.get('path', '')
+    
+    # Security check
+    upload_dir = safe_join(BASE_DIR, current_path)
+    if not is_safe_path(upload_dir, BASE_DIR):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.exists(upload_dir):
+        return jsonify({'error': 'Directory does not exist'}), 400
+    
+    uploaded_files = []
+    saved = 0
+    for file in files:
+        if file.filename == '':
+            continue
+        
+        filename, file_path = resolve_upload_filename(upload_dir, file.filename)
+        
+        try:
+            with watch_paused(file_path):
+                size, digests = save_hashed(file.stream, file_path)
+                if DEDUP_ENABLED and size >= DEDUP_MIN_SIZE:
+                    saved += dedup_replace(file_path, digests['sha256'], os.stat(file_path))
+                store_checksums(file_path, os.stat(file_path), digests)
+                dir_size_add(file_path, os.path.getsize(file_path))
+                search_index_add(file_path)
+                notify_dir_change(file_path)
+            uploaded_files.append(filename)
+        except Exception as e:
+            return jsonify({'error': f'Failed to save {filename}: {str(e)}'}), 500
+    
+    # Store operation for undo
+    if uploaded_files:
+        journal_record('upload', {'files': [search_rel_path(os.path.join(upload_dir, f)) for f in uploaded_files]})
+    
+    return jsonify({'success': True, 'uploaded': uploaded_files,
+                    'saved_bytes': saved, 'saved_formatted': format_file_size(saved)})
+
+# Resumable chunked uploads: the client opens a session, PUTs chunks at byte offsets
+# (several at once), can ask which ranges arrived, and completes the session, which
+# moves the partial file into place with an atomic rename.
+upload_lock = threading.Lock()
+
+def upload_part_path(upload_id):
+    """Path of the partial file for an upload session"""
+    return os.path.join(UPLOAD_TMP_DIR, f"{upload_id}.part")
+
+def upload_meta_path(upload_id):
+    """Path of the metadata file for an upload session"""
+    return os.path.join(UPLOAD_TMP_DIR, f"{upload_id}.json")
+
+def save_upload_session(upload):
+    """Persist upload session metadata so uploads survive a server restart"""
+    meta_path = upload_meta_path(upload['id'])
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(upload, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+
+def get_upload_session(upload_id):
+    """Read an upload session from disk, where every worker process sees the same state"""
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+        return None
+    
+    try:
+        with open(upload_meta_path(upload_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, IOError, json.JSONDecodeError):
+        return None
+
+@contextmanager
+def upload_session_lock(upload_id):
+    """Serialize read-modify-write of an upload session across threads and worker processes"""
+    with upload_lock:
+        with open(upload_meta_path(upload_id) + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+def discard_upload_session(upload_id):
+    """Forget an upload session and remove its files"""
+    forget_upload_hash(upload_id)
+    for path in (upload_part_path(upload_id), upload_meta_path(upload_id), upload_meta_path(upload_id) + '.lock'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def purge_expired_uploads():
+    """Remove chunked uploads that have not received data for UPLOAD_EXPIRY seconds"""
+    cutoff = time.time() - UPLOAD_EXPIRY
+    for entry in os.scandir(UPLOAD_TMP_DIR):
+        if entry.name.endswith('.json'):
+            try:
+                expired = entry.stat().st_mtime < cutoff
+            except OSError:
+                continue
+            if expired:
+                discard_upload_session(entry.name[:-len('.json')])
+
+def add_byte_range(ranges, start, end):
+    """Merge [start, end) into a sorted list of received ranges"""
+    merged = []
+    for r_start, r_end in sorted(ranges + [[start, end]]):
+        if merged and r_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], r_end)
+        else:
+            merged.append([r_start, r_end])
+    return merged
 
-@app.route('/logout')
-def logout():
-    """Logout and return to viewer mode"""
-    session.pop('admin', None)
-    flash('Logged out', 'info')
-    return redirect(url_for('index'))
+def upload_status(upload):
+    """Progress report for an upload session"""
+    return {
+        'upload_id': upload['id'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'received': upload['received'],
+        'received_bytes': sum(end - start for start, end in upload['received'])
+    }
 
-@app.route('/upload', methods=['POST'])
-def upload_files():
-    """Handle file uploads"""
-    global last_operation
+@app.route('/upload_session', methods=['POST'])
+def create_upload_session():
+    """Start a resumable chunked upload"""
+    data = request.get_json()
+    current_path = data.get('path', '')
+    filename = data.get('name', '')
+    size = data.get('size')
     
-    if 'files' not in request.files:
-        return jsonify({'error': 'No files provided'}), 400
+    if not filename:
+        return jsonify({'error': 'File name required'}), 400
     
-    files = request.files.getlist('files')
-    current_path = request.form.get('path', '')
+    if not isinstance(size, int) or size < 0:
+        return jsonify({'error': 'File size required'}), 400
+    
+    # No bigger than the configured limit, if any, or than the disk can take
+    if CHUNKED_UPLOAD_MAX_SIZE is not None and size > CHUNKED_UPLOAD_MAX_SIZE:
+        return jsonify({'error': f'File is larger than the {format_file_size(CHUNKED_UPLOAD_MAX_SIZE)} limit'}), 413
+    if size > shutil.disk_usage(UPLOAD_TMP_DIR).free:
+        return jsonify({'error': 'Not enough free space on the server'}), 507
     
     # Security check
     upload_dir = safe_join(BASE_DIR, current_path)
     if not is_safe_path(upload_dir, BASE_DIR):
         return jsonify({'error': 'Invalid path'}), 400
     
-    if not os.path.exists(upload_dir):
+    if not os.path.isdir(upload_dir):
         return jsonify({'error': 'Directory does not exist'}), 400
     
+    purge_expired_uploads()
+    
+    upload = {
+        'id': secrets.token_hex(16),
+        'path': current_path,
+        'name': filename,
+        'size': size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'received': [],
+        'created': time.time()
+    }
+    
+    try:
+        # Preallocate a sparse file so chunks can be written at any offset
+        with open(upload_part_path(upload['id']), 'wb') as f:
+            f.truncate(size)
+        save_upload_session(upload)
+    except (OSError, IOError) as e:
+        discard_upload_session(upload['id'])
+        return jsonify({'error': f'Failed to start upload: {str(e)}'}), 500
+    
+    return jsonify({'success': True, **upload_status(upload)})
+
+@app.route('/upload_status')
+def get_upload_status():
+    """Report which byte ranges of a chunked upload have arrived"""
+    upload = get_upload_session(request.args.get('upload_id'))
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    return jsonify({'success': True, **upload_status(upload)})
+
+@app.route('/upload_chunk', methods=['PUT'])
+def upload_chunk():
+    """Write one chunk of a resumable upload at the given byte offset"""
+    upload = get_upload_session(request.args.get('upload_id'))
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Invalid offset'}), 400
+    
+    length = request.content_length
+    if length is None or offset < 0 or offset + length > upload['size']:
+        return jsonify({'error': 'Chunk outside of file'}), 400
+    
+    # Stream the body straight into the partial file without spooling it first
+    written = 0
+    try:
+        with open(upload_part_path(upload['id']), 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                data = request.stream.read(min(DOWNLOAD_CHUNK_SIZE, length - written))
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+    except (OSError, IOError) as e:
+        return jsonify({'error': f'Failed to write chunk: {str(e)}'}), 500
+    
+    with upload_session_lock(upload['id']):
+        # Chunks may be landing in other worker processes at the same time
+        upload = get_upload_session(upload['id']) or upload
+        if written:
+            upload['received'] = add_byte_range(upload['received'], offset, offset + written)
+            save_upload_session(upload)
+        status = upload_status(upload)
+    advance_upload_hash(upload)
+    
+    if written < length:
+        return jsonify({'error': 'Chunk incomplete', **status}), 400
+    
+    return jsonify({'success': True, **status})
+
+@app.route('/upload_complete', methods=['POST'])
+def complete_uploads():
+    """Move finished chunked uploads into place"""
+    data = request.get_json()
+    upload_ids = data.get('upload_ids') or [data.get('upload_id')]
+    
     uploaded_files = []
-    for file in files:
-        if file.filename == '':
+    errors = []
+    saved = 0
+    for upload_id in upload_ids:
+        upload = get_upload_session(upload_id)
+        if not upload:
+            errors.append(f'Upload {upload_id} not found')
             continue
         
-        # Handle Unicode filenames properly
-        original_filename = file.filename
-        filename = secure_filename(original_filename)
-        
-        # If secure_filename stripped all characters (e.g., Cyrillic), use a fallback
-        if not filename:
-            import uuid
-            ext = os.path.splitext(original_filename)[1] if original_filename else '.txt'
-            filename = f"upload_{uuid.uuid4().hex[:8]}{ext}"
-        elif filename != original_filename:
-            # Try to preserve original filename if it's safe
-            try:
-                # Check if original filename is safe for filesystem
-                test_path = os.path.join(upload_dir, original_filename)
-                os.path.normpath(test_path)  # This will raise an exception for unsafe paths
-                if os.path.commonpath([test_path, upload_dir]) == upload_dir:
-                    filename = original_filename
-            except (ValueError, OSError):
-                pass  # Use the secure filename
-        
-        file_path = os.path.join(upload_dir, filename)
+        missing = upload['size'] - upload_status(upload)['received_bytes']
+        if missing:
+            errors.append(f"{upload['name']} is missing {missing} bytes")
+            continue
         
-        # Handle duplicate filenames
-        counter = 1
-        original_name = filename
-        while os.path.exists(file_path):
-            name, ext = os.path.splitext(original_name)
-            filename = f"{name}_{counter}{ext}"
-            file_path = os.path.join(upload_dir, filename)
-            counter += 1
+        upload_dir = safe_join(BASE_DIR, upload['path'])
+        if not os.path.isdir(upload_dir):
+            errors.append(f"Directory for {upload['name']} no longer exists")
+            continue
         
+        part_path = upload_part_path(upload_id)
+        # Mostly hashed already as the chunks came in
         try:
-            file.save(file_path)
-            uploaded_files.append(filename)
-        except Exception as e:
-            return jsonify({'error': f'Failed to save {filename}: {str(e)}'}), 500
+            digests = upload_digests(upload)
+        except OSError:
+            digests = {}
+        digest = digests.get('sha256') if DEDUP_ENABLED and upload['size'] >= DEDUP_MIN_SIZE else None
+        match = dedup_find(digest, upload['size']) if digest else None
+        clone_path, clone_method = dedup_clone(match[0]) if match else (None, None)
+        source_path = clone_path or part_path
+        
+        # Link into place so an existing file is never overwritten, then drop the partial name
+        with watch_paused(upload_dir):
+            while True:
+                filename, file_path = resolve_upload_filename(upload_dir, upload['name'])
+                try:
+                    os.link(source_path, file_path)
+                    break
+                except FileExistsError:
+                    continue
+                except OSError:
+                    # No hard links here (e.g. FAT or another filesystem); fall back to a rename
+                    shutil.move(source_path, file_path)
+                    break
+            
+            if clone_path:
+                if os.path.lexists(clone_path):
+                    os.remove(clone_path)
+                dedup_saved_bytes.inc(upload['size'])
+                saved += upload['size']
+            if digest:
+                dedup_record(file_path, digest, os.stat(file_path), cloned=clone_method == 'reflink')
+            if digests:
+                store_checksums(file_path, os.stat(file_path), digests)
+            discard_upload_session(upload_id)
+            dir_size_add(file_path, upload['size'])
+            search_index_add(file_path)
+            notify_dir_change(file_path)
+        uploaded_files.append(file_path)
     
-    # Store operation for undo
-    last_operation = {
-        'type': 'upload',
-        'files': [os.path.join(upload_dir, f) for f in uploaded_files],
-        'timestamp': datetime.now()
-    }
+    if uploaded_files:
+        # Store operation for undo
+        journal_record('upload', {'files': [search_rel_path(f) for f in uploaded_files]})
+    
+    if errors and not uploaded_files:
+        return jsonify({'error': '; '.join(errors)}), 400
+    
+    return jsonify({
+        'success': True,
+        'uploaded': [os.path.basename(p) for p in uploaded_files],
+        'errors': errors,
+        'saved_bytes': saved,
+        'saved_formatted': format_file_size(saved)
+    })
+
+@app.route('/upload_session', methods=['DELETE'])
+def abort_upload():
+    """Cancel a chunked upload and remove its partial file"""
+    upload = get_upload_session(request.args.get('upload_id'))
+    if not upload:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    discard_upload_session(upload['id'])
+    return jsonify({'success': True})
+
+@app.route('/thumbnail')
+def thumbnail():
+    """Serve a cached thumbnail of an image, rendering it first if needed"""
+    file_path = request.args.get('path', '')
+    try:
+        size = int(request.args.get('size', THUMBNAIL_SIZES[0]))
+    except ValueError:
+        size = 0
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({'error': 'Invalid thumbnail size'}), 400
+    
+    # Security check
+    full_path = safe_join(BASE_DIR, file_path)
+    if not is_safe_path(full_path, BASE_DIR):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.isfile(full_path):
+        return jsonify({'error': 'File not found'}), 404
+    
+    thumb_path = thumbnail_path(full_path, size)
+    if thumb_path is None:
+        return jsonify({'error': 'No thumbnail available for this file'}), 404
     
-    # Emit update to all clients
-    socketio.emit('file_updated', {'path': current_path}, room='file_browser')
+    if os.path.exists(thumb_path):
+        try:
+            os.utime(thumb_path)  # Mark as recently used for eviction
+        except OSError:
+            pass
+    else:
+        try:
+            queue_thumbnail(full_path, thumb_path, size).result(timeout=30)
+        except Exception as e:
+            return jsonify({'error': f'Failed to create thumbnail: {str(e)}'}), 500
     
-    return jsonify({'success': True, 'uploaded': uploaded_files})
+    response = send_file_ranged(thumb_path, as_attachment=False)
+    if request.args.get('v'):
+        # The client versions thumbnail URLs with the file's mtime, so they never go stale
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 @app.route('/download')
 def download_file():
-    """Download a single file"""
+    """Download a single file, or show it inline with inline=1 where that is safe (see inline_type)"""
     file_path = request.args.get('path', '')
+    inline = request.args.get('inline') == '1'
     
     # Security check
     full_path = safe_join(BASE_DIR, file_path)
@@ -335,13 +5123,70 @@ def download_file():
         return jsonify({'error': 'File not found'}), 404
     
     if os.path.isfile(full_path):
-        return send_file(full_path, as_attachment=True)
+        return send_file_ranged(full_path, as_attachment=not inline)
     else:
         return jsonify({'error': 'Path is not a file'}), 400
 
+def send_zip(entries, total_size, fingerprint, download_name):
+    """Response with a ZIP of entries from zip_entries(), from the archive cache where possible"""
+    if 0 < ZIP_CACHE_MAX_BYTES and total_size <= ZIP_CACHE_MAX_BYTES:
+        cache_path = zip_cache_path(fingerprint)
+        try:
+            part_path = start_zip_build(entries, cache_path)
+            part = open(part_path, 'rb') if part_path else None
+        except FileNotFoundError:
+            part = None  # The build finished between the two calls
+        except OSError as e:
+            return jsonify({'error': f'Failed to create ZIP: {str(e)}'}), 500
+        
+        if part is not None and ZIP_STREAMING:
+            zip_cache_total.inc(result='miss')
+            response = Response(stream_with_context(follow_zip_build(part, cache_path)), mimetype='application/zip')
+            response.headers['Content-Disposition'] = content_disposition('attachment', download_name)
+            response.headers['X-Accel-Buffering'] = 'no'  # Keep reverse proxies from buffering the stream
+            return response
+        if part is not None:
+            part.close()
+            zip_cache_total.inc(result='miss')
+            if not wait_zip_build(part_path, cache_path):
+                return jsonify({'error': 'Failed to create ZIP'}), 500
+        else:
+            zip_cache_total.inc(result='hit')
+        
+        try:
+            # Eviction goes by access time; the modification time stays, keeping the ETag valid for resumes
+            st = os.stat(cache_path)
+            os.utime(cache_path, ns=(time.time_ns(), st.st_mtime_ns))
+            return send_file_ranged(cache_path, download_name=download_name)
+        except FileNotFoundError:
+            return jsonify({'error': 'Failed to create ZIP'}), 500
+    
+    zip_cache_total.inc(result='uncached')
+    if ZIP_STREAMING:
+        response = Response(stream_with_context(generate_zip(entries)), mimetype='application/zip')
+        response.headers['Content-Disposition'] = content_disposition('attachment', download_name)
+        response.headers['X-Accel-Buffering'] = 'no'  # Keep reverse proxies from buffering the stream
+        return response
+    
+    # Create temporary zip file
+    temp_dir = tempfile.mkdtemp()
+    zip_path = os.path.join(temp_dir, download_name)
+    
+    try:
+        with open(zip_path, 'wb') as f:
+            for data in generate_zip(entries):
+                f.write(data)
+        
+        response = send_file(zip_path, as_attachment=True, download_name=download_name)
+        response.call_on_close(lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+        return response
+    except Exception as e:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return jsonify({'error': f'Failed to create ZIP: {str(e)}'}), 500
+
 @app.route('/download_folder')
 def download_folder():
-    """Download a folder as ZIP"""
+    """Download a folder as ZIP, or with background=1 build it in a job (202 with the job's ID)"""
     folder_path = request.args.get('path', '')
     
     # Security check
@@ -352,29 +5197,17 @@ def download_folder():
     if not os.path.exists(full_path) or not os.path.isdir(full_path):
         return jsonify({'error': 'Folder not found'}), 404
     
-    # Create temporary zip file
-    temp_dir = tempfile.mkdtemp()
     folder_name = os.path.basename(full_path) or 'files'
-    zip_path = os.path.join(temp_dir, f"{folder_name}.zip")
-    
-    try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(full_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arc_name = os.path.relpath(file_path, full_path)
-                    zipf.write(file_path, arc_name)
-        
-        return send_file(zip_path, as_attachment=True, download_name=f"{folder_name}.zip")
-    except Exception as e:
-        return jsonify({'error': f'Failed to create ZIP: {str(e)}'}), 500
+    if request.args.get('background') == '1':
+        entries, total_size, fingerprint = zip_entries(full_path)
+        job_id = start_job('zip', zip_job, entries, total_size, fingerprint, f"{folder_name}.zip", total=total_size)
+        return jsonify({'success': True, 'job': job_id}), 202
+    return send_zip(*zip_entries(full_path), f"{folder_name}.zip")
 
 @app.route('/create_folder', methods=['POST'])
 @admin_required
 def create_folder():
     """Create a new folder"""
-    global last_operation
-    
     data = request.get_json()
     current_path = data.get('path', '')
     folder_name = data.get('name', '').strip()
@@ -394,17 +5227,14 @@ def create_folder():
         return jsonify({'error': 'Folder already exists'}), 400
     
     try:
-        os.makedirs(new_folder_path)
+        with watch_paused(new_folder_path):
+            os.makedirs(new_folder_path)
+            dir_size_set(new_folder_path, 0)
+            search_index_add(new_folder_path)
+            notify_dir_change(new_folder_path)
         
         # Store operation for undo
-        last_operation = {
-            'type': 'create_folder',
-            'path': new_folder_path,
-            'timestamp': datetime.now()
-        }
-        
-        # Emit update to all clients
-        socketio.emit('file_updated', {'path': current_path}, room='file_browser')
+        journal_record('create_folder', {'path': search_rel_path(new_folder_path)})
         
         return jsonify({'success': True})
     except Exception as e:
@@ -413,9 +5243,7 @@ def create_folder():
 @app.route('/delete', methods=['POST'])
 @admin_required
 def delete_item():
-    """Delete a file or folder"""
-    global last_operation
-    
+    """Delete a file or folder, in a job with background set (202 with the job's ID)"""
     data = request.get_json()
     item_path = data.get('path', '')
     
@@ -427,34 +5255,18 @@ def delete_item():
     if not os.path.exists(full_path):
         return jsonify({'error': 'Item not found'}), 404
     
-    # Create backup for undo
-    backup_path = None
-    if os.path.isfile(full_path):
-        backup_dir = tempfile.mkdtemp()
-        backup_path = os.path.join(backup_dir, os.path.basename(full_path))
-        shutil.copy2(full_path, backup_path)
-    elif os.path.isdir(full_path):
-        backup_dir = tempfile.mkdtemp()
-        backup_path = os.path.join(backup_dir, os.path.basename(full_path))
-        shutil.copytree(full_path, backup_path)
+    if full_path == BASE_DIR:
+        return jsonify({'error': 'Cannot delete the root folder'}), 400
+    
+    if data.get('background'):
+        job_id = start_job('delete', delete_job, full_path, undo_session_id(), total=1)
+        return jsonify({'success': True, 'job': job_id}), 202
     
     try:
-        if os.path.isfile(full_path):
-            os.remove(full_path)
-        else:
-            shutil.rmtree(full_path)
+        trash_rel, removed_size = trash_item(full_path)
         
         # Store operation for undo
-        last_operation = {
-            'type': 'delete',
-            'original_path': full_path,
-            'backup_path': backup_path,
-            'timestamp': datetime.now()
-        }
-        
-        # Emit update to all clients
-        current_dir = os.path.dirname(item_path)
-        socketio.emit('file_updated', {'path': current_dir}, room='file_browser')
+        journal_record('delete', {'path': search_rel_path(full_path)}, trash=trash_rel, size=removed_size)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -464,8 +5276,6 @@ def delete_item():
 @admin_required
 def rename_item():
     """Rename a file or folder"""
-    global last_operation
-    
     data = request.get_json()
     old_path = data.get('path', '')
     new_name = data.get('name', '').strip()
@@ -489,73 +5299,393 @@ def rename_item():
         return jsonify({'error': 'Name already exists'}), 400
     
     try:
-        os.rename(full_old_path, new_full_path)
+        with watch_paused(full_old_path, new_full_path):
+            os.rename(full_old_path, new_full_path)
+            dir_size_move(full_old_path, new_full_path)
+            search_index_move(full_old_path, new_full_path)
+            notify_dir_change(new_full_path, old_path=full_old_path)
         
         # Store operation for undo
-        last_operation = {
-            'type': 'rename',
-            'old_path': full_old_path,
-            'new_path': new_full_path,
-            'timestamp': datetime.now()
-        }
-        
-        # Emit update to all clients
-        current_dir = os.path.dirname(old_path)
-        socketio.emit('file_updated', {'path': current_dir}, room='file_browser')
+        journal_record('rename', {'old_path': search_rel_path(full_old_path), 'new_path': search_rel_path(new_full_path)})
         
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': f'Failed to rename: {str(e)}'}), 500
 
+def resolve_bulk_paths(rel_paths):
+    """Absolute paths of the items of a bulk request, without duplicates and items inside
+    other selected folders; returns (paths, None) or (None, (error, status))"""
+    full_paths = set()
+    for rel_path in rel_paths:
+        full_path = safe_join(BASE_DIR, rel_path) if isinstance(rel_path, str) else None
+        if full_path is None or not is_safe_path(full_path, BASE_DIR) or full_path == BASE_DIR:
+            return None, (f'Invalid path: {rel_path}', 400)
+        if not os.path.exists(full_path):
+            return None, (f'{rel_path} not found', 404)
+        full_paths.add(full_path)
+    
+    # A selected folder already covers whatever is selected inside it
+    selected = []
+    for full_path in sorted(full_paths):
+        parent = os.path.dirname(full_path)
+        while parent != BASE_DIR and parent not in full_paths:
+            parent = os.path.dirname(parent)
+        if parent == BASE_DIR:
+            selected.append(full_path)
+    return selected, None
+
+def run_bulk(action, items, session_id, job=None):
+    """Delete items, or move or copy (old, new) pairs, as a single undoable step; returns how many were done
+
+    If an item fails, the items already done are put back and OperationError is raised. In a
+    job, progress is reported per item (per byte for copies) and cancelling puts the items
+    done back as well.
+    """
+    slot = new_trash_slot() if action == 'delete' else None
+    steps = []
+    copied = 0
+    if action == 'copy' and job:
+        total_bytes = sum(get_dir_size(old) or 0 if os.path.isdir(old) else os.path.getsize(old) for old, new in items)
+    
+    with dir_deltas_held():
+        try:
+            for i, item in enumerate(items):
+                current = item if action == 'delete' else item[0]
+                if action == 'copy':
+                    progress = None
+                    if job:
+                        job_progress(job, copied, total_bytes)
+                        progress = lambda n, base=copied: job_progress(job, base + n, total_bytes)
+                    size = copy_item(*item, progress=progress)
+                    copied += size
+                    steps.append({'type': 'copy', 'path': search_rel_path(item[1]), 'size': size})
+                    continue
+                if job:
+                    job_progress(job, i, len(items))
+                if action == 'delete':
+                    trash_rel, size = trash_item(item, f"{slot}/{i}")
+                    steps.append({'type': 'delete', 'path': search_rel_path(item), 'trash': trash_rel, 'size': size})
+                else:
+                    move_item(*item)
+                    steps.append({'type': 'move', 'old_path': search_rel_path(item[0]), 'new_path': search_rel_path(item[1])})
+        except Exception as e:
+            # Put back what was done, so the batch happens completely or not at all
+            for step in reversed(steps):
+                try:
+                    undo_operation(step)
+                except Exception:
+                    log.exception("Failed to roll back bulk step", extra={'step': step})
+            if isinstance(e, JobCancelled):
+                raise
+            raise OperationError(f'Failed to {action} {os.path.basename(current)}: {str(e)}') from e
+    
+    if steps:
+        sizes = [step.get('size') for step in steps]
+        total_size = None if None in sizes else sum(sizes)
+        journal_record('bulk', {'action': action, 'steps': steps}, trash=slot, size=total_size if slot else None,
+                       session_id=session_id)
+    return len(steps)
+
+def bulk_job(job, action, items, session_id):
+    """Job: a bulk delete, move or copy"""
+    return {'action': action, 'count': run_bulk(action, items, session_id, job)}
+
+@app.route('/bulk', methods=['POST'])
+def bulk_operation():
+    """Delete, move, copy or download several items at once
+
+    Takes JSON with action ('delete', 'move', 'copy' or 'download'), paths and, for moves and
+    copies, the destination folder; downloads may also be posted as a form. A delete, move or
+    copy is a single step: one undo reverses it, browsers get one update when it is done, and
+    if an item fails the items already done are put back. With background set, it runs as a
+    job (202 with the job's ID), which reports progress per item (per byte for copies) and can
+    be cancelled. Copies into the folder they are in get a numbered name.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {'action': request.form.get('action'), 'paths': request.form.getlist('paths')}
+    action = data.get('action')
+    rel_paths = data.get('paths')
+    
+    if action not in ('delete', 'move', 'copy', 'download'):
+        return jsonify({'error': 'Unknown bulk action'}), 400
+    if action != 'download' and not is_admin():
+        return jsonify({'error': 'Admin access required'}), 403
+    if not isinstance(rel_paths, list) or not rel_paths:
+        return jsonify({'error': 'No items selected'}), 400
+    if len(rel_paths) > BULK_MAX_ITEMS:
+        return jsonify({'error': f'At most {BULK_MAX_ITEMS} items can be selected at once'}), 400
+    
+    full_paths, error = resolve_bulk_paths(rel_paths)
+    if error:
+        return jsonify({'error': error[0]}), error[1]
+    
+    if action == 'download':
+        parent = os.path.commonpath([os.path.dirname(p) for p in full_paths])
+        name = os.path.basename(full_paths[0] if len(full_paths) == 1 else parent) or 'files'
+        return send_zip(*zip_entries(parent, full_paths), f"{name}.zip")
+    
+    if action in ('move', 'copy'):
+        destination = safe_join(BASE_DIR, str(data.get('destination') or '').strip('/'))
+        if not is_safe_path(destination, BASE_DIR):
+            return jsonify({'error': 'Invalid destination'}), 400
+        if not os.path.isdir(destination):
+            return jsonify({'error': 'Destination folder not found'}), 404
+        
+        items = []
+        targets = set()
+        for full_path in full_paths:
+            if destination == full_path or destination.startswith(full_path + os.sep):
+                return jsonify({'error': f'Cannot {action} {os.path.basename(full_path)} into itself'}), 400
+            new_path = os.path.join(destination, os.path.basename(full_path))
+            if new_path == full_path:
+                if action == 'move':
+                    continue  # Already there
+                # A copy next to the original, named like a duplicate upload
+                name, ext = os.path.splitext(os.path.basename(full_path))
+                counter = 1
+                while new_path in targets or os.path.lexists(new_path):
+                    new_path = os.path.join(destination, f"{name}_{counter}{ext}")
+                    counter += 1
+            if new_path in targets or os.path.lexists(new_path):
+                return jsonify({'error': f'{os.path.basename(full_path)} already exists in the destination'}), 409
+            targets.add(new_path)
+            items.append((full_path, new_path))
+    else:
+        items = full_paths
+    
+    if data.get('background'):
+        # Copies report bytes, so their total is only known once the job has summed the sizes
+        job_id = start_job('bulk', bulk_job, action, items, undo_session_id(),
+                           total=None if action == 'copy' else len(items))
+        return jsonify({'success': True, 'job': job_id}), 202
+    
+    try:
+        count = run_bulk(action, items, undo_session_id())
+    except OperationError as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'success': True, 'count': count})
+
 @app.route('/undo', methods=['POST'])
 @admin_required
 def undo_last_action():
-    """Undo the last file operation"""
-    global last_operation
-    
-    if not last_operation:
+    """Undo the most recent operation of this session, in a job with background set (202 with the job's ID)"""
+    history = journal_history(limit=1)
+    if not history:
         return jsonify({'error': 'No operation to undo'}), 400
+    op = history[0]
+    
+    if (request.get_json(silent=True) or {}).get('background'):
+        job_id = start_job('undo', undo_job, op, total=1)
+        return jsonify({'success': True, 'job': job_id}), 202
     
     try:
-        op_type = last_operation['type']
-        
-        if op_type == 'upload':
-            # Delete uploaded files
-            for file_path in last_operation['files']:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-        
-        elif op_type == 'create_folder':
-            # Remove created folder
-            if os.path.exists(last_operation['path']):
-                os.rmdir(last_operation['path'])
-        
-        elif op_type == 'delete':
-            # Restore from backup
-            if last_operation['backup_path'] and os.path.exists(last_operation['backup_path']):
-                if os.path.isfile(last_operation['backup_path']):
-                    shutil.copy2(last_operation['backup_path'], last_operation['original_path'])
-                else:
-                    shutil.copytree(last_operation['backup_path'], last_operation['original_path'])
-        
-        elif op_type == 'rename':
-            # Restore original name
-            if os.path.exists(last_operation['new_path']):
-                os.rename(last_operation['new_path'], last_operation['old_path'])
-        
-        # Clear last operation
-        last_operation = None
-        
-        # Emit update to all clients
-        socketio.emit('file_updated', {'path': ''}, room='file_browser')
-        
-        return jsonify({'success': True})
+        error = undo_operation(op)
     except Exception as e:
         return jsonify({'error': f'Failed to undo: {str(e)}'}), 500
+    
+    # Either undone or impossible to undo; in both cases the next undo goes one step further back
+    journal_remove(op['id'])
+    if error:
+        return jsonify({'error': f'Cannot undo {describe_operation(op)}: {error}'}), 409
+    return jsonify({'success': True, 'undone': describe_operation(op)})
+
+@app.route('/undo_history')
+@admin_required
+def undo_history():
+    """Undoable operations of this session, newest first"""
+    history = journal_history()
+    return jsonify({'operations': [{
+        'type': op['type'],
+        'description': describe_operation(op),
+        'timestamp': datetime.fromtimestamp(op['created']).strftime('%Y-%m-%d %H:%M:%S')
+    } for op in history]})
+
+@app.route('/jobs')
+def list_jobs():
+    """Background jobs of this session, newest first"""
+    with job_lock:
+        rows = jobs_db.execute('''
+            SELECT id, kind, status, done, total, result, error, worker, created FROM jobs
+            WHERE session = ? ORDER BY created DESC
+        ''', (undo_session_id(),)).fetchall()
+    return jsonify({'jobs': [job_view(row) for row in rows]})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """State of a background job of this session"""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job_request(job_id):
+    """Cancel a background job of this session"""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] not in JOB_ACTIVE:
+        return jsonify({'error': f"Job is {job['status']} already"}), 409
+    cancel_job(job_id)
+    return jsonify({'success': True})
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    """Download the ZIP a finished job built"""
+    job = get_job(job_id)
+    if not job or job['kind'] != 'zip':
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': 'The ZIP is not ready'}), 409
+    result = job['result']
+    path = os.path.join(ZIP_CACHE_DIR if result['cached'] else JOB_DIR, result['file'])
+    try:
+        # Eviction goes by access time; the modification time stays, keeping the ETag valid for resumes
+        st = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+    except FileNotFoundError:
+        return jsonify({'error': 'The ZIP has expired; download the folder again'}), 410
+    return send_file_ranged(path, download_name=result['name'])
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of this server (all workers in multi-worker mode)"""
+    return Response(render_metrics(collect_metrics()), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+BUS_HANDLERS['profiling'] = lambda settings: set_profiling(settings, publish=False)
+
+@app.route('/profiling', methods=['GET', 'POST'])
+@admin_required
+def profiling_settings():
+    """Show or change request profiling; POST {enabled, routes, sample}"""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            set_profiling({**profiling, **data})
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid profiling settings'}), 400
+    
+    profiles = sorted((e.name for e in os.scandir(PROFILE_DIR) if e.name.endswith('.prof')), reverse=True)
+    return jsonify({'success': True, **profiling, 'profiles': profiles})
+
+@app.route('/bandwidth', methods=['GET', 'POST'])
+@admin_required
+def bandwidth_settings():
+    """Show or change the bandwidth limits; POST any of the keys of the bandwidth section of config.json"""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            with shared_text_lock:
+                set_bandwidth({**bandwidth, **data})
+                snapshot = dict(config)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid bandwidth settings'}), 400
+        if not save_config(snapshot):
+            return jsonify({'error': 'Failed to save config file'}), 500
+    return jsonify({'success': True, **bandwidth})
+
+@app.route('/profiling/<name>')
+@admin_required
+def download_profile(name):
+    """Download a saved profile for pstats or snakeviz"""
+    path = os.path.join(PROFILE_DIR, secure_filename(name))
+    if not name.endswith('.prof') or not os.path.isfile(path):
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, as_attachment=True)
+
+@app.route('/dedup')
+@admin_required
+def dedup_status():
+    """Deduplication status: indexed files, bytes saved and the last background scan"""
+    return jsonify({'success': True, 'enabled': DEDUP_ENABLED, **dedup_stats()})
+
+@app.route('/dedup/scan', methods=['POST'])
+@admin_required
+def start_dedup_scan():
+    """Ask the background job to deduplicate BASE_DIR now"""
+    if not DEDUP_ENABLED:
+        return jsonify({'error': 'Deduplication is disabled'}), 400
+    dedup_scan_wanted.set()
+    bus_publish('dedup_scan')
+    return jsonify({'success': True})
+
+@app.route('/checksum')
+def checksum():
+    """Digests of a file for checking a download; cached ones come back at once
+
+    A file without cached digests is hashed in the request, or with background=1 in a job
+    (202 with the job's ID) whose result holds the digests.
+    """
+    file_path = request.args.get('path', '')
+    
+    # Security check
+    full_path = safe_join(BASE_DIR, file_path)
+    if not is_safe_path(full_path, BASE_DIR):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.isfile(full_path):
+        return jsonify({'error': 'File not found'}), 404
+    
+    st = os.stat(full_path)
+    digests = cached_checksums(st)
+    if all(algorithm in digests for algorithm in checksum_algorithms):
+        checksum_lookups_total.inc(result='hit')
+        return jsonify({'success': True, 'path': search_rel_path(full_path), 'size': st.st_size,
+                        'checksums': digests, 'cached': True})
+    
+    if request.args.get('background'):
+        job_id = start_job('checksum', checksum_job, full_path, total=st.st_size)
+        return jsonify({'success': True, 'job': job_id}), 202
+    
+    try:
+        digests = file_checksums(full_path)
+    except OSError as e:
+        return jsonify({'error': f'Failed to read file: {str(e)}'}), 500
+    return jsonify({'success': True, 'path': search_rel_path(full_path), 'size': st.st_size,
+                    'checksums': digests, 'cached': False})
+
+@app.route('/checksum/manifest')
+def checksum_manifest():
+    """Digests of every file below a folder, in the format of sha256sum and friends, for checking a whole download
+
+    Paths are relative to the folder, so `sha256sum -c` run inside a downloaded copy checks it.
+    Files without cached digests are hashed while the manifest streams.
+    """
+    folder_path = request.args.get('path', '')
+    algorithm = request.args.get('algorithm', 'sha256')
+    if algorithm not in checksum_algorithms:
+        return jsonify({'error': f"Unknown algorithm; available: {', '.join(checksum_algorithms)}"}), 400
+    
+    # Security check
+    full_path = safe_join(BASE_DIR, folder_path)
+    if not is_safe_path(full_path, BASE_DIR):
+        return jsonify({'error': 'Invalid path'}), 400
+    
+    if not os.path.isdir(full_path):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    def files():
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                if os.path.isfile(file_path):
+                    yield file_path
+    
+    def generate():
+        for file_path, digests in checksum_many(files()):
+            yield manifest_line(digests[algorithm], os.path.relpath(file_path, full_path).replace(os.sep, '/'))
+    
+    name = os.path.basename(full_path) if full_path != BASE_DIR else 'files'
+    response = Response(generate(), mimetype='text/plain')
+    response.headers['Content-Disposition'] = content_disposition('attachment', f"{name}.{algorithm}")
+    response.headers['X-Accel-Buffering'] = 'no'  # Lines go out as files are hashed
+    return response
 
 @app.route('/preview')
 def preview_file():
-    """Preview a text file"""
+    """Page through a text file: offset (bytes), before (page ending there), line (1-based) or tail (lines)"""
     file_path = request.args.get('path', '')
     
     # Security check
@@ -566,65 +5696,315 @@ def preview_file():
     if not os.path.exists(full_path) or not os.path.isfile(full_path):
         return jsonify({'error': 'File not found'}), 404
     
+    def as_int(name):
+        value = request.args.get(name)
+        return int(value) if value not in (None, '') else None
+    
+    try:
+        page_args = {
+            'offset': as_int('offset'),
+            'before': as_int('before'),
+            'line': as_int('line'),
+            'tail': as_int('tail'),
+            'length': as_int('length') or PREVIEW_PAGE_BYTES,
+            'lines': as_int('lines')
+        }
+    except ValueError:
+        return jsonify({'error': 'Invalid page position'}), 400
+    
     try:
         # Check if file is text
         mimetype, _ = mimetypes.guess_type(full_path)
         if mimetype and not mimetype.startswith('text/'):
             return jsonify({'error': 'File is not a text file'}), 400
         
-        with open(full_path, 'r', encoding='utf-8-sig', errors='replace') as f:
-            content = f.read(10000)  # Limit to first 10KB
-        
-        return jsonify({'success': True, 'content': content})
+        return jsonify({'success': True, **read_text_page(full_path, **page_args)})
     except Exception as e:
         return jsonify({'error': f'Failed to read file: {str(e)}'}), 500
 
+@app.route('/archive')
+def browse_archive():
+    """List a folder inside a ZIP or tar archive: path (the archive) and dir (folder in it)"""
+    resolved, error = resolve_archive_request()
+    if error:
+        return error
+    full_path, index, _ = resolved
+    folder = archive_member_name(request.args.get('dir', '')) or ''
+    items = list_archive_dir(index, folder)
+    if folder and not items and folder not in index['lookup']:
+        return jsonify({'error': 'Folder not found in archive'}), 404
+    return jsonify({'success': True, 'kind': index['kind'], 'dir': folder, 'items': items,
+                    'members': len(index['members'])})
+
+@app.route('/archive/member')
+def download_archive_member():
+    """Stream one member out of an archive without extracting it, or show it inline with inline=1 where that is safe"""
+    resolved, error = resolve_archive_request(member_required=True)
+    if error:
+        return error
+    full_path, index, member = resolved
+    inline = request.args.get('inline') == '1'
+    name = posixpath.basename(member[0])
+    if inline:
+        mimetype, disposition = inline_type(name)
+    else:
+        mimetype, disposition = mimetypes.guess_type(name)[0] or 'application/octet-stream', 'attachment'
+    response = Response(stream_with_context(read_archive_member(full_path, index, member)), mimetype=mimetype)
+    response.headers['Content-Length'] = str(member[2])
+    response.headers['Content-Disposition'] = content_disposition(disposition, name)
+    if inline:
+        response.headers.update(INLINE_HEADERS)
+    return response
+
+@app.route('/archive/preview')
+def preview_archive_member():
+    """First PREVIEW_PAGE_BYTES of a text member of an archive"""
+    resolved, error = resolve_archive_request(member_required=True)
+    if error:
+        return error
+    full_path, index, member = resolved
+    mimetype, _ = mimetypes.guess_type(member[0])
+    if mimetype and not mimetype.startswith('text/'):
+        return jsonify({'error': 'Member is not a text file'}), 400
+    try:
+        data = b''.join(read_archive_member(full_path, index, member, limit=PREVIEW_PAGE_BYTES))
+    except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+        return jsonify({'error': f'Failed to read archive: {str(e)}'}), 500
+    if b'\0' in data:
+        return jsonify({'error': 'Member is not a text file'}), 400
+    return jsonify({'success': True, 'content': data[:utf8_boundary(data, 0, len(data))].decode('utf-8', 'replace'),
+                    'size': member[2], 'truncated': member[2] > len(data)})
+
 @app.route('/shared_text')
 def get_shared_text():
-    """Get shared text content"""
-    return jsonify(shared_text_content)
+    """Get shared text content and its version"""
+    return jsonify(shared_text_state())
 
 @app.route('/shared_text', methods=['POST'])
 def update_shared_text():
-    """Update shared text content"""
-    global shared_text_content, config
-    
-    data = request.get_json()
+    """Replace the shared text; the browser sends operations over Socket.IO instead"""
+    data = request.get_json() or {}
     content = data.get('content', '')
+    if not isinstance(content, str):
+        return jsonify({'error': 'Content must be a string'}), 400
     
-    shared_text_content['content'] = content
-    
-    # Save to config file for persistence
-    config['shared_text'] = content
-    success = save_config(config)
-    
-    if success:
-        print(f"Shared text updated and saved: {content[:50]}...")
-    else:
-        print("Failed to save shared text to config file")
-    
-    # Emit update to all clients
-    socketio.emit('shared_text_updated', shared_text_content, room='shared_text')
+    with shared_text_lock:
+        op = []
+        shared_text_catch_up()
+        text_op_push(op, -text_units(shared_text_content['content']))
+        text_op_push(op, content)
+        version, op = shared_text_apply(op, shared_text_content['version'])
+        socketio.emit('shared_text_op', {'version': version, 'op': op}, room='shared_text')
     
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'version': version})
 
 # SocketIO events
+socket_folders = {}  # Socket id -> room of the folder that client is viewing
+
 @socketio.on('connect')
 def on_connect():
     """Handle client connection"""
-    join_room('file_browser')
     join_room('shared_text')
 
+@socketio.on('subscribe')
+def on_subscribe(data):
+    """Move a client to the room of the folder it is viewing"""
+    current_path = (data or {}).get('path', '')
+    full_path = safe_join(BASE_DIR, current_path)
+    if not is_safe_path(full_path, BASE_DIR):
+        return {'error': 'Invalid path'}
+    
+    room = dir_room(search_rel_path(full_path))
+    previous = socket_folders.get(request.sid)
+    if previous and previous != room:
+        leave_room(previous)
+    join_room(room)
+    socket_folders[request.sid] = room
+    return {'success': True}
+
+@socketio.on('job_subscribe')
+def on_job_subscribe(data):
+    """Send a client the progress events of a job; its random ID is what lets a client follow it"""
+    job_id = str((data or {}).get('id', ''))
+    if not re.fullmatch(r'[0-9a-f]{16}', job_id):
+        return {'error': 'Invalid job'}
+    join_room(job_room(job_id))
+    return {'success': True}
+
+@socketio.on('shared_text_sync')
+def on_shared_text_sync():
+    """Send the full shared text to a client that is new or too far behind"""
+    with shared_text_lock:
+        shared_text_catch_up()
+        emit('shared_text_state', dict(shared_text_content))
+
+@socketio.on('shared_text_op')
+def on_shared_text_op(data):
+    """Apply a client's shared text operation and pass it on to everyone else"""
+    data = data or {}
+    with shared_text_lock:
+        try:
+            result = shared_text_apply(data.get('op') or [], int(data.get('version', -1)))
+        except (ValueError, TypeError):
+            result = None
+        if result is None:
+            # Unusable or too old to transform: the client starts over from the current text
+            shared_text_catch_up()
+            emit('shared_text_state', dict(shared_text_content))
+            return
+        
+        version, op = result
+        # Sent under the lock so this worker's clients get them in version order; operations
+        # from other workers arrive through the message queue and clients reorder by version
+        socketio.emit('shared_text_op', {'version': version, 'op': op}, room='shared_text', skip_sid=request.sid)
+        emit('shared_text_ack', {'version': version})
+
+# Followed text previews: socket id -> {'path', 'offset'} with the offset of the bytes already sent
+preview_follows = {}
+preview_follow_lock = threading.Lock()
+preview_follow_thread = None
+
+def preview_follow_loop():
+    """Send text appended to followed files; one read serves every client at the same offset"""
+    while True:
+        time.sleep(PREVIEW_FOLLOW_INTERVAL)
+        groups = {}
+        with preview_follow_lock:
+            for sid, follow in preview_follows.items():
+                groups.setdefault((follow['path'], follow['offset']), []).append(sid)
+        
+        for (full_path, offset), sids in groups.items():
+            try:
+                update = read_appended_text(full_path, offset)
+            except OSError:
+                update = None
+            if update is not None and update[1] == offset:
+                continue
+            
+            rel = search_rel_path(full_path)
+            if update is None:
+                # Truncated, rotated, removed or too far ahead: the browser reloads the end instead
+                payload = {'path': rel, 'reset': True}
+            else:
+                content, end, size = update
+                payload = {'path': rel, 'offset': offset, 'end': end, 'size': size, 'content': content}
+            with preview_follow_lock:
+                for sid in sids:
+                    if update is None:
+                        preview_follows.pop(sid, None)
+                    elif sid in preview_follows:
+                        preview_follows[sid]['offset'] = payload['end']
+            for sid in sids:
+                socketio.emit('preview_append', payload, to=sid)
+
+@socketio.on('preview_follow')
+def on_preview_follow(data):
+    """Stream what gets appended to a text file, starting at the client's byte offset"""
+    global preview_follow_thread
+    data = data or {}
+    full_path = safe_join(BASE_DIR, data.get('path', ''))
+    if not is_safe_path(full_path, BASE_DIR) or not os.path.isfile(full_path):
+        return {'error': 'File not found'}
+    try:
+        offset = max(int(data.get('offset', 0)), 0)
+    except (TypeError, ValueError):
+        return {'error': 'Invalid offset'}
+    
+    with preview_follow_lock:
+        preview_follows[request.sid] = {'path': full_path, 'offset': offset}
+        if preview_follow_thread is None:
+            preview_follow_thread = threading.Thread(target=preview_follow_loop, daemon=True)
+            preview_follow_thread.start()
+    return {'success': True}
+
+@socketio.on('preview_unfollow')
+def on_preview_unfollow():
+    """Stop streaming a followed text file"""
+    with preview_follow_lock:
+        preview_follows.pop(request.sid, None)
+
 @socketio.on('disconnect')
 def on_disconnect():
     """Handle client disconnection"""
-    leave_room('file_browser')
+    with preview_follow_lock:
+        preview_follows.pop(request.sid, None)
+    room = socket_folders.pop(request.sid, None)
+    if room:
+        leave_room(room)
     leave_room('shared_text')
 
+services_started = False
+leader_lock_file = None
+
+def acquire_leadership():
+    """Become the worker that runs the tree-wide background services; True if this one is it"""
+    global leader_lock_file
+    if fcntl is None:
+        return True
+    lock_file = open(os.path.join(DATA_DIR, "leader.lock"), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    leader_lock_file = lock_file  # Held open for the life of the process
+    return True
+
+def start_leader_services():
+    """Background services that must run in exactly one process"""
+    if DIR_SIZE_LAZY:
+        # Build the whole size index with a single walk while the server starts up
+        with dir_size_lock:
+            dir_size_pending.add(BASE_DIR)
+        dir_size_executor.submit(dir_size_task, BASE_DIR)
+    
+    # Catch up with changes made while the server was down; the old index serves searches meanwhile
+    socketio.start_background_task(rebuild_search_index)
+    
+    if WATCH_FILESYSTEM:
+        start_watcher()
+    
+    threading.Thread(target=trash_purge_loop, daemon=True).start()
+    trash_purge_wanted.set()
+    
+    if DEDUP_ENABLED:
+        threading.Thread(target=dedup_scan_loop, daemon=True).start()
+    
+    if CHECKSUM_SCAN:
+        threading.Thread(target=checksum_scan_loop, daemon=True).start()
+
+def await_leadership():
+    """Background thread taking over the leader's services if its process goes away"""
+    while not acquire_leadership():
+        time.sleep(10)
+    log.info("Took over background services", extra={'worker': os.getpid()})
+    start_leader_services()
+
+def start_services():
+    """Start background services once per process; with several workers one of them leads"""
+    global services_started
+    if services_started:
+        return
+    services_started = True
+    if MESSAGE_QUEUE:
+        socketio.server.manager.initialize()
+        threading.Thread(target=metrics_snapshot_loop, daemon=True).start()
+    if acquire_leadership():
+        start_leader_services()
+    else:
+        threading.Thread(target=await_leadership, daemon=True).start()
+
+def create_app():
+    """Application factory for running several workers, e.g.
+    PFSHARE_MESSAGE_QUEUE=sqlite gunicorn -k eventlet -w 4 -b 0.0.0.0:80 'pfshare:create_app()'
+    """
+    start_services()
+    return app
+
 if __name__ == '__main__':
-    print(f"Starting Flask File Server...")
-    print(f"Serving files from: {BASE_DIR}")
-    print(f"Admin password: {ADMIN_PASSWORD}")
-    print(f"Access the server at: http://localhost:80")
+    start_services()
+    
+    log.info("Starting Flask File Server", extra={'files': BASE_DIR, 'url': 'http://localhost:80'})
+    print(f"Admin password: {ADMIN_PASSWORD}")  # Console only, kept out of the logs
     
-    socketio.run(app, host='0.0.0.0', port=80, debug=False)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=80, debug=False)
@@ -0,0 +1,2129 @@
+// Global variables
+let socket;
+let viewMode = localStorage.getItem('viewMode') || 'list';
+let contextMenuItem = null;
+let downloadQueue = [];
+const selectedPaths = new Set();  // Ticked items, kept while scrolling and across live updates
+const jobWaiters = new Map();  // Background job ID -> callbacks waiting for it to finish
+let draggedPaths = null;  // Items being dragged onto a folder, while a drag from the list is going on
+// Shared text: edits are sent as operations against the last version seen from the server
+const sharedText = {
+    version: null,       // Server version of confirmed
+    confirmed: '',       // Text at that version
+    base: '',            // confirmed plus the operation awaiting acknowledgement
+    outstanding: null,   // Operation sent but not acknowledged yet
+    syncing: true,       // Waiting for the full text after (re)connecting
+    received: {},        // Operations and acks that arrived ahead of an earlier version
+    timer: null
+};
+const UPLOAD_PARALLEL_CHUNKS = 4;
+const FILE_ROW_HEIGHT = 52;  // Must match .file-list-rows .file-item
+const FILE_ROW_OVERSCAN = 10;
+const GRID_ROW_HEIGHT = 160;  // Must match .file-tile
+const GRID_TILE_MIN_WIDTH = 140;
+const THUMBNAIL_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tif', 'tiff'];
+const PREVIEW_IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp'];
+const ARCHIVE_PATTERN = /\.(zip|tar|tar\.gz|tgz|tar\.bz2|tbz2|tar\.xz|txz)$/i;  // Archives /archive can browse
+const ITEM_DRAG_TYPE = 'application/x-pfshare-paths';  // Marks drags of listed items, as opposed to files from outside
+
+// Loaded part of the current listing; next is a cursor (/api/list) or page number (/api/search)
+const fileList = {
+    items: [],
+    next: null,
+    source: null,
+    loading: false,
+    complete: false,
+    requestId: 0,
+    renderedRange: null,
+    checksumAlgorithm: 'sha256'  // Digest listed files carry, from /api/list
+};
+const UPLOAD_CHUNK_RETRIES = 3;
+
+// Initialize Socket.IO
+document.addEventListener('DOMContentLoaded', function() {
+    socket = websocketOnly ? io({transports: ['websocket']}) : io();
+
+    let connectedBefore = false;
+    socket.on('connect', function() {
+        console.log('Connected to server');
+        socket.emit('subscribe', {path: currentPath});
+        sharedText.syncing = true;
+        socket.emit('shared_text_sync');
+        // Rooms are per connection; follow the jobs still running again
+        jobWaiters.forEach((waiter, id) => subscribeJob(id));
+        // Changes made while disconnected were missed
+        if (connectedBefore) {
+            reloadFileList();
+            if (textPreview && textPreview.following) {
+                loadTextPage({offset: textPreview.end});
+            }
+        }
+        connectedBefore = true;
+    });
+
+    socket.on('dir_delta', function(data) {
+        // A null path resets every folder
+        if (data.path === currentPath || data.path === null) {
+            applyDirDelta(data);
+        }
+    });
+
+    socket.on('dir_size_updated', function(data) {
+        const item = fileList.items.find(i => i.path === data.path);
+        if (item) {
+            item.size = data.size;
+            item.size_formatted = data.size_formatted;
+            item.size_pending = false;
+            renderFileList(true);
+        }
+    });
+
+    socket.on('shared_text_state', applySharedTextState);
+    socket.on('shared_text_op', data => receiveSharedText(data.version, data.op));
+    socket.on('shared_text_ack', data => receiveSharedText(data.version, null));
+    socket.on('preview_append', appendTextPreview);
+    socket.on('job_progress', handleJobProgress);
+
+    initializeTheme();
+    initializeFileList();
+    initializeFileHandling();
+    initializeSharedText();
+    initializeSearch();
+    initializeSorting();
+    resumeZipJobs();
+});
+
+// Theme handling
+function initializeTheme() {
+    const themeToggle = document.getElementById('themeToggle');
+    const savedTheme = localStorage.getItem('theme');
+    const systemPrefersDark = window.matchMedia('(prefers-color-scheme: dark)').matches;
+
+    const theme = savedTheme || (systemPrefersDark ? 'dark' : 'light');
+    setTheme(theme);
+
+    themeToggle.addEventListener('click', toggleTheme);
+
+    // Listen for system theme changes
+    window.matchMedia('(prefers-color-scheme: dark)').addEventListener('change', (e) => {
+        if (!localStorage.getItem('theme')) {
+            setTheme(e.matches ? 'dark' : 'light');
+        }
+    });
+}
+
+function setTheme(theme) {
+    document.documentElement.setAttribute('data-theme', theme);
+    const icon = document.querySelector('#themeToggle i');
+    icon.className = theme === 'dark' ? 'fas fa-sun' : 'fas fa-moon';
+    localStorage.setItem('theme', theme);
+}
+
+function toggleTheme() {
+    const currentTheme = document.documentElement.getAttribute('data-theme');
+    const newTheme = currentTheme === 'dark' ? 'light' : 'dark';
+    setTheme(newTheme);
+}
+
+// File list
+function initializeFileList() {
+    const viewport = document.getElementById('fileListViewport');
+
+    viewport.addEventListener('scroll', () => requestAnimationFrame(() => renderFileList()));
+    window.addEventListener('resize', () => renderFileList(true));
+
+    const viewToggle = document.getElementById('viewToggle');
+    viewToggle.addEventListener('click', () => {
+        setViewMode(viewMode === 'grid' ? 'list' : 'grid');
+    });
+    setViewMode(viewMode);
+
+    // Rows come and go while scrolling, so their events are handled on the viewport
+    viewport.addEventListener('click', handleFileClick);
+    viewport.addEventListener('contextmenu', handleContextMenu);
+    if (isAdmin) {
+        viewport.addEventListener('dragstart', handleItemDragStart);
+        viewport.addEventListener('dragend', handleItemDragEnd);
+    }
+
+    reloadFileList();
+}
+
+function reloadFileList() {
+    fileList.items = [];
+    fileList.next = null;
+    fileList.source = null;
+    fileList.complete = false;
+    fileList.loading = false;
+    fileList.requestId++;
+    loadFileListPage();
+}
+
+// Same order as the server: folders first, then the sort key, name as tie-breaker
+function compareFileItems(a, b) {
+    if (a.is_dir !== b.is_dir) return a.is_dir ? -1 : 1;
+    let keyA, keyB;
+    if (sortBy === 'size') {
+        keyA = a.size || 0; keyB = b.size || 0;
+    } else if (sortBy === 'modified') {
+        keyA = a.mtime; keyB = b.mtime;
+    } else {
+        keyA = a.name.toLowerCase(); keyB = b.name.toLowerCase();
+    }
+    let result = keyA < keyB ? -1 : keyA > keyB ? 1 : 0;
+    if (result === 0) result = a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+    return sortOrder === 'desc' ? -result : result;
+}
+
+// Patch the loaded listing in place from a dir_delta event
+function applyDirDelta(delta) {
+    if (delta.reset || searchQuery || fileList.source !== 'list') {
+        reloadFileList();
+        return;
+    }
+
+    const gone = new Set(delta.removed);
+    delta.renamed.forEach(r => gone.add(r.from));
+    const changed = delta.added.concat(delta.renamed.map(r => r.item));
+    changed.forEach(item => gone.add(item.name));
+    fileList.items = fileList.items.filter(item => !gone.has(item.name));
+    gone.forEach(name => selectedPaths.delete(currentPath ? `${currentPath}/${name}` : name));
+    updateSelectionBar();
+
+    changed.forEach(item => {
+        let index = fileList.items.findIndex(existing => compareFileItems(item, existing) < 0);
+        if (index === -1) {
+            // Past the loaded part; a later page will include it
+            if (!fileList.complete) return;
+            index = fileList.items.length;
+        }
+        fileList.items.splice(index, 0, item);
+    });
+
+    renderFileList(true);
+}
+
+async function loadFileListPage() {
+    if (fileList.loading || fileList.complete) return;
+
+    const requestId = fileList.requestId;
+    fileList.loading = true;
+    updateFileListStatus();
+
+    try {
+        const page = await fetchFileListPage(fileList.next);
+        if (requestId !== fileList.requestId) return;
+
+        fileList.items.push(...page.items);
+        fileList.next = page.next;
+        fileList.complete = page.next === null;
+    } catch (error) {
+        if (requestId !== fileList.requestId) return;
+        fileList.complete = true;
+        showAlert(escapeHtml(error.message), 'error');
+    } finally {
+        if (requestId === fileList.requestId) {
+            fileList.loading = false;
+            renderFileList(true);
+        }
+    }
+}
+
+async function fetchFileListPage(next) {
+    const params = new URLSearchParams({ path: currentPath, sort: sortBy, order: sortOrder });
+
+    if (searchQuery && fileList.source !== 'list') {
+        params.set('q', searchQuery);
+        params.set('page', next || 1);
+        const response = await fetch(`/api/search?${params}`);
+
+        // 503 means the search index is still being built
+        if (response.status !== 503) {
+            const data = await response.json();
+            if (!response.ok) {
+                throw new Error(data.error || 'Search failed');
+            }
+            fileList.source = 'search';
+            return { items: data.results, next: data.has_more ? data.page + 1 : null };
+        }
+
+        // Fall back to filtering the current folder only
+        params.delete('q');
+        params.delete('page');
+    }
+
+    if (searchQuery) {
+        params.set('search', searchQuery);
+    }
+    if (next) {
+        params.set('cursor', next);
+    }
+
+    const response = await fetch(`/api/list?${params}`);
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'Failed to load folder');
+    }
+    fileList.source = 'list';
+    fileList.checksumAlgorithm = data.checksum_algorithm || fileList.checksumAlgorithm;
+    return { items: data.items, next: data.next_cursor };
+}
+
+function setViewMode(mode) {
+    viewMode = mode;
+    localStorage.setItem('viewMode', mode);
+
+    document.getElementById('fileListRows').classList.toggle('grid', mode === 'grid');
+    document.querySelector('#viewToggle i').className = mode === 'grid' ? 'fas fa-list' : 'fas fa-th-large';
+    document.getElementById('viewToggle').title = mode === 'grid' ? 'Show as list' : 'Show as grid';
+    renderFileList(true);
+}
+
+function renderFileList(force = false) {
+    const viewport = document.getElementById('fileListViewport');
+    const rows = document.getElementById('fileListRows');
+    const count = fileList.items.length;
+
+    // In grid view every virtual row holds several tiles
+    const grid = viewMode === 'grid';
+    const columns = grid ? Math.max(1, Math.floor(viewport.clientWidth / GRID_TILE_MIN_WIDTH)) : 1;
+    const rowHeight = grid ? GRID_ROW_HEIGHT : FILE_ROW_HEIGHT;
+    const rowCount = Math.ceil(count / columns);
+
+    document.getElementById('fileListSpacer').style.height = (rowCount * rowHeight) + 'px';
+    document.getElementById('fileListEmpty').style.display = (count === 0 && fileList.complete) ? 'block' : 'none';
+
+    const firstRow = Math.max(0, Math.floor(viewport.scrollTop / rowHeight) - FILE_ROW_OVERSCAN);
+    const lastRow = Math.min(rowCount, Math.ceil((viewport.scrollTop + viewport.clientHeight) / rowHeight) + FILE_ROW_OVERSCAN);
+    const first = firstRow * columns;
+    const last = Math.min(count, lastRow * columns);
+
+    const range = `${viewMode}:${columns}:${first}:${last}`;
+    if (force || range !== fileList.renderedRange) {
+        fileList.renderedRange = range;
+        rows.style.transform = `translateY(${firstRow * rowHeight}px)`;
+        rows.style.setProperty('--grid-columns', columns);
+
+        let html = '';
+        for (let i = first; i < last; i++) {
+            html += grid ? renderFileTile(fileList.items[i], i) : renderFileRow(fileList.items[i], i);
+        }
+        rows.innerHTML = html;
+    }
+
+    // Fetch the next page before the user reaches the end of what is loaded
+    if (!fileList.complete && !fileList.loading && last >= count - FILE_ROW_OVERSCAN * columns) {
+        loadFileListPage();
+    }
+
+    updateFileListStatus();
+}
+
+function renderFileRow(item, index) {
+    const actionButton = (action, title, icon) => `
+        <button class="action-btn" title="${title}" data-action="${action}">
+            <i class="fas ${icon}"></i>
+        </button>`;
+
+    let actions = item.is_dir
+        ? actionButton('download', 'Download as ZIP', 'fa-download')
+        : actionButton('preview', 'Preview', 'fa-eye') + actionButton('download', 'Download', 'fa-download');
+
+    if (isAdmin) {
+        actions += actionButton('rename', 'Rename', 'fa-edit') + actionButton('delete', 'Delete', 'fa-trash');
+    }
+
+    let location = item.location !== undefined
+        ? `<div class="file-meta">in /${escapeHtml(item.location)}</div>`
+        : '';
+    if (!location && item.checksum) {
+        const algorithm = fileList.checksumAlgorithm;
+        location = `<div class="file-meta file-checksum" title="${algorithm}: ${item.checksum}">${algorithm} ${item.checksum.slice(0, 16)}&hellip;</div>`;
+    }
+
+    const selected = selectedPaths.has(item.path);
+    return `
+        <div class="file-item${selected ? ' selected' : ''}" data-index="${index}" data-path="${escapeAttribute(item.path)}" data-is-dir="${item.is_dir}"${isAdmin ? ' draggable="true"' : ''}>
+            <input type="checkbox" class="file-select" title="Select"${selected ? ' checked' : ''}>
+            <div class="file-icon ${item.is_dir ? 'folder' : 'file'}">
+                ${fileThumbnail(item, 96) || `<i class="${item.icon}"></i>`}
+            </div>
+
+            <div class="file-info">
+                <div class="file-name" title="${escapeAttribute(item.name)}">${escapeHtml(item.name)}</div>
+                ${location}
+            </div>
+
+            <div class="file-size${item.size_pending ? ' pending' : ''}"${item.size_pending ? ' title="Calculating size..."' : ''}>${item.size_formatted}</div>
+            <div class="file-date">${item.modified}</div>
+
+            <div class="file-actions">${actions}</div>
+        </div>`;
+}
+
+function renderFileTile(item, index) {
+    const selected = selectedPaths.has(item.path);
+    return `
+        <div class="file-tile${selected ? ' selected' : ''}" data-index="${index}" data-path="${escapeAttribute(item.path)}" data-is-dir="${item.is_dir}" title="${escapeAttribute(item.name)}"${isAdmin ? ' draggable="true"' : ''}>
+            <input type="checkbox" class="file-select" title="Select"${selected ? ' checked' : ''}>
+            <div class="file-tile-preview ${item.is_dir ? 'folder' : 'file'}">
+                ${fileThumbnail(item, 256) || `<i class="${item.icon}"></i>`}
+            </div>
+            <div class="file-tile-name">${escapeHtml(item.name)}</div>
+        </div>`;
+}
+
+function fileThumbnail(item, size) {
+    const ext = item.name.split('.').pop().toLowerCase();
+    if (!thumbnailsEnabled || item.is_dir || !THUMBNAIL_EXTENSIONS.includes(ext)) {
+        return '';
+    }
+
+    // The mtime makes the URL change whenever the file does, so browsers can cache it for good
+    const src = `/thumbnail?path=${encodeURIComponent(item.path)}&size=${size}&v=${item.mtime}`;
+    const fallback = `this.replaceWith(Object.assign(document.createElement('i'), { className: '${item.icon}' }))`;
+    return `<img class="${size > 96 ? '' : 'file-thumb'}" src="${src}" loading="lazy" alt="" onerror="${fallback}">`;
+}
+
+function updateFileListStatus() {
+    const status = document.getElementById('fileListStatus');
+    const count = fileList.items.length;
+
+    if (fileList.loading) {
+        status.textContent = count ? `${count} items, loading more...` : 'Loading...';
+    } else if (count) {
+        status.textContent = fileList.complete ? `${count} items` : `${count}+ items`;
+    } else {
+        status.textContent = '';
+    }
+}
+
+function runFileAction(action, item) {
+    switch (action) {
+        case 'preview':
+            previewFile(item.path);
+            break;
+        case 'download':
+            if (item.is_dir) {
+                downloadFolder(item.path);
+            } else {
+                downloadFile(item.path);
+            }
+            break;
+        case 'rename':
+            renameItem(item.path, item.name);
+            break;
+        case 'delete':
+            deleteItem(item.path);
+            break;
+    }
+}
+
+// File handling
+function initializeFileHandling() {
+    const fileInput = document.getElementById('fileInput');
+    const uploadBtn = document.getElementById('uploadBtn');
+
+    // Upload button click handler
+    if (uploadBtn && fileInput) {
+        uploadBtn.addEventListener('click', () => fileInput.click());
+    }
+
+    // Whole page drag and drop
+    document.addEventListener('dragover', handlePageDragOver);
+    document.addEventListener('dragleave', handlePageDragLeave);
+    document.addEventListener('drop', handlePageDrop);
+
+    if (fileInput) {
+        fileInput.addEventListener('change', handleFileSelect);
+    }
+
+    // Modal handlers
+    const createFolderBtn = document.getElementById('createFolderBtn');
+    if (createFolderBtn) {
+        createFolderBtn.addEventListener('click', () => showModal('createFolderModal'));
+    }
+
+    const undoBtn = document.getElementById('undoBtn');
+    if (undoBtn) {
+        undoBtn.addEventListener('click', undoLastAction);
+    }
+
+    // Form handlers
+    const createFolderForm = document.getElementById('createFolderForm');
+    if (createFolderForm) {
+        createFolderForm.addEventListener('submit', handleCreateFolder);
+    }
+
+    const renameForm = document.getElementById('renameForm');
+    if (renameForm) {
+        renameForm.addEventListener('submit', handleRename);
+    }
+
+    // Hide context menu on click outside
+    document.addEventListener('click', hideContextMenu);
+}
+
+function handlePageDragOver(e) {
+    e.preventDefault();
+    if (draggedPaths) {
+        // Items from the list go to folders on the page, not to the upload overlay
+        const target = itemDropTarget(e);
+        setItemDropTarget(target);
+        e.dataTransfer.dropEffect = target ? (e.ctrlKey || e.altKey ? 'copy' : 'move') : 'none';
+        return;
+    }
+    document.body.classList.add('dragover');
+}
+
+function handlePageDragLeave(e) {
+    e.preventDefault();
+    // Only remove dragover class if we're leaving the document body
+    if (!e.relatedTarget || e.relatedTarget.nodeName === 'HTML') {
+        document.body.classList.remove('dragover');
+    }
+}
+
+function handlePageDrop(e) {
+    e.preventDefault();
+    document.body.classList.remove('dragover');
+
+    if (draggedPaths) {
+        const target = itemDropTarget(e);
+        const paths = draggedPaths;
+        setItemDropTarget(null);
+        if (target) {
+            runBulkOperation(e.ctrlKey || e.altKey ? 'copy' : 'move', { destination: target.dataset.path }, paths);
+        }
+        return;
+    }
+
+    if (e.dataTransfer.files.length > 0) {
+        const files = Array.from(e.dataTransfer.files);
+        uploadFiles(files);
+    }
+}
+
+// Dragging listed items onto a folder row, tile or breadcrumb moves them there; Ctrl or Alt copies
+function handleItemDragStart(e) {
+    const row = e.target.closest('.file-item, .file-tile');
+    if (!row) return;
+
+    // Dragging a ticked item takes the whole selection along
+    const item = fileList.items[row.dataset.index];
+    draggedPaths = selectedPaths.has(item.path) ? Array.from(selectedPaths) : [item.path];
+    e.dataTransfer.setData(ITEM_DRAG_TYPE, JSON.stringify(draggedPaths));
+    e.dataTransfer.effectAllowed = 'copyMove';
+}
+
+function handleItemDragEnd() {
+    draggedPaths = null;
+    setItemDropTarget(null);
+}
+
+function itemDropTarget(e) {
+    const target = e.target.closest('.file-item[data-is-dir="true"], .file-tile[data-is-dir="true"], .breadcrumb a[data-path]');
+    // A folder cannot take itself
+    return target && !draggedPaths.includes(target.dataset.path) ? target : null;
+}
+
+function setItemDropTarget(target) {
+    document.querySelectorAll('.drop-target').forEach(element => {
+        if (element !== target) element.classList.remove('drop-target');
+    });
+    if (target) target.classList.add('drop-target');
+}
+
+function handleFileSelect(e) {
+    const files = Array.from(e.target.files);
+    uploadFiles(files);
+}
+
+function uploadFiles(files) {
+    if (files.length === 0) return;
+
+    const uploadPath = currentPath;
+    const progressContainer = document.getElementById('progressContainer');
+    const progressFill = document.getElementById('progressFill');
+    const progressText = document.getElementById('progressText');
+
+    progressContainer.style.display = 'block';
+    progressFill.style.width = '0%';
+    progressText.textContent = 'Uploading...';
+
+    // Bytes of finished chunks plus whatever the in-flight chunks have sent so far
+    const totalBytes = files.reduce((sum, file) => sum + file.size, 0);
+    let doneBytes = 0;
+    const inFlight = new Map();
+
+    const progress = {
+        done(bytes) {
+            doneBytes += bytes;
+            this.update();
+        },
+        update() {
+            let loaded = doneBytes;
+            inFlight.forEach(bytes => loaded += bytes);
+            const percentComplete = totalBytes ? Math.min(100, (loaded / totalBytes) * 100) : 100;
+            progressFill.style.width = percentComplete + '%';
+            progressText.textContent = `Uploading... ${Math.round(percentComplete)}%`;
+        },
+        inFlight
+    };
+
+    (async () => {
+        const uploaded = [];
+        const failed = [];
+        let savedNote = '';
+
+        for (const file of files) {
+            try {
+                uploaded.push(await uploadFileInChunks(file, uploadPath, progress));
+            } catch (error) {
+                failed.push(`${file.name}: ${error.message}`);
+            }
+        }
+
+        if (uploaded.length > 0) {
+            try {
+                const response = await fetch('/upload_complete', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({ upload_ids: uploaded.map(u => u.uploadId) })
+                });
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(data.error || 'Upload failed');
+                }
+                uploaded.forEach(u => localStorage.removeItem(u.resumeKey));
+                failed.push(...data.errors);
+                if (data.saved_bytes > 0) {
+                    savedNote = ` ${data.saved_formatted} saved by deduplication.`;
+                }
+            } catch (error) {
+                failed.push(error.message);
+            }
+        }
+
+        progressContainer.style.display = 'none';
+
+        if (failed.length === 0) {
+            showAlert(`Files uploaded successfully!${escapeHtml(savedNote)}`, 'success');
+            // File list will be updated via socket
+        } else {
+            showAlert(`Upload failed: ${escapeHtml(failed.join(', '))}. Upload the same files again to resume.`, 'error');
+        }
+    })();
+}
+
+async function uploadFileInChunks(file, path, progress) {
+    // Resume an earlier attempt at the same file if the server still has it
+    const resumeKey = `upload:${path}:${file.name}:${file.size}:${file.lastModified}`;
+    let session = null;
+    const savedId = localStorage.getItem(resumeKey);
+
+    if (savedId) {
+        const response = await fetch(`/upload_status?upload_id=${encodeURIComponent(savedId)}`);
+        if (response.ok) {
+            session = await response.json();
+        }
+    }
+
+    if (!session) {
+        const response = await fetch('/upload_session', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ path, name: file.name, size: file.size })
+        });
+        session = await response.json();
+        if (!response.ok) {
+            throw new Error(session.error || 'Upload failed');
+        }
+        localStorage.setItem(resumeKey, session.upload_id);
+    }
+
+    // Only send the chunks the server does not have yet
+    const chunks = [];
+    for (let start = 0; start < file.size; start += session.chunk_size) {
+        const end = Math.min(start + session.chunk_size, file.size);
+        if (session.received.some(([s, e]) => s <= start && e >= end)) {
+            progress.done(end - start);
+        } else {
+            chunks.push([start, end]);
+        }
+    }
+
+    let next = 0;
+    const worker = async () => {
+        while (next < chunks.length) {
+            const [start, end] = chunks[next++];
+            await sendChunkWithRetry(session.upload_id, file.slice(start, end), start, progress);
+        }
+    };
+
+    const workers = [];
+    for (let i = 0; i < Math.min(UPLOAD_PARALLEL_CHUNKS, chunks.length); i++) {
+        workers.push(worker());
+    }
+    await Promise.all(workers);
+
+    return { uploadId: session.upload_id, resumeKey };
+}
+
+async function sendChunkWithRetry(uploadId, blob, offset, progress) {
+    const key = `${uploadId}:${offset}`;
+
+    for (let attempt = 0; ; attempt++) {
+        try {
+            await sendChunk(uploadId, blob, offset, loaded => {
+                progress.inFlight.set(key, loaded);
+                progress.update();
+            });
+            progress.inFlight.delete(key);
+            progress.done(blob.size);
+            return;
+        } catch (error) {
+            progress.inFlight.delete(key);
+            if (attempt >= UPLOAD_CHUNK_RETRIES) {
+                throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+        }
+    }
+}
+
+function sendChunk(uploadId, blob, offset, onProgress) {
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+
+        xhr.upload.addEventListener('progress', (e) => onProgress(e.loaded));
+
+        xhr.addEventListener('load', () => {
+            if (xhr.status === 200) {
+                resolve();
+            } else {
+                let message = 'Upload failed';
+                try {
+                    message = JSON.parse(xhr.responseText).error || message;
+                } catch (e) {}
+                reject(new Error(message));
+            }
+        });
+
+        xhr.addEventListener('error', () => reject(new Error('Connection lost')));
+
+        xhr.open('PUT', `/upload_chunk?upload_id=${encodeURIComponent(uploadId)}&offset=${offset}`);
+        xhr.send(blob);
+    });
+}
+
+function handleFileClick(e) {
+    const row = e.target.closest('.file-item, .file-tile');
+    if (!row) return;
+
+    const item = fileList.items[row.dataset.index];
+    const button = e.target.closest('.action-btn');
+    if (button) {
+        runFileAction(button.dataset.action, item);
+        return;
+    }
+
+    // The checkbox, or Ctrl/Cmd-click anywhere on the item, ticks it
+    if (e.target.classList.contains('file-select') || e.ctrlKey || e.metaKey) {
+        toggleSelection(item.path);
+        return;
+    }
+
+    if (item.is_dir) {
+        window.location.href = `/?path=${encodeURIComponent(item.path)}`;
+    } else if (row.classList.contains('file-tile')) {
+        // Tiles have no action buttons, so a click previews the file
+        previewFile(item.path);
+    }
+}
+
+function handleContextMenu(e) {
+    const row = e.target.closest('.file-item, .file-tile');
+    if (!row) return;
+
+    e.preventDefault();
+
+    const path = row.dataset.path;
+    const isDir = row.dataset.isDir === 'true';
+
+    contextMenuItem = { path, isDir };
+
+    const contextMenu = document.getElementById('contextMenu');
+    contextMenu.style.display = 'block';
+    contextMenu.style.left = e.pageX + 'px';
+    contextMenu.style.top = e.pageY + 'px';
+}
+
+function hideContextMenu() {
+    const contextMenu = document.getElementById('contextMenu');
+    contextMenu.style.display = 'none';
+}
+
+function contextPreview() {
+    if (contextMenuItem) {
+        previewFile(contextMenuItem.path);
+    }
+    hideContextMenu();
+}
+
+function contextDownload() {
+    if (contextMenuItem) {
+        if (contextMenuItem.isDir) {
+            downloadFolder(contextMenuItem.path);
+        } else {
+            downloadFile(contextMenuItem.path);
+        }
+    }
+    hideContextMenu();
+}
+
+function contextChecksums() {
+    if (contextMenuItem) {
+        if (contextMenuItem.isDir) {
+            downloadChecksumManifest(contextMenuItem.path);
+        } else {
+            showChecksums(contextMenuItem.path);
+        }
+    }
+    hideContextMenu();
+}
+
+function contextRename() {
+    if (contextMenuItem) {
+        const fileName = contextMenuItem.path.split('/').pop();
+        renameItem(contextMenuItem.path, fileName);
+    }
+    hideContextMenu();
+}
+
+function contextDelete() {
+    if (contextMenuItem) {
+        deleteItem(contextMenuItem.path);
+    }
+    hideContextMenu();
+}
+
+// File operations
+function downloadFile(path) {
+    addToDownloadQueue(path, 'file');
+    window.open(`/download?path=${encodeURIComponent(path)}`, '_blank');
+}
+
+async function showChecksums(path) {
+    const title = `Checksums: ${path.split('/').pop()}`;
+    const content = document.getElementById('previewContent');
+    document.getElementById('previewTitle').textContent = title;
+    content.innerHTML = `
+        <div style="text-align: center; padding: 2rem;">
+            <div class="loading-spinner"></div>
+            <p id="checksumStatus">Reading checksums...</p>
+        </div>
+    `;
+    showModal('previewModal');
+
+    try {
+        // Cached digests come back at once; otherwise the file is hashed in a background job
+        const response = await fetch(`/checksum?${new URLSearchParams({ path, background: 1 })}`);
+        let data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to get checksums');
+        }
+        if (data.job) {
+            data = await followJob(data.job, job => {
+                const status = document.getElementById('checksumStatus');
+                if (status && job.total) {
+                    status.textContent = `Hashing... ${Math.floor(job.done / job.total * 100)}%`;
+                }
+            });
+        }
+        if (document.getElementById('previewTitle').textContent !== title) return;
+
+        const rows = Object.entries(data.checksums).map(([algorithm, digest]) => `
+            <div class="checksum-item">
+                <span class="checksum-algorithm">${algorithm}</span>
+                <code>${digest}</code>
+                <button class="action-btn" title="Copy" onclick="copyToClipboard('${digest}')">
+                    <i class="fas fa-copy"></i>
+                </button>
+            </div>`).join('');
+        content.innerHTML = `<div class="checksum-list">${rows}</div>`;
+    } catch (error) {
+        if (document.getElementById('previewTitle').textContent === title) {
+            content.innerHTML = `<p style="text-align: center; padding: 2rem;">${escapeHtml(error.message)}</p>`;
+        }
+    }
+}
+
+function downloadChecksumManifest(path) {
+    addToDownloadQueue(`${path || 'Home'} (${fileList.checksumAlgorithm} manifest)`, 'file');
+    window.open(`/checksum/manifest?${new URLSearchParams({ path, algorithm: fileList.checksumAlgorithm })}`, '_blank');
+}
+
+async function downloadFolder(path) {
+    // The ZIP is built in a background job and downloaded once it is ready
+    try {
+        const response = await fetch(`/download_folder?path=${encodeURIComponent(path)}&background=1`);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Download failed');
+        }
+        trackZipJob(data.job, `${path.split('/').pop() || 'files'}.zip`);
+    } catch (error) {
+        showAlert(escapeHtml(error.message), 'error');
+    }
+}
+
+function previewFile(path) {
+    const modal = document.getElementById('previewModal');
+    const title = document.getElementById('previewTitle');
+    const content = document.getElementById('previewContent');
+
+    const fileName = path.split('/').pop();
+    title.textContent = `Preview: ${fileName}`;
+
+    content.innerHTML = `
+        <div style="text-align: center; padding: 2rem;">
+            <div class="loading-spinner"></div>
+            <p>Loading preview...</p>
+        </div>
+    `;
+
+    showModal('previewModal');
+
+    if (ARCHIVE_PATTERN.test(fileName)) {
+        showArchivePreview(path);
+        return;
+    }
+
+    // Check file type and create appropriate preview
+    const ext = fileName.split('.').pop().toLowerCase();
+    const videoExts = ['mp4', 'avi', 'mkv', 'mov', 'wmv', 'webm'];
+    const audioExts = ['mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a'];
+
+    if (PREVIEW_IMAGE_EXTENSIONS.includes(ext)) {
+        const fullSrc = `/download?path=${encodeURIComponent(path)}&inline=1`;
+        const showThumbnail = thumbnailsEnabled && THUMBNAIL_EXTENSIONS.includes(ext);
+        content.innerHTML = `
+            <div style="text-align: center;">
+                <img id="previewImage" src="${showThumbnail ? `/thumbnail?path=${encodeURIComponent(path)}&size=256` : fullSrc}" style="max-width: 100%; max-height: 400px; min-height: ${showThumbnail ? '256px' : '0'}; border-radius: 0.375rem;" alt="${escapeAttribute(fileName)}">
+            </div>
+        `;
+
+        // Show the thumbnail right away and swap in the original once it has loaded
+        if (showThumbnail) {
+            const original = new Image();
+            original.onload = () => {
+                const img = document.getElementById('previewImage');
+                if (img) {
+                    img.src = fullSrc;
+                    img.style.minHeight = '0';
+                }
+            };
+            original.src = fullSrc;
+        }
+    } else if (videoExts.includes(ext)) {
+        content.innerHTML = `
+            <div style="text-align: center;">
+                <video controls style="max-width: 100%; max-height: 400px; border-radius: 0.375rem;">
+                    <source src="/download?path=${encodeURIComponent(path)}&inline=1" type="video/${ext}">
+                    Your browser does not support the video tag.
+                </video>
+            </div>
+        `;
+    } else if (audioExts.includes(ext)) {
+        content.innerHTML = `
+            <div style="text-align: center; padding: 2rem;">
+                <i class="fas fa-music" style="font-size: 4rem; margin-bottom: 1rem; color: var(--accent-color);"></i>
+                <h3>${fileName}</h3>
+                <audio controls style="width: 100%; margin-top: 1rem;">
+                    <source src="/download?path=${encodeURIComponent(path)}&inline=1" type="audio/${ext}">
+                    Your browser does not support the audio tag.
+                </audio>
+            </div>
+        `;
+    } else {
+        showTextPreview(path);
+    }
+}
+
+// Archive browsing: the preview modal lists an archive's folders, previews text and image
+// members and downloads single members, all without unpacking the archive
+let archivePreview = null;
+
+function archiveMemberUrl(member, inline) {
+    const params = new URLSearchParams({ path: archivePreview.path, member });
+    if (inline) {
+        params.set('inline', '1');
+    }
+    return `/archive/member?${params}`;
+}
+
+function showArchivePreview(path, dir = '') {
+    archivePreview = { path, dir, items: [], member: null };
+    fetch(`/archive?${new URLSearchParams({ path, dir })}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!archivePreview || archivePreview.path !== path || archivePreview.dir !== dir) {
+                return;
+            }
+            const content = document.getElementById('previewContent');
+            if (!data.success) {
+                content.innerHTML = `
+                    <div style="text-align: center; padding: 2rem;">
+                        <i class="fas fa-file-archive" style="font-size: 4rem; margin-bottom: 1rem; color: var(--text-secondary);"></i>
+                        <p>${escapeHtml(data.error || 'Failed to read archive')}</p>
+                    </div>
+                `;
+                return;
+            }
+            archivePreview.items = data.items;
+
+            // Breadcrumb inside the archive, starting at the archive itself
+            let crumbs = `<a href="#" onclick="showArchivePreview(archivePreview.path); return false;"><i class="fas fa-file-archive"></i> ${escapeHtml(path.split('/').pop())}</a>`;
+            let crumbPath = '';
+            (dir ? dir.split('/') : []).forEach(part => {
+                crumbPath = crumbPath ? `${crumbPath}/${part}` : part;
+                crumbs += ` / <a href="#" onclick="showArchivePreview(archivePreview.path, ${escapeAttribute(JSON.stringify(crumbPath))}); return false;">${escapeHtml(part)}</a>`;
+            });
+
+            const rows = data.items.map((item, index) => `
+                <div class="archive-item" onclick="openArchiveItem(${index})">
+                    <i class="${item.icon}"></i>
+                    <span class="file-name" title="${escapeAttribute(item.name)}">${escapeHtml(item.name)}</span>
+                    <span class="file-size">${item.size_formatted}</span>
+                    ${item.is_dir ? '<span></span>' : `
+                        <button class="action-btn" title="Download" onclick="event.stopPropagation(); downloadArchiveMember(archivePreview.items[${index}].path)">
+                            <i class="fas fa-download"></i>
+                        </button>`}
+                </div>`).join('');
+
+            content.innerHTML = `
+                <div class="text-preview">
+                    <div class="text-preview-toolbar">
+                        <span>${crumbs}</span>
+                        <span class="text-preview-status">${data.members} members</span>
+                    </div>
+                    <div class="archive-list">${rows || '<p style="padding: 1rem;">This folder is empty</p>'}</div>
+                </div>
+            `;
+        })
+        .catch(() => showAlert('Failed to read archive', 'error'));
+}
+
+function openArchiveItem(index) {
+    const item = archivePreview.items[index];
+    if (item.is_dir) {
+        showArchivePreview(archivePreview.path, item.path);
+        return;
+    }
+    archivePreview.member = item;
+
+    const ext = item.name.split('.').pop().toLowerCase();
+    const content = document.getElementById('previewContent');
+    const toolbar = `
+        <div class="text-preview-toolbar">
+            <button class="btn btn-secondary" onclick="showArchivePreview(archivePreview.path, archivePreview.dir)" title="Back to the archive"><i class="fas fa-arrow-left"></i></button>
+            <span>${escapeHtml(item.path)}</span>
+            <button class="btn btn-secondary" onclick="downloadArchiveMember(archivePreview.member.path)" title="Download"><i class="fas fa-download"></i></button>
+            <span class="text-preview-status" id="archiveMemberStatus">${item.size_formatted}</span>
+        </div>`;
+
+    if (PREVIEW_IMAGE_EXTENSIONS.includes(ext)) {
+        content.innerHTML = `
+            <div class="text-preview">
+                ${toolbar}
+                <div style="text-align: center; overflow: auto;">
+                    <img src="${archiveMemberUrl(item.path, true)}" style="max-width: 100%; max-height: 60vh; border-radius: 0.375rem;" alt="${escapeAttribute(item.name)}">
+                </div>
+            </div>
+        `;
+        return;
+    }
+
+    content.innerHTML = `<div class="text-preview">${toolbar}<pre id="archiveMemberBody">Loading...</pre></div>`;
+    fetch(`/archive/preview?${new URLSearchParams({ path: archivePreview.path, member: item.path })}`)
+        .then(response => response.json())
+        .then(data => {
+            const body = document.getElementById('archiveMemberBody');
+            if (!body || !archivePreview || archivePreview.member !== item) {
+                return;
+            }
+            if (!data.success) {
+                body.textContent = data.error || 'Preview not available for this file type';
+                return;
+            }
+            body.textContent = data.content;
+            if (data.truncated) {
+                document.getElementById('archiveMemberStatus').textContent = `Start of ${item.size_formatted}; download for the rest`;
+            }
+        })
+        .catch(() => showAlert('Error loading preview', 'error'));
+}
+
+function downloadArchiveMember(member) {
+    addToDownloadQueue(member, 'file');
+    window.open(archiveMemberUrl(member, false), '_blank');
+}
+
+// Paged text preview: pages are located by byte offset, so they stay valid while a
+// file grows; following streams appended text over the socket.
+const TEXT_PREVIEW_LINES = 500;
+const TEXT_PREVIEW_MAX_CHARS = 2 * 1024 * 1024;  // Oldest followed text is dropped beyond this
+let textPreview = null;
+
+function showTextPreview(path) {
+    stopFollowingText();
+    textPreview = {path, offset: 0, end: 0, size: 0, firstLine: 1, totalLines: null, following: false};
+    loadTextPage({offset: 0}, () => {
+        const content = document.getElementById('previewContent');
+        content.innerHTML = `
+            <div style="text-align: center; padding: 2rem;">
+                <i class="fas fa-file" style="font-size: 4rem; margin-bottom: 1rem; color: var(--text-secondary);"></i>
+                <p>Preview not available for this file type</p>
+                <button class="btn" onclick="downloadFile('${escapeAttribute(path)}')">
+                    <i class="fas fa-download"></i>
+                    Download File
+                </button>
+            </div>
+        `;
+    });
+}
+
+function renderTextPreviewShell() {
+    const content = document.getElementById('previewContent');
+    if (document.getElementById('textPreviewBody')) {
+        return;
+    }
+    content.innerHTML = `
+        <div class="text-preview">
+            <div class="text-preview-toolbar">
+                <button class="btn btn-secondary" onclick="loadTextPage({offset: 0})" title="Start of file"><i class="fas fa-angle-double-up"></i></button>
+                <button class="btn btn-secondary" id="textPreviewPrev" onclick="loadTextPage({before: textPreview.offset})" title="Previous page"><i class="fas fa-angle-up"></i></button>
+                <button class="btn btn-secondary" id="textPreviewNext" onclick="loadTextPage({offset: textPreview.end})" title="Next page"><i class="fas fa-angle-down"></i></button>
+                <button class="btn btn-secondary" onclick="loadTextPage({tail: TEXT_PREVIEW_LINES})" title="End of file"><i class="fas fa-angle-double-down"></i></button>
+                <input type="number" min="1" class="form-control" id="textPreviewLine" placeholder="Line">
+                <button class="btn btn-secondary" onclick="goToTextLine()">Go</button>
+                <label><input type="checkbox" id="textPreviewFollow" onchange="toggleFollowText(this.checked)"> Follow</label>
+                <span class="text-preview-status" id="textPreviewStatus"></span>
+            </div>
+            <pre id="textPreviewBody"></pre>
+        </div>
+    `;
+    document.getElementById('textPreviewLine').addEventListener('keydown', e => {
+        if (e.key === 'Enter') {
+            goToTextLine();
+        }
+    });
+}
+
+function loadTextPage(position, onError) {
+    if (!textPreview) {
+        return;
+    }
+    const path = textPreview.path;
+    const params = new URLSearchParams({path});
+    Object.entries(position).forEach(([key, value]) => params.set(key, value));
+
+    return fetch(`/preview?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!textPreview || textPreview.path !== path) {
+                return;
+            }
+            if (!data.success) {
+                if (onError) {
+                    onError(data);
+                } else {
+                    showAlert(escapeHtml(data.error || 'Failed to load preview'), 'error');
+                }
+                return;
+            }
+            renderTextPreviewShell();
+            Object.assign(textPreview, {
+                offset: data.offset,
+                end: data.end,
+                size: data.size,
+                firstLine: data.first_line,
+                totalLines: data.total_lines
+            });
+            const body = document.getElementById('textPreviewBody');
+            body.textContent = data.content;
+            body.scrollTop = 'tail' in position ? body.scrollHeight : 0;
+            updateTextPreviewStatus();
+            if (textPreview.following) {
+                socket.emit('preview_follow', {path, offset: textPreview.end});
+            }
+        })
+        .catch(() => {
+            if (onError) {
+                onError({});
+            } else {
+                showAlert('Error loading preview', 'error');
+            }
+        });
+}
+
+function goToTextLine() {
+    const line = parseInt(document.getElementById('textPreviewLine').value, 10);
+    if (line > 0) {
+        loadTextPage({line, lines: TEXT_PREVIEW_LINES});
+    }
+}
+
+function updateTextPreviewStatus() {
+    const body = document.getElementById('textPreviewBody');
+    const status = document.getElementById('textPreviewStatus');
+    if (!body || !status) {
+        return;
+    }
+    const text = body.textContent;
+    const shown = (text.match(/\n/g) || []).length + (text && !text.endsWith('\n') ? 1 : 0);
+    const lines = textPreview.firstLine !== null && shown
+        ? `Lines ${textPreview.firstLine.toLocaleString()}-${(textPreview.firstLine + shown - 1).toLocaleString()}`
+        : `Bytes ${textPreview.offset.toLocaleString()}-${textPreview.end.toLocaleString()}`;
+    const total = textPreview.totalLines !== null
+        ? ` of ${textPreview.totalLines.toLocaleString()} lines`
+        : '';
+    status.textContent = `${lines}${total}, ${textPreview.size.toLocaleString()} bytes`;
+    document.getElementById('textPreviewPrev').disabled = textPreview.offset === 0;
+    document.getElementById('textPreviewNext').disabled = textPreview.end >= textPreview.size;
+}
+
+function toggleFollowText(enabled) {
+    if (!textPreview) {
+        return;
+    }
+    textPreview.following = enabled;
+    if (!enabled) {
+        socket.emit('preview_unfollow');
+    } else if (textPreview.end < textPreview.size) {
+        loadTextPage({tail: TEXT_PREVIEW_LINES});  // Starts following once the end is shown
+    } else {
+        socket.emit('preview_follow', {path: textPreview.path, offset: textPreview.end});
+    }
+}
+
+function stopFollowingText() {
+    if (textPreview && textPreview.following) {
+        socket.emit('preview_unfollow');
+    }
+    textPreview = null;
+}
+
+function appendTextPreview(data) {
+    if (!textPreview || !textPreview.following || data.path !== textPreview.path) {
+        return;
+    }
+    if (data.reset || data.offset > textPreview.end) {
+        // The file was truncated or replaced, or updates were missed
+        loadTextPage({tail: TEXT_PREVIEW_LINES});
+        return;
+    }
+    if (data.end <= textPreview.end || data.offset !== textPreview.end) {
+        return;
+    }
+
+    const body = document.getElementById('textPreviewBody');
+    const atBottom = body.scrollTop + body.clientHeight >= body.scrollHeight - 20;
+    let text = body.textContent + data.content;
+    if (text.length > TEXT_PREVIEW_MAX_CHARS) {
+        // Drop whole lines from the top and keep the position bookkeeping right
+        let cut = text.indexOf('\n', text.length - TEXT_PREVIEW_MAX_CHARS) + 1;
+        if (cut <= 0) {
+            cut = text.length - TEXT_PREVIEW_MAX_CHARS;
+        }
+        const dropped = text.slice(0, cut);
+        textPreview.offset += new TextEncoder().encode(dropped).length;
+        if (textPreview.firstLine !== null) {
+            textPreview.firstLine += (dropped.match(/\n/g) || []).length;
+        }
+        text = text.slice(cut);
+    }
+    body.textContent = text;
+    if (textPreview.totalLines !== null) {
+        textPreview.totalLines += (data.content.match(/\n/g) || []).length;
+    }
+    textPreview.end = data.end;
+    textPreview.size = data.size;
+    if (atBottom) {
+        body.scrollTop = body.scrollHeight;
+    }
+    updateTextPreviewStatus();
+}
+
+function renameItem(path, currentName) {
+    const modal = document.getElementById('renameModal');
+    const input = document.getElementById('renameInput');
+
+    input.value = currentName;
+    input.dataset.path = path;
+
+    showModal('renameModal');
+    setTimeout(() => input.focus(), 100);
+}
+
+function deleteItem(path) {
+    if (!confirm('Are you sure you want to delete this item?')) return;
+
+    fetch('/delete', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ path })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showAlert('Item deleted successfully', 'success');
+        } else {
+            showAlert(data.error || 'Delete failed', 'error');
+        }
+    })
+    .catch(error => {
+        showAlert('Delete failed', 'error');
+    });
+}
+
+// Bulk operations on the ticked items
+function toggleSelection(path) {
+    if (selectedPaths.has(path)) {
+        selectedPaths.delete(path);
+    } else {
+        selectedPaths.add(path);
+    }
+    renderFileList(true);
+    updateSelectionBar();
+}
+
+function clearSelection() {
+    selectedPaths.clear();
+    renderFileList(true);
+    updateSelectionBar();
+}
+
+function updateSelectionBar() {
+    const count = selectedPaths.size;
+    document.getElementById('selectionBar').style.display = count ? 'flex' : 'none';
+    document.getElementById('selectionCount').textContent = `${count} selected`;
+}
+
+function downloadSelection() {
+    // A form post, so the browser treats the ZIP as a download
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = '/bulk';
+    form.target = '_blank';
+    const fields = [['action', 'download'], ...Array.from(selectedPaths, path => ['paths', path])];
+    fields.forEach(([name, value]) => {
+        form.appendChild(Object.assign(document.createElement('input'), { type: 'hidden', name, value }));
+    });
+    document.body.appendChild(form);
+    form.submit();
+    form.remove();
+    addToDownloadQueue(`${selectedPaths.size} selected items`, 'folder');
+}
+
+function deleteSelection() {
+    if (!confirm(`Are you sure you want to delete ${selectedPaths.size} items?`)) return;
+    runBulkOperation('delete');
+}
+
+function moveSelection() {
+    const destination = prompt('Move the selected items to folder (path from Home):', currentPath);
+    if (destination === null) return;
+    runBulkOperation('move', { destination: destination.replace(/^\/+|\/+$/g, '') });
+}
+
+function copySelection() {
+    const destination = prompt('Copy the selected items to folder (path from Home):', currentPath);
+    if (destination === null) return;
+    runBulkOperation('copy', { destination: destination.replace(/^\/+|\/+$/g, '') });
+}
+
+const BULK_VERBS = {
+    delete: ['Deleting', 'deleted'],
+    move: ['Moving', 'moved'],
+    copy: ['Copying', 'copied'],
+};
+
+async function runBulkOperation(action, options = {}, paths = Array.from(selectedPaths)) {
+    const [verb, done] = BULK_VERBS[action];
+    updateBulkProgress(verb, { done: 0, total: action === 'copy' ? null : paths.length });
+
+    try {
+        const response = await fetch('/bulk', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ action, paths, background: true, ...options })
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `Failed to ${action} items`);
+        }
+        const result = await followJob(data.job, job => updateBulkProgress(verb, job, action === 'copy'));
+        clearSelection();
+        showAlert(`${result.count} item${result.count === 1 ? '' : 's'} ${done}`, 'success');
+    } catch (error) {
+        showAlert(escapeHtml(error.message), 'error');
+    } finally {
+        document.getElementById('progressContainer').style.display = 'none';
+    }
+}
+
+function updateBulkProgress(verb, job, bytes = false) {
+    const percent = job.total ? (job.done / job.total) * 100 : (job.total === 0 ? 100 : 0);
+    document.getElementById('progressContainer').style.display = 'block';
+    document.getElementById('progressFill').style.width = percent + '%';
+    // Copies count bytes, which read better as a percentage
+    document.getElementById('progressText').textContent = bytes || job.total == null
+        ? `${verb}... ${Math.floor(percent)}%`
+        : `${verb}... ${job.done} / ${job.total}`;
+}
+
+function handleCreateFolder(e) {
+    e.preventDefault();
+
+    const folderName = document.getElementById('folderNameInput').value.trim();
+    if (!folderName) return;
+
+    fetch('/create_folder', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ 
+            path: currentPath,
+            name: folderName 
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showAlert('Folder created successfully', 'success');
+            closeModal('createFolderModal');
+            document.getElementById('folderNameInput').value = '';
+        } else {
+            showAlert(data.error || 'Failed to create folder', 'error');
+        }
+    })
+    .catch(error => {
+        showAlert('Failed to create folder', 'error');
+    });
+}
+
+function handleRename(e) {
+    e.preventDefault();
+
+    const input = document.getElementById('renameInput');
+    const newName = input.value.trim();
+    const path = input.dataset.path;
+
+    if (!newName) return;
+
+    fetch('/rename', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ 
+            path: path,
+            name: newName 
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            showAlert('Item renamed successfully', 'success');
+            closeModal('renameModal');
+        } else {
+            showAlert(data.error || 'Failed to rename item', 'error');
+        }
+    })
+    .catch(error => {
+        showAlert('Failed to rename item', 'error');
+    });
+}
+
+async function undoLastAction() {
+    let history;
+    try {
+        history = await (await fetch('/undo_history')).json();
+    } catch (error) {
+        showAlert('Failed to load undo history', 'error');
+        return;
+    }
+    if (!history.operations || !history.operations.length) {
+        showAlert('Nothing to undo', 'info');
+        return;
+    }
+    const last = history.operations[0];
+    if (!confirm(`Undo the ${last.description} (${last.timestamp})?`)) return;
+
+    // Undoing a large bulk operation takes a while, so it runs as a background job
+    try {
+        const response = await fetch('/undo', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ background: true })
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to undo action');
+        }
+        const result = await followJob(data.job);
+        showAlert(`Undid the ${result.undone}`, 'success');
+    } catch (error) {
+        showAlert(escapeHtml(error.message), 'error');
+    }
+}
+
+// Background jobs report progress in job_progress events to the clients following them
+function followJob(id, onProgress) {
+    return new Promise((resolve, reject) => {
+        jobWaiters.set(id, { resolve, reject, onProgress });
+        subscribeJob(id);
+    });
+}
+
+function subscribeJob(id) {
+    socket.emit('job_subscribe', { id });
+    // It may have progressed or finished before the subscription took effect
+    fetch(`/jobs/${id}`)
+        .then(response => response.ok ? response.json() : { id, status: 'failed', error: 'Job not found' })
+        .then(handleJobProgress)
+        .catch(() => {});
+}
+
+function handleJobProgress(job) {
+    const waiter = jobWaiters.get(job.id);
+    if (!waiter) return;
+    if (job.status === 'done') {
+        jobWaiters.delete(job.id);
+        waiter.resolve(job.result);
+    } else if (job.status === 'failed' || job.status === 'cancelled') {
+        jobWaiters.delete(job.id);
+        waiter.reject(Object.assign(new Error(job.error || 'Cancelled'), { cancelled: job.status === 'cancelled' }));
+    } else if (waiter.onProgress) {
+        waiter.onProgress(job);
+    }
+}
+
+function cancelJob(id) {
+    fetch(`/jobs/${id}/cancel`, { method: 'POST' }).catch(() => {});
+}
+
+// Folder ZIPs being built are remembered, so the download still starts after leaving the page
+function storedZipJobs() {
+    try {
+        return JSON.parse(localStorage.getItem('zipJobs')) || {};
+    } catch (error) {
+        return {};
+    }
+}
+
+function storeZipJob(id, name) {
+    const jobs = storedZipJobs();
+    if (name) {
+        jobs[id] = name;
+    } else {
+        delete jobs[id];
+    }
+    localStorage.setItem('zipJobs', JSON.stringify(jobs));
+}
+
+function resumeZipJobs() {
+    Object.entries(storedZipJobs()).forEach(([id, name]) => trackZipJob(id, name));
+}
+
+function trackZipJob(id, name) {
+    const item = { id, name, type: 'folder', status: 'downloading', percent: null, job: id };
+    downloadQueue.push(item);
+    updateDownloadQueue();
+    showDownloadQueue();
+    storeZipJob(id, name);
+
+    followJob(id, job => {
+        item.percent = job.percent;
+        updateDownloadQueue();
+    })
+    .then(result => {
+        item.status = 'completed';
+        // Sent as an attachment, so the page stays
+        window.location.href = result.download;
+    })
+    .catch(error => {
+        item.status = 'failed';
+        if (!error.cancelled) {
+            showAlert(escapeHtml(`Failed to create ${name}: ${error.message}`), 'error');
+        }
+    })
+    .finally(() => {
+        storeZipJob(id, null);
+        updateDownloadQueue();
+        setTimeout(() => removeFromDownloadQueue(item.id), 3000);
+    });
+}
+
+// Download queue
+function addToDownloadQueue(path, type) {
+    const fileName = path.split('/').pop() || 'files';
+    const item = {
+        id: Date.now(),
+        path: path,
+        name: fileName,
+        type: type,
+        status: 'downloading'
+    };
+
+    downloadQueue.push(item);
+    updateDownloadQueue();
+    showDownloadQueue();
+
+    // Simulate download completion
+    setTimeout(() => {
+        item.status = 'completed';
+        updateDownloadQueue();
+
+        setTimeout(() => {
+            removeFromDownloadQueue(item.id);
+        }, 3000);
+    }, 2000);
+}
+
+function removeFromDownloadQueue(id) {
+    downloadQueue = downloadQueue.filter(item => item.id !== id);
+    updateDownloadQueue();
+
+    if (downloadQueue.length === 0) {
+        hideDownloadQueue();
+    }
+}
+
+function updateDownloadQueue() {
+    const queueItems = document.getElementById('queueItems');
+
+    queueItems.innerHTML = downloadQueue.map(item => `
+        <div class="queue-item">
+            <div>
+                <i class="fas fa-${item.type === 'folder' ? 'folder' : 'file'}"></i>
+                ${item.name}
+            </div>
+            <div>
+                ${item.status === 'downloading' ? `
+                    ${item.percent != null ? `${item.percent}%` : ''}
+                    <div class="loading-spinner"></div>
+                    ${item.job ? `<button class="close-btn" title="Cancel" onclick="cancelJob('${item.job}')"><i class="fas fa-times"></i></button>` : ''}` :
+                  item.status === 'failed' ?
+                    '<i class="fas fa-times" style="color: var(--danger-color);"></i>' :
+                    '<i class="fas fa-check" style="color: var(--success-color);"></i>'
+                }
+            </div>
+        </div>
+    `).join('');
+}
+
+function showDownloadQueue() {
+    document.getElementById('downloadQueue').classList.add('show');
+}
+
+function hideDownloadQueue() {
+    document.getElementById('downloadQueue').classList.remove('show');
+}
+
+// Shared text area
+function initializeSharedText() {
+    const textarea = document.getElementById('sharedTextArea');
+    const copyBtn = document.getElementById('copyTextBtn');
+
+    // Content arrives with shared_text_state once the socket connects
+    textarea.addEventListener('input', () => {
+        clearTimeout(sharedText.timer);
+        sharedText.timer = setTimeout(sendSharedText, 500);
+    });
+
+    // Handle copy button
+    if (copyBtn) {
+        copyBtn.addEventListener('click', () => {
+            copyToClipboard(textarea.value);
+        });
+    }
+}
+
+// Operations are lists of components over string indices: n > 0 keeps n characters,
+// n < 0 deletes -n characters and a string inserts it (same format as the server)
+function pushTextOp(op, component) {
+    if (component === 0 || component === '') return;
+    const last = op[op.length - 1];
+    if (typeof last === 'string' && typeof component === 'string') {
+        op[op.length - 1] = last + component;
+    } else if (typeof last === 'number' && typeof component === 'number' && (last > 0) === (component > 0)) {
+        op[op.length - 1] = last + component;
+    } else {
+        op.push(component);
+    }
+}
+
+function applyTextOp(text, op) {
+    const parts = [];
+    let pos = 0;
+    op.forEach(component => {
+        if (typeof component === 'string') {
+            parts.push(component);
+        } else if (component > 0) {
+            parts.push(text.slice(pos, pos + component));
+            pos += component;
+        } else {
+            pos -= component;
+        }
+    });
+    if (pos !== text.length) throw new Error('Operation does not fit the text');
+    return parts.join('');
+}
+
+// Returns [a', b'] so that a then b' equals b then a'; inserts of a go first
+function transformTextOps(a, b) {
+    const aPrime = [], bPrime = [];
+    let i = 0, j = 0;
+    let x = a[0], y = b[0];
+    while (x !== undefined || y !== undefined) {
+        if (typeof x === 'string') {
+            pushTextOp(aPrime, x);
+            pushTextOp(bPrime, x.length);
+            x = a[++i];
+            continue;
+        }
+        if (typeof y === 'string') {
+            pushTextOp(aPrime, y.length);
+            pushTextOp(bPrime, y);
+            y = b[++j];
+            continue;
+        }
+        if (x === undefined || y === undefined) throw new Error('Operations do not match');
+
+        const length = Math.min(Math.abs(x), Math.abs(y));
+        if (x > 0 && y > 0) {
+            pushTextOp(aPrime, length);
+            pushTextOp(bPrime, length);
+        } else if (x < 0 && y > 0) {
+            pushTextOp(aPrime, -length);
+        } else if (x > 0 && y < 0) {
+            pushTextOp(bPrime, -length);
+        }
+        x = x > 0 ? x - length : x + length;
+        y = y > 0 ? y - length : y + length;
+        if (x === 0) x = a[++i];
+        if (y === 0) y = b[++j];
+    }
+    return [aPrime, bPrime];
+}
+
+// Single replacement turning oldText into newText, never splitting a surrogate pair
+function diffTextOp(oldText, newText) {
+    const maxCommon = Math.min(oldText.length, newText.length);
+    let prefix = 0;
+    while (prefix < maxCommon && oldText.charCodeAt(prefix) === newText.charCodeAt(prefix)) prefix++;
+    if (prefix > 0 && /[\uD800-\uDBFF]/.test(oldText[prefix - 1])) prefix--;
+    let suffix = 0;
+    while (suffix < maxCommon - prefix &&
+           oldText.charCodeAt(oldText.length - 1 - suffix) === newText.charCodeAt(newText.length - 1 - suffix)) suffix++;
+    if (suffix > 0 && /[\uDC00-\uDFFF]/.test(oldText[oldText.length - suffix])) suffix--;
+
+    const op = [];
+    pushTextOp(op, prefix);
+    pushTextOp(op, -(oldText.length - prefix - suffix));
+    pushTextOp(op, newText.slice(prefix, newText.length - suffix));
+    pushTextOp(op, suffix);
+    return op;
+}
+
+// Where a text position ends up after an operation
+function transformTextIndex(index, op) {
+    let pos = 0, newPos = 0;
+    for (const component of op) {
+        if (typeof component === 'string') {
+            // Text inserted right at the position stays after it
+            if (pos < index) newPos += component.length;
+        } else if (component > 0) {
+            if (index <= pos + component) return newPos + (index - pos);
+            pos += component;
+            newPos += component;
+        } else {
+            if (index <= pos - component) return newPos;
+            pos -= component;
+        }
+    }
+    return newPos + Math.max(index - pos, 0);
+}
+
+function sendSharedText() {
+    clearTimeout(sharedText.timer);
+    sharedText.timer = null;
+    if (sharedText.outstanding || sharedText.syncing || !socket.connected) return;
+
+    const local = document.getElementById('sharedTextArea').value;
+    if (local === sharedText.base) return;
+    sharedText.outstanding = diffTextOp(sharedText.base, local);
+    sharedText.base = local;
+    socket.emit('shared_text_op', {version: sharedText.version, op: sharedText.outstanding});
+}
+
+// Operations (and acks, op null) are applied strictly in version order; with several
+// server workers they can arrive slightly out of order
+function receiveSharedText(version, op) {
+    if (!sharedText.syncing && version <= sharedText.version) return;
+    // Kept while syncing too, in case they are newer than the text that is on its way
+    sharedText.received[version] = op;
+    if (!sharedText.syncing) {
+        drainSharedText();
+    }
+}
+
+function drainSharedText() {
+    while ((sharedText.version + 1) in sharedText.received) {
+        const next = sharedText.received[sharedText.version + 1];
+        delete sharedText.received[sharedText.version + 1];
+        if (next === null) {
+            // Our outstanding operation became this version
+            sharedText.version++;
+            sharedText.confirmed = sharedText.base;
+            sharedText.outstanding = null;
+            if (!sharedText.timer) {
+                sendSharedText();
+            }
+        } else {
+            applyRemoteSharedText(sharedText.version + 1, next);
+            if (sharedText.syncing) return;
+        }
+    }
+
+    if (Object.keys(sharedText.received).length > 100) {
+        // A version never arrived
+        sharedText.syncing = true;
+        socket.emit('shared_text_sync');
+    }
+}
+
+function applyRemoteSharedText(version, op) {
+    const textarea = document.getElementById('sharedTextArea');
+    try {
+        let remote = op;
+        sharedText.confirmed = applyTextOp(sharedText.confirmed, remote);
+        if (sharedText.outstanding) {
+            [sharedText.outstanding, remote] = transformTextOps(sharedText.outstanding, remote);
+        }
+        // Edits not sent yet stay in the textarea; move the remote operation past them
+        const [, forTextarea] = transformTextOps(diffTextOp(sharedText.base, textarea.value), remote);
+        sharedText.base = applyTextOp(sharedText.base, remote);
+
+        const focused = document.activeElement === textarea;
+        const start = transformTextIndex(textarea.selectionStart, forTextarea);
+        const end = transformTextIndex(textarea.selectionEnd, forTextarea);
+        textarea.value = applyTextOp(textarea.value, forTextarea);
+        if (focused) {
+            textarea.setSelectionRange(start, end);
+        }
+        sharedText.version = version;
+    } catch (error) {
+        console.error('Shared text out of sync, reloading:', error);
+        sharedText.syncing = true;
+        socket.emit('shared_text_sync');
+    }
+}
+
+function applySharedTextState(data) {
+    const textarea = document.getElementById('sharedTextArea');
+    const ackedLater = Object.keys(sharedText.received).some(
+        version => Number(version) > data.version && sharedText.received[version] === null);
+    if (ackedLater) {
+        // Our last operation landed after this text was read; ask again to include it
+        sharedText.received = {};
+        socket.emit('shared_text_sync');
+        return;
+    }
+    const localEdits = sharedText.version !== null && textarea.value !== sharedText.confirmed;
+
+    // Keep local edits if nobody else changed the text in the meantime
+    const keepLocal = localEdits && data.content === sharedText.confirmed;
+    if (!keepLocal) {
+        textarea.value = data.content;
+    }
+    sharedText.version = data.version;
+    sharedText.confirmed = data.content;
+    sharedText.base = data.content;
+    sharedText.outstanding = null;
+    sharedText.syncing = false;
+    Object.keys(sharedText.received).forEach(version => {
+        if (Number(version) <= data.version) {
+            delete sharedText.received[version];
+        }
+    });
+    drainSharedText();
+    if (keepLocal) {
+        sendSharedText();
+    }
+}
+
+function formatText(type) {
+    const textarea = document.getElementById('sharedTextArea');
+    let content = textarea.value;
+
+    switch (type) {
+        case 'upper':
+            content = content.toUpperCase();
+            break;
+        case 'lower':
+            content = content.toLowerCase();
+            break;
+        case 'title':
+            content = content.replace(/\w\S*/g, (txt) => 
+                txt.charAt(0).toUpperCase() + txt.substr(1).toLowerCase()
+            );
+            break;
+        case 'clear':
+            content = '';
+            break;
+    }
+
+    textarea.value = content;
+    // Immediately update shared text to sync with other clients
+    sendSharedText();
+    textarea.focus();
+}
+
+// Search functionality
+function initializeSearch() {
+    const searchInput = document.getElementById('searchInput');
+    let searchTimeout;
+
+    searchInput.addEventListener('input', () => {
+        clearTimeout(searchTimeout);
+        searchTimeout = setTimeout(() => {
+            const query = searchInput.value.trim();
+            const url = new URL(window.location);
+
+            if (query) {
+                url.searchParams.set('search', query);
+            } else {
+                url.searchParams.delete('search');
+            }
+
+            history.replaceState(null, '', url.toString());
+            searchQuery = query;
+            document.querySelector('#fileListEmpty p').textContent = query ? 'No matching files' : 'This directory is empty';
+            document.getElementById('fileListViewport').scrollTop = 0;
+            reloadFileList();
+        }, 300);
+    });
+}
+
+// Sorting functionality
+function initializeSorting() {
+    const sortSelect = document.getElementById('sortSelect');
+    const sortOrderBtn = document.getElementById('sortOrderBtn');
+
+    if (sortSelect) {
+        sortSelect.addEventListener('change', () => {
+            updateSort();
+        });
+    }
+
+    if (sortOrderBtn) {
+        sortOrderBtn.addEventListener('click', () => {
+            const currentOrder = sortOrderBtn.dataset.order;
+            const newOrder = currentOrder === 'asc' ? 'desc' : 'asc';
+            sortOrderBtn.dataset.order = newOrder;
+
+            const icon = sortOrderBtn.querySelector('i');
+            icon.className = `fas fa-sort-${newOrder === 'asc' ? 'up' : 'down'}`;
+
+            updateSort();
+        });
+    }
+}
+
+function updateSort() {
+    const sortSelect = document.getElementById('sortSelect');
+    const sortOrderBtn = document.getElementById('sortOrderBtn');
+
+    const url = new URL(window.location);
+    url.searchParams.set('sort', sortSelect.value);
+    url.searchParams.set('order', sortOrderBtn.dataset.order);
+    history.replaceState(null, '', url.toString());
+
+    sortBy = sortSelect.value;
+    sortOrder = sortOrderBtn.dataset.order;
+    document.getElementById('fileListViewport').scrollTop = 0;
+    reloadFileList();
+}
+
+// Modal functions
+function showModal(modalId) {
+    document.getElementById(modalId).classList.add('show');
+}
+
+function closeModal(modalId) {
+    const modal = document.getElementById(modalId);
+
+    // Stop any audio/video that might be playing in the modal
+    if (modalId === 'previewModal') {
+        stopFollowingText();
+
+        const audioElements = modal.querySelectorAll('audio');
+        const videoElements = modal.querySelectorAll('video');
+
+        audioElements.forEach(audio => {
+            audio.pause();
+            audio.currentTime = 0;
+        });
+
+        videoElements.forEach(video => {
+            video.pause();
+            video.currentTime = 0;
+        });
+    }
+
+    modal.classList.remove('show');
+}
+
+// Alert functions
+function showAlert(message, type = 'info') {
+    const alertContainer = document.getElementById('alertContainer');
+    const alertId = 'alert-' + Date.now();
+
+    const alertHtml = `
+        <div class="alert alert-${type}" id="${alertId}">
+            <i class="fas fa-${getAlertIcon(type)}"></i>
+            ${message}
+            <button class="close-btn" onclick="closeAlert('${alertId}')" style="margin-left: auto;">
+                <i class="fas fa-times"></i>
+            </button>
+        </div>
+    `;
+
+    alertContainer.insertAdjacentHTML('beforeend', alertHtml);
+
+    // Auto-remove after 5 seconds
+    setTimeout(() => {
+        closeAlert(alertId);
+    }, 5000);
+}
+
+function getAlertIcon(type) {
+    switch (type) {
+        case 'success': return 'check-circle';
+        case 'error': return 'exclamation-triangle';
+        case 'warning': return 'exclamation-triangle';
+        default: return 'info-circle';
+    }
+}
+
+function closeAlert(alertId) {
+    const alert = document.getElementById(alertId);
+    if (alert) {
+        alert.style.opacity = '0';
+        alert.style.transform = 'translateX(100%)';
+        setTimeout(() => {
+            alert.remove();
+        }, 300);
+    }
+}
+
+// Utility functions
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+function escapeAttribute(text) {
+    return escapeHtml(text).replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+}
+
+function copyToClipboard(text) {
+    // Check if modern clipboard API is available
+    if (navigator.clipboard && navigator.clipboard.writeText) {
+        navigator.clipboard.writeText(text).then(() => {
+            showAlert('Text copied to clipboard!', 'success');
+        }).catch(err => {
+            // Fallback if modern API fails
+            copyToClipboardFallback(text);
+        });
+    } else {
+        // Use fallback method
+        copyToClipboardFallback(text);
+    }
+}
+
+function copyToClipboardFallback(text) {
+    const textarea = document.createElement('textarea');
+    textarea.value = text;
+    textarea.style.position = 'fixed';
+    textarea.style.left = '-999999px';
+    textarea.style.top = '-999999px';
+    document.body.appendChild(textarea);
+    textarea.focus();
+    textarea.select();
+
+    try {
+        const successful = document.execCommand('copy');
+        if (successful) {
+            showAlert('Text copied to clipboard!', 'success');
+        } else {
+            showAlert('Failed to copy text', 'error');
+        }
+    } catch (err) {
+        showAlert('Copy not supported in this browser', 'error');
+    }
+
+    document.body.removeChild(textarea);
+}
+
+// Close modals when clicking outside
+document.addEventListener('click', (e) => {
+    if (e.target.classList.contains('modal')) {
+        const modalId = e.target.id;
+        closeModal(modalId);
+    }
+});
+
+// Keyboard shortcuts
+document.addEventListener('keydown', (e) => {
+    // Escape key closes modals and context menu
+    if (e.key === 'Escape') {
+        const modals = document.querySelectorAll('.modal.show');
+        modals.forEach(modal => {
+            closeModal(modal.id);
+        });
+        hideContextMenu();
+        // With nothing else open, Escape unticks the selection
+        if (!modals.length && selectedPaths.size) {
+            clearSelection();
+        }
+    }
+
+    // Ctrl+U for upload (admin only)
+    if (e.ctrlKey && e.key === 'u' && document.getElementById('fileInput')) {
+        e.preventDefault();
+        document.getElementById('fileInput').click();
+    }
+
+    // Ctrl+N for new folder (admin only)
+    if (e.ctrlKey && e.key === 'n' && document.getElementById('createFolderBtn')) {
+        e.preventDefault();
+        showModal('createFolderModal');
+    }
+});